@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+エージェントベースの負荷生成（マーケットメイカー・モメンタム・ノイズトレーダー）。
+
+数千人分のエージェントのパラメータを NumPy 配列で持ち、注文（エージェント・売買・
+指値・数量）をまとめて乱数で生成する。drive() は生成した注文を注文受付の
+callable に目標レートで流し込むので、マッチングとストレージを本番相当の量で
+オフラインに回せる。価格・数量は fixedpoint の整数単位。
+
+    python agents.py --backend memory --agents 5000 --rate 2000 --seconds 10
+
+    種類        売買                         指値
+    mm          買い・売りを半々             mid から ±spread の外側（板に残る）
+    momentum    直近の値動きの方向に寄せる   mid を越えて取りに行く（約定しやすい）
+    noise       半々                         mid の周りに対数正規でばらつく
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, Optional
+
+import numpy as np
+
+from exchange import Exchange
+from fixedpoint import PRICE_SCALE, QTY_SCALE, to_mock, to_lots
+from storage import JournalStorage, MemoryStorage, SQLiteStorage
+
+MM, MOMENTUM, NOISE = 0, 1, 2
+KIND_NAMES = ("mm", "momentum", "noise")
+
+
+class AgentPool:
+    def __init__(self, n_mm:int=100, n_momentum:int=200, n_noise:int=700, seed:Optional[int]=None,
+                 spread_bps:float=20, aggress_bps:float=30, noise_sigma:float=0.01, size_mean:float=1.0):
+        self.rng = np.random.default_rng(seed)
+        self.kind = np.repeat(np.array([MM, MOMENTUM, NOISE], dtype=np.int8), [n_mm, n_momentum, n_noise])
+        n = len(self.kind)
+        # エージェントごとの注文サイズ（Y）の中央値。大口と小口が混ざるように対数正規で振る
+        self.size = size_mean * self.rng.lognormal(0.0, 0.75, n)
+        self.spread = spread_bps / 1e4
+        self.aggress = aggress_bps / 1e4
+        self.noise_sigma = noise_sigma
+
+    def __len__(self):
+        return len(self.kind)
+
+    def batch(self, n:int, mid:int, trend:float=0.0):
+        """n 件の注文を生成する。mid は現在価格（1e-6 Mock）、trend は直近の相対変化。
+        戻り値は (agent, is_buy, price, qty) の配列（price / qty は int64）"""
+        rng = self.rng
+        agent = rng.integers(0, len(self.kind), n)
+        kind = self.kind[agent]
+        u = rng.random(n)
+        # モメンタム: 上昇中は買い寄り（確率 0.5 + trend を 0.1〜0.9 に丸める）
+        p_buy = np.where(kind == MOMENTUM, np.clip(0.5 + trend * 50, 0.1, 0.9), 0.5)
+        is_buy = u < p_buy
+        sign = np.where(is_buy, 1.0, -1.0)
+        rel = np.where(kind == MM, -sign * self.spread * (1 + rng.random(n)),
+              np.where(kind == MOMENTUM, sign * self.aggress,
+                       rng.normal(0.0, self.noise_sigma, n)))
+        price = np.maximum(np.rint(mid * np.exp(rel)), PRICE_SCALE).astype(np.int64)
+        qty = np.maximum(np.rint(self.size[agent] * rng.lognormal(0.0, 0.5, n) * QTY_SCALE), 1).astype(np.int64)
+        return agent, is_buy, price, qty
+
+
+def drive(pool:AgentPool, submit:Callable[[int,str,int,int],object], mid:Callable[[],int],
+          n_orders:int, rate:Optional[float]=None, batch:int=256, uids=None)->dict:
+    """pool の注文を submit(uid, side, price, qty) に n_orders 件流す。
+    rate（件/秒）を指定するとその速さに合わせて待つ。uids はエージェント番号 -> user_id"""
+    sent = 0
+    last_mid = mid()
+    trend = 0.0
+    lag = 0.0   # 目標レートからの遅れ（秒）の最大
+    t0 = time.perf_counter()
+    while sent < n_orders:
+        m = mid()
+        trend = 0.8 * trend + 0.2 * (m - last_mid) / max(last_mid, 1)   # 値動きの指数移動平均
+        last_mid = m
+        k = min(batch, n_orders - sent)
+        agent, is_buy, price, qty = pool.batch(k, m, trend)
+        for a, b, p, q in zip(agent.tolist(), is_buy.tolist(), price.tolist(), qty.tolist()):
+            if rate:
+                wait = t0 + sent / rate - time.perf_counter()
+                if wait > 0: time.sleep(wait)
+                else: lag = max(lag, -wait)
+            submit(uids[a] if uids is not None else a, 'buy' if b else 'sell', p, q)
+            sent += 1
+    wall = time.perf_counter() - t0
+    return {"orders": sent, "wall_s": wall, "orders_per_s": sent / wall if wall else 0.0, "max_lag_s": lag}
+
+
+# ---------------------- オフライン実行 ----------------------
+BACKENDS = {
+    "sqlite":  lambda d: SQLiteStorage(os.path.join(d, "agents.db")),
+    "journal": lambda d: JournalStorage(os.path.join(d, "agents.json")),
+    "memory":  lambda d: MemoryStorage(),
+}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--backend", choices=sorted(BACKENDS), default="memory")
+    ap.add_argument("--agents", type=int, default=1000, help="エージェント数（mm:momentum:noise = 1:2:7）")
+    ap.add_argument("--rate", type=float, default=None, help="目標の注文レート（件/秒、省略時は全速）")
+    ap.add_argument("--seconds", type=float, default=10.0)
+    ap.add_argument("--orders", type=int, default=None, help="注文数（省略時は rate × seconds）")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="agents_")
+    try:
+        storage = BACKENDS[args.backend](workdir)
+        ex = Exchange(storage)
+        n = args.agents
+        pool = AgentPool(n // 10, n // 5, n - n // 10 - n // 5, seed=args.seed)
+        uids = [ex.create_user(f"agent{i}", "pw") for i in range(len(pool))]
+        storage.set_wallets((u, to_mock(1e9), to_lots(1e6)) for u in uids)
+
+        n_orders = args.orders or int((args.rate or 1000) * args.seconds)
+        fills = [0]
+        def submit(uid, side, price, qty):
+            fills[0] += ex.place_order(uid, side, price, qty)
+        res = drive(pool, submit, ex.price, n_orders, args.rate, uids=uids)
+        print(f"{args.backend}: {res['orders']} orders in {res['wall_s']:.2f}s = {res['orders_per_s']:.0f} orders/s, "
+              f"{fills[0]} fills, book {len(ex.book)}, price {ex.price() / PRICE_SCALE:.2f}, "
+              f"max lag {res['max_lag_s'] * 1e3:.1f} ms")
+        storage.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
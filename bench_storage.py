@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+ストレージのバックエンド（SQLite・ジャーナル・メモリ）を同じワークロードで比べるベンチマーク。
+
+バックエンドごとに新しい exchange.Exchange を作り、乱数シード固定の同じ操作列
+（登録・販売所の連打・小口の約定・厚い板の一括約定・画面の読み込み）を流して、
+スループットと p50/p99 レイテンシを表にして JSON に保存する。
+
+    python bench_storage.py --users 100 --n 2000 --out bench_storage.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+from exchange import Exchange
+from fixedpoint import to_mock, to_lots
+from storage import JournalStorage, MemoryStorage, SQLiteStorage
+
+BACKENDS = {
+    "sqlite":  lambda d, name: SQLiteStorage(os.path.join(d, name + ".db")),
+    "journal": lambda d, name: JournalStorage(os.path.join(d, name + ".json")),
+    "memory":  lambda d, name: MemoryStorage(),
+}
+
+# ---------------------- ワークロード ----------------------
+def fresh(make, workdir:str, name:str, n_users:int):
+    """新しいバックエンドに資金を入れたユーザーを n_users 人登録する"""
+    ex = Exchange(make(workdir, name))
+    uids = [ex.create_user(f"bench{i}", "pw") for i in range(n_users)]
+    ex.storage.set_wallets((uid, to_mock(1e9), to_lots(1e6)) for uid in uids)
+    return ex, uids
+
+def run(ops)->dict:
+    lat = []
+    t0 = time.perf_counter()
+    for op in ops:
+        t = time.perf_counter()
+        op()
+        lat.append(time.perf_counter() - t)
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return {
+        "ops": len(lat),
+        "wall_s": wall,
+        "ops_per_s": len(lat) / wall if wall else 0.0,
+        "p50_ms": lat[len(lat) // 2] * 1e3 if lat else 0.0,
+        "p99_ms": lat[min(len(lat) - 1, int(len(lat) * 0.99))] * 1e3 if lat else 0.0,
+    }
+
+def bench_signup(make, workdir, n_users, n, rng):
+    """ユーザー登録"""
+    ex = Exchange(make(workdir, "signup"))
+    names = iter(range(n))
+    return ex, run([lambda: ex.create_user(f"u{next(names)}", "pw")] * n)
+
+def bench_dealer(make, workdir, n_users, n, rng):
+    """販売所の売買を連打"""
+    ex, uids = fresh(make, workdir, "dealer", n_users)
+    def op():
+        uid = rng.choice(uids); qty = to_lots(rng.randint(1, 5))
+        if rng.random() < 0.5: ex.dealer_buy(uid, qty)
+        else: ex.dealer_sell(uid, qty)
+    return ex, run([op] * n)
+
+def bench_small_fills(make, workdir, n_users, n, rng):
+    """数量1の売り注文に数量1の買い注文を1本ずつぶつける（1注文1約定）"""
+    ex, uids = fresh(make, workdir, "small", n_users)
+    for i in range(n):
+        ex.place_order(uids[i % n_users], 'sell', to_mock(100 + rng.randint(0, 20)), to_lots(1))
+    return ex, run([lambda: ex.place_order(rng.choice(uids), 'buy', to_mock(200), to_lots(1))] * n)
+
+def bench_deep(make, workdir, n_users, n, rng):
+    """n 本の売り注文が並んだ板を1本の買い注文で一括約定させる"""
+    ex, uids = fresh(make, workdir, "deep", n_users)
+    for i in range(n):
+        ex.place_order(uids[i % n_users], 'sell', to_mock(100 + (i % 200) * 0.5), to_lots(rng.randint(1, 3)))
+    return ex, run([lambda: ex.place_order(uids[0], 'buy', to_mock(200), to_lots(1e7))])
+
+def bench_reads(make, workdir, n_users, n, rng):
+    """画面1回分の読み込み（残高・価格・履歴）"""
+    ex, uids = fresh(make, workdir, "reads", n_users)
+    for i in range(n):
+        ex.dealer_buy(uids[i % n_users], to_lots(1))
+        ex.place_order(uids[i % n_users], 'buy' if i % 2 else 'sell', to_mock(100), to_lots(1))
+    def op():
+        ex.wallet(rng.choice(uids)); ex.price()
+        ex.trades('dealer', 50); ex.trades('exchange', 50)
+    return ex, run([op] * n)
+
+WORKLOADS = {
+    "signup": bench_signup,
+    "dealer": bench_dealer,
+    "small_fills": bench_small_fills,
+    "deep_crossing": bench_deep,
+    "reads": bench_reads,
+}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--n", type=int, default=2000, help="ワークロードあたりの操作数（板の厚さ）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--backends", nargs="*", choices=sorted(BACKENDS))
+    ap.add_argument("--only", nargs="*", choices=sorted(WORKLOADS), help="実行するワークロード")
+    ap.add_argument("--out", default="bench_storage.json")
+    args = ap.parse_args()
+
+    backends = args.backends or list(BACKENDS)
+    workloads = args.only or list(WORKLOADS)
+    results = {b: {} for b in backends}
+    workdir = tempfile.mkdtemp(prefix="bench_storage_")
+    try:
+        for b in backends:
+            os.makedirs(os.path.join(workdir, b))
+            for name in workloads:
+                rng = random.Random(args.seed)   # バックエンド間で同じ操作列
+                ex, res = WORKLOADS[name](BACKENDS[b], os.path.join(workdir, b), args.users, args.n, rng)
+                ex.storage.close()
+                results[b][name] = res
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'ops/s (p99 ms)':<16}" + "".join(f"{b:>22}" for b in backends))
+    for name in workloads:
+        cells = "".join(f"{results[b][name]['ops_per_s']:>12.0f} ({results[b][name]['p99_ms']:6.2f})"
+                        for b in backends)
+        print(f"{name:<16}{cells}")
+
+    report = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "args": vars(args),
+        },
+        "backends": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved: {args.out}")
+
+if __name__ == "__main__":
+    main()
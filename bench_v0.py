@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+crypt_demo_v0 の取引所コア（販売所・注文受付・マッチング）のベンチマーク。
+
+Streamlit の画面なしで一時 SQLite DB を init_db() で作り、create_user で
+ダミーユーザーを用意してから、乱数シード固定のワークロードを流す。
+ワークロードごとにスループット、p50/p99 レイテンシ、DB 時間を測り、JSON に保存する。
+
+    python bench_v0.py --users 100 --n 2000 --out bench_v0.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import crypt_demo_v0 as core
+import metrics
+
+# ---------------------- DB 時間の計測 ----------------------
+_db_time = [0.0]   # SQLite の中で過ごした累計秒
+
+class TimedConnection(metrics.TimedConnection):
+    """metrics の接続クラスの計測値を _db_time にも積む（metrics が無効でも測る）"""
+    def _observe(self, name:str, seconds:float):
+        _db_time[0] += seconds
+        if metrics.ENABLED:
+            super()._observe(name, seconds)
+
+# ---------------------- ワークロード ----------------------
+def fresh_db(workdir:str, name:str, n_users:int):
+    """一時 DB を作り、資金を入れたユーザーを n_users 人登録して ID を返す"""
+    core.DB = os.path.join(workdir, name + ".db")
+    core.init_db()
+    uids = [core.create_user(f"bench{i}", "pw") for i in range(n_users)]
+    for uid in uids:
+        core.set_wallet(uid, core.to_mock(1e9), core.to_lots(1e6))
+    return uids
+
+def run(name:str, ops)->dict:
+    """ops（引数なし callable の列）を順に実行し、統計を返す"""
+    lat = []
+    db0 = _db_time[0]
+    t0 = time.perf_counter()
+    for op in ops:
+        t = time.perf_counter()
+        op()
+        lat.append(time.perf_counter() - t)
+    wall = time.perf_counter() - t0
+    db = _db_time[0] - db0
+    lat.sort()
+    res = {
+        "ops": len(lat),
+        "wall_s": wall,
+        "ops_per_s": len(lat) / wall if wall else 0.0,
+        "p50_ms": lat[len(lat) // 2] * 1e3 if lat else 0.0,
+        "p99_ms": lat[min(len(lat) - 1, int(len(lat) * 0.99))] * 1e3 if lat else 0.0,
+        "db_s": db,
+        "db_share": db / wall if wall else 0.0,
+    }
+    print(f"{name:<18} {res['ops']:>7} ops {res['ops_per_s']:>10.0f} ops/s "
+          f"p50 {res['p50_ms']:7.3f} ms  p99 {res['p99_ms']:7.3f} ms  db {res['db_share']:5.1%}")
+    return res
+
+def run_concurrent(name:str, op, n:int, clients:int)->dict:
+    """clients 本のスレッドから op を合計 n 回呼び、1回ごとのレイテンシで統計を取る"""
+    lat = []
+    db0 = _db_time[0]
+    def client(k):
+        for _ in range(k):
+            t = time.perf_counter()
+            op()
+            lat.append(time.perf_counter() - t)
+    threads = [threading.Thread(target=client, args=(n // clients + (i < n % clients),)) for i in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.perf_counter() - t0
+    db = _db_time[0] - db0
+    lat.sort()
+    res = {
+        "ops": len(lat),
+        "clients": clients,
+        "wall_s": wall,
+        "ops_per_s": len(lat) / wall if wall else 0.0,
+        "p50_ms": lat[len(lat) // 2] * 1e3 if lat else 0.0,
+        "p99_ms": lat[min(len(lat) - 1, int(len(lat) * 0.99))] * 1e3 if lat else 0.0,
+        "db_s": db,
+        "db_share": db / wall if wall else 0.0,
+    }
+    print(f"{name:<18} {res['ops']:>7} ops {res['ops_per_s']:>10.0f} ops/s "
+          f"p50 {res['p50_ms']:7.3f} ms  p99 {res['p99_ms']:7.3f} ms  db {res['db_share']:5.1%}")
+    return res
+
+def bench_dealer_burst(workdir, n_users, n, rng):
+    """販売所の売買を連打"""
+    uids = fresh_db(workdir, "dealer", n_users)
+    def op():
+        uid = rng.choice(uids); qty = core.to_lots(rng.randint(1, 5))
+        if rng.random() < 0.5: core.dealer_buy(uid, qty)
+        else: core.dealer_sell(uid, qty)
+    return run("dealer_burst", [op] * n)
+
+DEALER_CLIENTS = 64
+
+def bench_dealer_engine(workdir, n_users, n, rng):
+    """DEALER_CLIENTS 人が同時に販売所の売買を連打（DealerEngine でまとめて約定）"""
+    uids = fresh_db(workdir, "dealer_engine", n_users)
+    engine = core.get_dealer()
+    lock = threading.Lock()   # rng はスレッド間で共有
+    def op():
+        with lock:
+            uid = rng.choice(uids); qty = core.to_lots(rng.randint(1, 5)); buy = rng.random() < 0.5
+        engine.call(uid, 'buy' if buy else 'sell', qty)
+    return run_concurrent("dealer_engine", op, n, DEALER_CLIENTS)
+
+def bench_deep_book(workdir, n_users, n, rng):
+    """n 本の売り注文が並んだ厚い板を、1本の大きな買い注文で一気に約定させる"""
+    uids = fresh_db(workdir, "deep", n_users)
+    for i in range(n):
+        core.place_order(uids[i % n_users], 'sell', core.to_mock(100 + (i % 200) * 0.5), core.to_lots(rng.randint(1, 3)))
+    fills = []
+    def sweep():
+        fills.append(core.place_order(uids[0], 'buy', core.to_mock(200), core.to_lots(1e7)))
+    res = run("deep_crossing", [sweep])
+    res["fills"] = fills[0]
+    res["fills_per_s"] = fills[0] / res["wall_s"] if res["wall_s"] else 0.0
+    print(f"{'':<18} {fills[0]:>7} fills {res['fills_per_s']:>8.0f} fills/s")
+    return res
+
+def bench_small_fills(workdir, n_users, n, rng):
+    """数量1の売り注文に、数量1の買い注文を1本ずつぶつける（1注文1約定）"""
+    uids = fresh_db(workdir, "small", n_users)
+    for i in range(n):
+        core.place_order(uids[i % n_users], 'sell', core.to_mock(100 + rng.randint(0, 20)), core.to_lots(1))
+    def op():
+        core.place_order(rng.choice(uids), 'buy', core.to_mock(200), core.to_lots(1))
+    return run("small_fills", [op] * n)
+
+def bench_dashboard(workdir, n_users, n, rng):
+    """main_ui 1回分の読み込みと、注文・販売所の書き込みを 4:1 で混ぜる"""
+    uids = fresh_db(workdir, "mixed", n_users)
+    for i in range(n):
+        side = 'buy' if i % 2 else 'sell'
+        price = 100 + (rng.randint(-20, -1) if side == 'buy' else rng.randint(1, 20))
+        core.place_order(uids[i % n_users], side, core.to_mock(price), core.to_lots(1))
+        core.dealer_buy(uids[i % n_users], core.to_lots(1))
+    def render():
+        uid = rng.choice(uids)
+        core.get_wallet(uid); core.get_price()
+        core.trades_page('dealer', limit=51); core.candles_frame('all', 60, 120)
+        core.depth_table('buy'); core.depth_table('sell'); core.trades_page('exchange', limit=51)
+    def write():
+        uid = rng.choice(uids)
+        if rng.random() < 0.5:
+            core.place_order(uid, rng.choice(['buy', 'sell']), core.to_mock(100 + rng.randint(-5, 5)), core.to_lots(1))
+        else:
+            core.dealer_buy(uid, core.to_lots(1))
+    ops = [write if i % 5 == 4 else render for i in range(n)]
+    return run("mixed_dashboard", ops)
+
+WORKLOADS = {
+    "dealer_burst": bench_dealer_burst,
+    "dealer_engine": bench_dealer_engine,
+    "deep_crossing": bench_deep_book,
+    "small_fills": bench_small_fills,
+    "mixed_dashboard": bench_dashboard,
+}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--n", type=int, default=2000, help="ワークロードあたりの操作数（板の厚さ）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--only", nargs="*", choices=sorted(WORKLOADS), help="実行するワークロード")
+    ap.add_argument("--out", default="bench_v0.json")
+    args = ap.parse_args()
+
+    core.DB_FACTORY = TimedConnection
+    workdir = tempfile.mkdtemp(prefix="bench_v0_")
+    results = {}
+    try:
+        for name in args.only or WORKLOADS:
+            rng = random.Random(args.seed)
+            results[name] = WORKLOADS[name](workdir, args.users, args.n, rng)
+        bad_plans = core.check_query_plans()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if bad_plans:
+        print("WARNING: 全表走査に戻ったクエリがあります:", bad_plans)
+
+    report = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "args": vars(args),
+            "bad_query_plans": bad_plans,
+        },
+        "workloads": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved: {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+価格チャートの描画（crypt_demo_v1 / v3 の matplotlib チャート）。
+
+長い系列は LTTB（Largest-Triangle-Three-Buckets）で MAX_POINTS 点まで間引いてから
+描き、PNG にする。ChartCache は系列のバージョンごとに PNG を持つ（v1 の販売所チャート）。pyplot を通さず Figure を
+直接作るので、再実行ごとに図が溜まっていくことはない。描画コストもメモリも
+履歴の長さに関係なく一定になる。
+
+    charts = ChartCache()
+    png = charts.get("dealer", len(txs), lambda: line_png(times, prices, ylabel="Price"))
+    st.image(png)
+"""
+
+import datetime
+import io
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Sequence
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.dates as mdates
+
+MAX_POINTS = 500     # 1本の線に描く点数の上限
+MARKER_MAX = 50      # これ以下の点数のときだけマーカーを付ける
+CACHE_SIZE = 32      # 保持するチャートの数（キーごとに最新の1枚）
+
+
+def lttb(x:np.ndarray, y:np.ndarray, n:int)->np.ndarray:
+    """見た目の形を保つように n 点を選び、その添字を返す（両端は必ず含む）"""
+    m = len(x)
+    if n >= m or n < 3:
+        return np.arange(m)
+    idx = np.empty(n, dtype=np.int64)
+    idx[0], idx[-1] = 0, m - 1
+    edges = np.linspace(1, m - 1, n - 1).astype(np.int64)   # 端を除いた n-2 個のバケツの境界
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < n - 1:
+            cx = x[hi:edges[i + 2]].mean(); cy = y[hi:edges[i + 2]].mean()   # 次のバケツの平均
+        else:
+            cx, cy = x[-1], y[-1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def line_png(x:Sequence, y:Sequence, title:str="", ylabel:str="", max_points:int=MAX_POINTS)->bytes:
+    """x（数値・date・datetime・"%Y-%m-%d %H:%M:%S" の文字列）と y の折れ線を PNG にする"""
+    dates = len(x) > 0 and isinstance(x[0], (str, datetime.date))
+    xs = np.asarray(mdates.date2num(np.asarray(x, dtype="datetime64[s]")) if dates else x, dtype=float)
+    ys = np.asarray(y, dtype=float)
+    keep = lttb(xs, ys, max_points)
+    xs, ys = xs[keep], ys[keep]
+
+    fig = Figure(figsize=(6.4, 4.0))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot(xs, ys, marker="o" if len(xs) <= MARKER_MAX else None)
+    if dates:
+        loc = mdates.AutoDateLocator()
+        ax.xaxis.set_major_locator(loc)
+        ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(loc))
+    if title: ax.set_title(title)
+    if ylabel: ax.set_ylabel(ylabel)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+class ChartCache:
+    """key ごとに最新バージョンの PNG だけを持つ LRU（全セッションで共有してよい）"""
+
+    def __init__(self, size:int=CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self._png = OrderedDict()   # key -> (version, png)
+
+    def get(self, key:Hashable, version:Hashable, render:Callable[[],bytes])->bytes:
+        """version が前回と同じならキャッシュを返し、違えば render() で描き直す"""
+        with self.lock:
+            hit = self._png.get(key)
+            if hit and hit[0] == version:
+                self._png.move_to_end(key)
+                return hit[1]
+        png = render()
+        with self.lock:
+            self._png[key] = (version, png)
+            self._png.move_to_end(key)
+            while len(self._png) > self.size:
+                self._png.popitem(last=False)
+        return png
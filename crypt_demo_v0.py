@@ -7,71 +7,242 @@ Created on Sat Sep  6 19:16:07 2025
 
 import streamlit as st
 import pandas as pd
+from dateutil.tz import tzlocal
 import sqlite3
-import hashlib, os, time, secrets
+import hashlib, os, queue, sys, time, secrets, threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
+
+from dealer import DealerEngine
+from exchange import EX_FEE_BPS, dealer_fill, sweep
+import gateway
+from fixedpoint import PRICE_SCALE, QTY_SCALE, to_mock, to_lots, mock_value, y_value, notional, bps_fee
+import ledger
+import metrics
+from ledger import ISSUER, MOCK, Y, Postings
+from orderbook import OrderBook
+import snapshot
+from storage import (SCHEMA_VERSION, DB_PRAGMAS, ORDER_INDEXES, TRADE_INDEXES, OLD_TRADE_INDEXES,
+                     create_tables, create_indexes, create_order_log, upsert_candles)
+from worker import Worker
 
 DB = "simdex.db"
 
 # ---------------------- DB LAYER ----------------------
+# 接続クラス（計測時に差し替える）。SIMDEX_METRICS=1 なら DB の往復を metrics に記録する
+DB_FACTORY = metrics.TimedConnection if metrics.ENABLED else sqlite3.Connection
+
+DB_POOL_SIZE = 8   # 返却された接続をプロセスで保持する本数（超えた分は閉じる）
+
+class _Lease:
+    """スレッドが借りている接続。スレッドが終わって threading.local が消えるとプールに返る"""
+    __slots__ = ("pool", "con")
+
+    def __init__(self, pool:"ConnPool", con:sqlite3.Connection):
+        self.pool = pool
+        self.con = con
+
+    def __del__(self):
+        try:
+            self.pool.release(self.con)
+        except Exception:
+            pass   # 終了処理中など
+
+class ConnPool:
+    """DB ごとの接続プール。スレッドは最初の db_conn() で空いている接続を借り、終了時に返す。
+    Streamlit は再実行ごとに新しいスレッドで動くが、接続（PRAGMA 済み・文のキャッシュ入り）は
+    プールを通して次の再実行に引き継がれる"""
+
+    def __init__(self, db:str, size:int=DB_POOL_SIZE):
+        self.db = db
+        self.idle = queue.Queue(maxsize=size)
+        self.local = threading.local()
+
+    def _connect(self)->sqlite3.Connection:
+        con = sqlite3.connect(self.db, check_same_thread=False, cached_statements=256,
+                              factory=DB_FACTORY)
+        for pragma in DB_PRAGMAS:
+            con.execute(pragma)
+        metrics.inc("db_connects")
+        return con
+
+    def get(self)->sqlite3.Connection:
+        lease = getattr(self.local, "lease", None)
+        if lease is None:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                con = self._connect()
+            lease = self.local.lease = _Lease(self, con)
+        return lease.con
+
+    def release(self, con:sqlite3.Connection):
+        if con.in_transaction:
+            con.rollback()   # 途中で終わったスレッドの書きかけは捨てる
+        try:
+            self.idle.put_nowait(con)
+        except queue.Full:
+            con.close()
+
+@st.cache_resource
+def _conn_pool(db:str)->ConnPool:
+    return ConnPool(db)
+
+_pool = (None, None)
+
 def db_conn():
-    return sqlite3.connect(DB, check_same_thread=False)
+    """このスレッドが借りている接続を返す（スレッドの終了時にプールへ返る）。呼び出し側で close しないこと。"""
+    global _pool
+    if _pool[0] != DB:
+        _pool = (DB, _conn_pool(DB))
+    return _pool[1].get()
+
+# 市場データのバージョン（書き込みのコミット後に上げる。読み取りキャッシュのキーに使う）
+MARKET_TOPICS = ("trades", "book", "price", "wallets")
+
+@st.cache_resource
+def _market_versions(db:str)->Tuple[threading.Lock,dict]:
+    return threading.Lock(), {t: 0 for t in MARKET_TOPICS}
+
+def bump_version(*topics:str):
+    lock, versions = _market_versions(DB)
+    with lock:
+        for t in topics:
+            versions[t] += 1
+
+def market_version(topic:str)->int:
+    return _market_versions(DB)[1][topic]
+
+def _migrate_fixed_point(cur):
+    """REAL 版の旧スキーマ（user_version=0）を整数版に移行する"""
+    for idx in ORDER_INDEXES + OLD_TRADE_INDEXES + TRADE_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS {idx}")
+    for t in ("wallets", "orders", "trades"):
+        cur.execute(f"ALTER TABLE {t} RENAME TO {t}_real")
+    create_tables(cur)
+    m, q = PRICE_SCALE, QTY_SCALE
+    cur.execute(f"""INSERT INTO wallets(user_id,mock,y)
+                    SELECT user_id, CAST(ROUND(mock*{m}) AS INTEGER), CAST(ROUND(y*{q}) AS INTEGER)
+                    FROM wallets_real""")
+    cur.execute(f"""INSERT INTO orders(id,user_id,side,price,qty_rem,ts)
+                    SELECT id, user_id, side, CAST(ROUND(price*{m}) AS INTEGER),
+                           CAST(ROUND(qty_rem*{q}) AS INTEGER), ts
+                    FROM orders_real""")
+    cur.execute(f"""INSERT INTO trades(id,ts,venue,buyer_id,seller_id,price,qty,fee_bps,fee_buyer_mock,fee_seller_mock)
+                    SELECT id, ts, venue, buyer_id, seller_id, CAST(ROUND(price*{m}) AS INTEGER),
+                           CAST(ROUND(qty*{q}) AS INTEGER), fee_bps,
+                           CAST(ROUND(fee_buyer_mock*{m}) AS INTEGER), CAST(ROUND(fee_seller_mock*{m}) AS INTEGER)
+                    FROM trades_real""")
+    cur.execute(f"""UPDATE state SET v=CAST(CAST(ROUND(CAST(v AS REAL)*{m}) AS INTEGER) AS TEXT)
+                    WHERE k='last_price'""")
+    for t in ("wallets", "orders", "trades"):
+        cur.execute(f"DROP TABLE {t}_real")
+
+def _backfill_candles(cur):
+    """既存の trades からローソク足を作り直す（candles 導入時の移行）"""
+    cur.execute("DELETE FROM candles")
+    upsert_candles(cur, cur.execute("SELECT ts,venue,price,qty FROM trades ORDER BY ts, id").fetchall())
 
 def init_db():
     con = db_conn(); cur = con.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        pw_hash TEXT,
-        salt TEXT
-    );""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS wallets(
-        user_id INTEGER PRIMARY KEY,
-        mock REAL NOT NULL DEFAULT 0,
-        y REAL NOT NULL DEFAULT 0,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    );""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS orders(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        side TEXT,           -- 'buy' or 'sell'
-        price REAL,
-        qty_rem REAL,
-        ts INTEGER,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    );""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS trades(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ts INTEGER,
-        venue TEXT,          -- 'dealer' or 'exchange'
-        buyer_id INTEGER,
-        seller_id INTEGER,
-        price REAL,
-        qty REAL,
-        fee_bps INTEGER,
-        fee_buyer_mock REAL,
-        fee_seller_mock REAL,
-        FOREIGN KEY(buyer_id) REFERENCES users(id),
-        FOREIGN KEY(seller_id) REFERENCES users(id)
-    );""")
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS state(
-        k TEXT PRIMARY KEY,
-        v TEXT
-    );""")
+    cur.execute("PRAGMA user_version")
+    version = cur.fetchone()[0]
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='wallets'")
+    if version == 0 and cur.fetchone():
+        _migrate_fixed_point(cur)
+    create_tables(cur)
+    if version < 2:
+        _backfill_candles(cur)
+    if version < 4:
+        ledger.post_opening(cur, int(time.time()))   # 元帳導入前の残高を開始残高にする
+    create_indexes(cur)
+    create_order_log(cur)
     # 初期価格（100 Mock / Y）
-    cur.execute("INSERT OR IGNORE INTO state(k,v) VALUES ('last_price','100')")
-    con.commit(); con.close()
+    cur.execute("INSERT OR IGNORE INTO state(k,v) VALUES ('last_price',?)", (str(to_mock(100)),))
+    cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    con.commit()
+
+@st.cache_resource
+def _init_once(db:str)->bool:
+    init_db()
+    return True
+
+def ensure_db():
+    """init_db をプロセスで1回だけ実行する（再実行のたびに DDL を流さない）"""
+    _init_once(DB)
+
+# よく呼ばれるクエリ（check_query_plans で実行計画を検査する）
+SQL_BOOK_BUY = """SELECT o.id, u.username, o.side, o.price, o.qty_rem, o.ts
+                  FROM orders o JOIN users u ON o.user_id=u.id
+                  WHERE o.side='buy' AND o.qty_rem>0
+                  ORDER BY o.price DESC, o.ts, o.id"""
+SQL_BOOK_SELL = """SELECT o.id, u.username, o.side, o.price, o.qty_rem, o.ts
+                   FROM orders o JOIN users u ON o.user_id=u.id
+                   WHERE o.side='sell' AND o.qty_rem>0
+                   ORDER BY o.price, o.ts, o.id"""
+SQL_TRADES_VENUE = """SELECT ts,venue,buyer_id,seller_id,price,qty,fee_bps FROM trades
+                      WHERE venue=? ORDER BY ts DESC LIMIT ?"""
+SQL_TRADES_ALL = """SELECT ts,venue,buyer_id,seller_id,price,qty,fee_bps FROM trades
+                    ORDER BY ts DESC LIMIT ?"""
+# 履歴表示用（ユーザー名を JOIN で一度に引く）
+_SQL_TRADES_NAMED = """SELECT t.id, t.ts, t.venue, t.buyer_id, t.seller_id,
+                              bu.username AS buyer, su.username AS seller,
+                              t.price, t.qty, t.fee_bps
+                       FROM trades t
+                       LEFT JOIN users bu ON bu.id=t.buyer_id
+                       LEFT JOIN users su ON su.id=t.seller_id"""
+# 取引履歴のページ（(ts, id) より古いものを新しい順に）。ユーザー指定は買い手・売り手の
+# インデックスをそれぞれ後ろから読んでマージし、LIMIT 件だけ取り出してから名前を JOIN する
+def _trades_page_sql(venue:bool, user:bool)->str:
+    key = "(ts, id) < (:ts, :id)"
+    v = " AND venue=:venue" if venue else ""
+    if not user:
+        return (_SQL_TRADES_NAMED + " WHERE (t.ts, t.id) < (:ts, :id)" + (" AND t.venue=:venue" if venue else "")
+                + " ORDER BY t.ts DESC, t.id DESC LIMIT :limit")
+    return (f"""WITH p(ts, id) AS (
+                    SELECT ts, id FROM trades WHERE buyer_id=:uid{v} AND {key}
+                    UNION
+                    SELECT ts, id FROM trades WHERE seller_id=:uid{v} AND {key}
+                    ORDER BY ts DESC, id DESC LIMIT :limit)
+                """ + _SQL_TRADES_NAMED + " JOIN p ON p.id=t.id ORDER BY p.ts DESC, p.id DESC")
+SQL_TRADES_PAGE = {(v, u): _trades_page_sql(v, u) for v in (False, True) for u in (False, True)}
+PAGE_TOP = (2**63 - 1, 2**63 - 1)   # 先頭ページのカーソル
+
+SQL_CANDLES = """SELECT bucket, open, high, low, close, volume, n FROM candles
+                 WHERE venue=? AND interval=? ORDER BY bucket DESC LIMIT ?"""
+HOT_QUERIES = {
+    "orderbook_buy":  (SQL_BOOK_BUY, ()),
+    "orderbook_sell": (SQL_BOOK_SELL, ()),
+    "trades_venue":   (SQL_TRADES_VENUE, ("exchange", 200)),
+    "trades_all":     (SQL_TRADES_ALL, (500,)),
+    "candles":        (SQL_CANDLES, ("all", 60, 120)),
+    "trades_page_all":   (SQL_TRADES_PAGE[False, False], dict(ts=1, id=1, limit=51)),
+    "trades_page_venue": (SQL_TRADES_PAGE[True, False], dict(venue="exchange", ts=1, id=1, limit=51)),
+    "trades_page_user":  (SQL_TRADES_PAGE[True, True], dict(venue="exchange", uid=1, ts=1, id=1, limit=51)),
+}
+
+def check_query_plans()->list:
+    """HOT_QUERIES の実行計画を調べ、インデックスを使わない全表走査や
+    一時 B-tree でのソートに落ちているものを (名前, 計画) のリストで返す（空なら OK）。
+    LIMIT 付きで実体化した CTE（MATERIALIZE）の走査とその並べ替えは、行数が LIMIT 以下なので許す"""
+    con=db_conn(); cur=con.cursor()
+    bad = []
+    for name, (sql, args) in HOT_QUERIES.items():
+        cur.execute("EXPLAIN QUERY PLAN " + sql, args)
+        plan = [row[-1] for row in cur.fetchall()]
+        ctes = {d.split()[1] for d in plan if d.startswith("MATERIALIZE ")}
+        for detail in plan:
+            if ctes and (detail in {f"SCAN {c}" for c in ctes} or detail == "USE TEMP B-TREE FOR ORDER BY"):
+                continue
+            if (detail.startswith("SCAN") and " USING " not in detail) or "TEMP B-TREE" in detail:
+                bad.append((name, detail))
+    return bad
 
 def get_user_by_name(username:str)->Optional[Tuple[int,str]]:
     con = db_conn(); cur = con.cursor()
     cur.execute("SELECT id, pw_hash, salt FROM users WHERE username=?", (username,))
-    r = cur.fetchone(); con.close()
+    r = cur.fetchone()
     return r
 
 def create_user(username:str, password:str)->int:
@@ -81,8 +252,12 @@ def create_user(username:str, password:str)->int:
     cur.execute("INSERT INTO users(username,pw_hash,salt) VALUES (?,?,?)", (username, pw_hash, salt))
     uid = cur.lastrowid
     # 初期配布：1000 Mock / 0 Y
-    cur.execute("INSERT INTO wallets(user_id,mock,y) VALUES (?,?,?)", (uid, 1000.0, 0.0))
-    con.commit(); con.close()
+    cur.execute("INSERT INTO wallets(user_id,mock,y) VALUES (?,?,?)", (uid, to_mock(1000), 0))
+    p = Postings(int(time.time()))
+    p.post('signup', None, [(uid, MOCK, to_mock(1000)), (ISSUER, MOCK, -to_mock(1000))])
+    p.write(cur)
+    con.commit()
+    bump_version("wallets")
     return uid
 
 def check_password(username:str, password:str)->Optional[int]:
@@ -93,184 +268,579 @@ def check_password(username:str, password:str)->Optional[int]:
         return uid
     return None
 
-def get_wallet(uid:int):
+@metrics.timed()
+def get_wallet(uid:int)->Tuple[int,int]:
+    """(Mock 単位, Y lot)"""
     con = db_conn(); cur = con.cursor()
     cur.execute("SELECT mock,y FROM wallets WHERE user_id=?", (uid,))
-    r=cur.fetchone(); con.close()
-    return (r[0], r[1]) if r else (0.0,0.0)
+    r=cur.fetchone()
+    return (r[0], r[1]) if r else (0,0)
 
-def set_wallet(uid:int, mock:float, y:float):
+def set_wallet(uid:int, mock:int, y:int):
+    """残高を直接書き換える（管理・ベンチ用）。差分は ISSUER との振替として元帳に記録する"""
     con=db_conn(); cur=con.cursor()
-    cur.execute("UPDATE wallets SET mock=?, y=? WHERE user_id=?", (mock,y,uid))
-    con.commit(); con.close()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("SELECT mock,y FROM wallets WHERE user_id=?", (uid,))
+        r = cur.fetchone()
+        if r:
+            cur.execute("UPDATE wallets SET mock=?, y=? WHERE user_id=?", (mock,y,uid))
+            p = Postings(int(time.time()))
+            p.post('adjust', None, [(uid, MOCK, mock - r[0]), (ISSUER, MOCK, r[0] - mock),
+                                    (uid, Y, y - r[1]), (ISSUER, Y, r[1] - y)])
+            p.write(cur)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    bump_version("wallets")
 
 def get_username(uid:int)->str:
     con=db_conn(); cur=con.cursor()
     cur.execute("SELECT username FROM users WHERE id=?", (uid,))
-    r=cur.fetchone(); con.close()
+    r=cur.fetchone()
     return r[0] if r else "unknown"
 
-def get_price()->float:
+@metrics.timed()
+def get_price()->int:
+    """直近価格（1e-6 Mock / Y）"""
     con=db_conn(); cur=con.cursor()
     cur.execute("SELECT v FROM state WHERE k='last_price'")
     v = cur.fetchone()
-    con.close()
-    return float(v[0]) if v else 100.0
+    return int(v[0]) if v else to_mock(100)
 
-def set_price(p:float):
-    p = max(1.0, float(p))
+def set_price(p:int):
+    p = max(PRICE_SCALE, int(p))   # 下限 1 Mock
     con=db_conn(); cur=con.cursor()
     cur.execute("INSERT OR REPLACE INTO state(k,v) VALUES ('last_price',?)", (str(p),))
-    con.commit(); con.close()
+    con.commit()
+    bump_version("price")
 
 def add_trade(ts:int, venue:str, buyer_id:Optional[int], seller_id:Optional[int],
-              price:float, qty:float, fee_bps:int, fee_buyer:float, fee_seller:float):
+              price:int, qty:int, fee_bps:int, fee_buyer:int, fee_seller:int):
     con=db_conn(); cur=con.cursor()
     cur.execute("""INSERT INTO trades(ts,venue,buyer_id,seller_id,price,qty,fee_bps,fee_buyer_mock,fee_seller_mock)
                    VALUES(?,?,?,?,?,?,?,?,?)""",
                 (ts,venue,buyer_id,seller_id,price,qty,fee_bps,fee_buyer,fee_seller))
-    con.commit(); con.close()
+    upsert_candles(cur, ((ts, venue, price, qty),))
+    con.commit()
+    bump_version("trades")
 
+@metrics.timed()
 def list_trades(venue:Optional[str]=None, limit:int=200):
     con=db_conn(); cur=con.cursor()
     if venue:
-        cur.execute("""SELECT ts,venue,buyer_id,seller_id,price,qty,fee_bps FROM trades
-                       WHERE venue=? ORDER BY ts DESC LIMIT ?""", (venue, limit))
+        cur.execute(SQL_TRADES_VENUE, (venue, limit))
     else:
-        cur.execute("""SELECT ts,venue,buyer_id,seller_id,price,qty,fee_bps FROM trades
-                       ORDER BY ts DESC LIMIT ?""", (limit,))
-    rows = cur.fetchall(); con.close()
+        cur.execute(SQL_TRADES_ALL, (limit,))
+    rows = cur.fetchall()
     return rows
 
-def place_order(uid:int, side:str, price:float, qty:float):
-    ts=int(time.time())
-    con=db_conn(); cur=con.cursor()
-    cur.execute("INSERT INTO orders(user_id,side,price,qty_rem,ts) VALUES(?,?,?,?,?)",
-                (uid,side,price,qty,ts))
-    con.commit(); con.close()
+@metrics.timed()
+def trades_page(venue:Optional[str]=None, user_id:Optional[int]=None,
+                before:Tuple[int,int]=PAGE_TOP, limit:int=50)->pd.DataFrame:
+    """取引履歴を新しい順に1ページ読む（buyer/seller のユーザー名付き）。
+    before は (ts, id) のカーソルで、次のページには最後の行の (ts, id) を渡す。
+    OFFSET を使わないので、どれだけ古いページでもインデックスを読む量は limit 件分"""
+    args = dict(venue=venue, uid=user_id, ts=before[0], id=before[1], limit=limit)
+    return pd.read_sql_query(SQL_TRADES_PAGE[venue is not None, user_id is not None], db_conn(), params=args)
+
+def page_cursor(df:pd.DataFrame)->Tuple[int,int]:
+    """trades_page の結果の最後の行から次のページのカーソルを作る"""
+    return int(df["ts"].iloc[-1]), int(df["id"].iloc[-1])
 
+@metrics.timed()
+def candles_frame(venue:str='all', interval:int=60, limit:int=120)->pd.DataFrame:
+    """直近 limit 本のローソク足（古い順）。trades は読まない"""
+    df = pd.read_sql_query(SQL_CANDLES, db_conn(), params=(venue, interval, limit))
+    return df.iloc[::-1].reset_index(drop=True)
+
+@metrics.timed()
 def list_orderbook():
+    """板を (買い: 高い順, 売り: 安い順) で返す。並べ替えは部分インデックス順で SQL 側"""
     con=db_conn(); cur=con.cursor()
-    cur.execute("""SELECT o.id, u.username, o.side, o.price, o.qty_rem, o.ts
-                   FROM orders o JOIN users u ON o.user_id=u.id
-                   WHERE o.qty_rem>0""")
-    rows = cur.fetchall(); con.close()
-    buy = [r for r in rows if r[2]=='buy']
-    sell= [r for r in rows if r[2]=='sell']
-    # 買いは高い順、売りは安い順
-    buy.sort(key=lambda x: (-x[3], x[5]))
-    sell.sort(key=lambda x: (x[3], x[5]))
+    cur.execute(SQL_BOOK_BUY); buy = cur.fetchall()
+    cur.execute(SQL_BOOK_SELL); sell = cur.fetchall()
     return buy, sell
 
 def get_order(order_id:int):
     con=db_conn(); cur=con.cursor()
     cur.execute("SELECT id,user_id,side,price,qty_rem,ts FROM orders WHERE id=?", (order_id,))
-    r=cur.fetchone(); con.close()
+    r=cur.fetchone()
     return r
 
-def update_order_qty(order_id:int, new_qty:float):
+def update_order_qty(order_id:int, new_qty:int):
     con=db_conn(); cur=con.cursor()
     cur.execute("UPDATE orders SET qty_rem=? WHERE id=?", (new_qty, order_id))
-    con.commit(); con.close()
+    con.commit()
+    bump_version("book")
+    get_book().update_qty(order_id, new_qty)
 
 def delete_order(order_id:int):
     con=db_conn(); cur=con.cursor()
     cur.execute("DELETE FROM orders WHERE id=?", (order_id,))
-    con.commit(); con.close()
+    con.commit()
+    bump_version("book")
+    get_book().remove(order_id)
+
+def reload_book(book:OrderBook):
+    """DB の orders テーブルを正として板を作り直す"""
+    con=db_conn(); cur=con.cursor()
+    cur.execute("""SELECT id,user_id,side,price,qty_rem,ts FROM orders
+                   WHERE qty_rem>0 ORDER BY ts, id""")
+    book.load(cur.fetchall())
+
+@contextmanager
+def book_transaction(book:OrderBook):
+    """板と DB を1つの BEGIN IMMEDIATE トランザクションで更新する。
+    失敗したらロールバックし、板を DB に合わせて作り直す。"""
+    con=db_conn(); cur=con.cursor()
+    with book.lock:
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            yield cur
+            con.commit()
+        except Exception:
+            con.rollback()
+            reload_book(book)
+            raise
+        finally:
+            bump_version("book")
+
+@st.cache_resource
+def _load_book(db:str)->OrderBook:
+    """板をプロセスで1回だけ読み込む（以後は注文・取消と同期）。
+    スナップショットがあればそこから（以降の変更は読み直して足す）、無ければ orders テーブルから読んでスナップショットを書く"""
+    book = OrderBook()
+    with metrics.timer("load_book"):
+        rows = snapshot_orders()
+        if rows is not None:
+            book.load(rows)
+        else:
+            reload_book(book)
+            write_snapshot()
+    metrics.gauge("book_orders", book.__len__)
+    # 連続マッチング導入前の DB には交差したまま残っている注文があり得る
+    if book.crossed():
+        with book_transaction(book) as cur:
+            _sweep(cur, book)
+        bump_version("trades", "price", "wallets")
+    return book
+
+def get_book()->OrderBook:
+    return _load_book(DB)
+
+@st.cache_resource
+def _matcher(db:str)->Worker:
+    """注文・販売所取引を1本のスレッドで順に実行する書き込みワーカー（プロセスで1つ）"""
+    w = Worker(f"matcher:{db}")
+    metrics.gauge("matcher_pending", w.pending)
+    return w
+
+def get_matcher()->Worker:
+    return _matcher(DB)
+
+@st.cache_resource
+def _dealer(db:str)->DealerEngine:
+    """販売所の売買をまとめて約定させるエンジン（マッチングワーカーの上で動く）"""
+    return DealerEngine(_matcher(db), dealer_batch, lambda: market_version("price"))
+
+def get_dealer()->DealerEngine:
+    return _dealer(DB)
+
+# ---------------------- SNAPSHOT ----------------------
+# 未約定注文を snapshot.py のバイナリ形式で保存し、起動時の板の読み込みに使う。
+# 目印は orders の最大 id と order_log（orders の更新・削除の記録）の位置。読み込むときは
+# それより新しい注文と、更新・削除された注文だけを DB から読み直して足す。
+SNAPSHOT_INTERVAL = 60    # 秒（注文があればこの間隔で書き直す）
+SNAP_SIDES = ('buy', 'sell')
+SNAP_MARKS = ("orders_seq", "order_log_seq")
+SQL_OPEN_ORDERS = "SELECT id,user_id,side,price,qty_rem,ts FROM orders WHERE qty_rem>0"
+
+def snapshot_path()->str:
+    return DB + ".snap"
+
+def snapshot_marks(cur)->dict:
+    """orders の目印。注文の追加・更新・削除でだけ進む（約定の記録や残高の変更では変わらない）"""
+    cur.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('orders','order_log')")
+    seq = dict(cur.fetchall())
+    return {"orders_seq": seq.get("orders", 0), "order_log_seq": seq.get("order_log", 0)}
+
+@metrics.timed()
+def write_snapshot()->str:
+    """未約定注文を1つの読み取りトランザクションで読んでスナップショットに書き、
+    それより古い order_log を消す"""
+    con=db_conn(); cur=con.cursor()
+    cur.execute("BEGIN")
+    try:
+        meta = snapshot_marks(cur)
+        meta["created"] = int(time.time())
+        orders = cur.execute(SQL_OPEN_ORDERS + " ORDER BY ts, id").fetchall()
+    finally:
+        con.commit()
+    col = lambda rows, i: [r[i] for r in rows]
+    path = snapshot_path()
+    snapshot.dump(path, meta, {
+        "orders": {"id": ("q", col(orders, 0)), "user_id": ("q", col(orders, 1)),
+                   "side": ("b", [SNAP_SIDES.index(s) for s in col(orders, 2)]),
+                   "price": ("q", col(orders, 3)), "qty": ("q", col(orders, 4)), "ts": ("q", col(orders, 5))},
+    })
+    cur.execute("DELETE FROM order_log WHERE seq<=?", (meta["order_log_seq"],))
+    cur.execute("INSERT OR REPLACE INTO state(k,v) VALUES ('order_log_pruned',?)", (str(meta["order_log_seq"]),))
+    con.commit()
+    _snapshot_clock(DB)[0] = time.monotonic()
+    return path
+
+def snapshot_orders()->Optional[List[tuple]]:
+    """スナップショットの未約定注文に、それ以降の追加・更新・削除を足したもの（時刻順）。
+    無い・壊れている・別の DB のもの・差分の記録が既に消えている場合は None"""
+    snap = snapshot.load(snapshot_path())
+    if snap is None:
+        return None
+    con=db_conn(); cur=con.cursor()
+    cur.execute("BEGIN")
+    try:
+        marks = snapshot_marks(cur)
+        cur.execute("SELECT v FROM state WHERE k='order_log_pruned'")
+        r = cur.fetchone()
+        pruned = int(r[0]) if r else 0
+        seen = {k: snap.meta.get(k) for k in SNAP_MARKS}
+        if any(v is None or v > marks[k] for k, v in seen.items()) or seen["order_log_seq"] < pruned:
+            return None
+        orders = {r[0]: r for r in
+                  ((i, u, SNAP_SIDES[s], p, q, t)
+                   for i, u, s, p, q, t in snap.rows("orders", "id", "user_id", "side", "price", "qty", "ts"))}
+        changed = [oid for (oid,) in cur.execute(
+            "SELECT DISTINCT order_id FROM order_log WHERE seq>? AND order_id<=?",
+            (seen["order_log_seq"], seen["orders_seq"])).fetchall()]
+        added = cur.execute(SQL_OPEN_ORDERS + " AND id>? ORDER BY id", (seen["orders_seq"],)).fetchall()
+        for oid in changed:
+            orders.pop(oid, None)
+        for k in range(0, len(changed), 500):
+            part = changed[k:k + 500]
+            cur.execute(SQL_OPEN_ORDERS + f" AND id IN ({','.join('?' * len(part))})", part)
+            for r in cur.fetchall():
+                orders[r[0]] = r
+    finally:
+        con.commit()
+        snap.close()
+    rows = list(orders.values()) + added
+    if changed or added:
+        rows.sort(key=lambda r: (r[5], r[0]))
+    return rows
+
+@st.cache_resource
+def _snapshot_clock(db:str)->list:
+    return [time.monotonic()]   # 最後にスナップショットを書いた時刻
+
+def maybe_snapshot():
+    """前回から SNAPSHOT_INTERVAL 秒たっていれば、書き込みワーカーにスナップショットを書かせる"""
+    clock = _snapshot_clock(DB)
+    if time.monotonic() - clock[0] >= SNAPSHOT_INTERVAL:
+        clock[0] = time.monotonic()
+        get_matcher().submit(write_snapshot)
+
+# ---------------------- READ CACHE ----------------------
+# 画面の読み取りは市場バージョンをキーにキャッシュし、書き込みがあったものだけ読み直す
+@st.cache_data(max_entries=256, show_spinner=False)
+def _wallet_v(db:str, uid:int, version:int):
+    return get_wallet(uid)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _price_v(db:str, version:int):
+    return get_price()
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _trades_page_v(db:str, venue:Optional[str], user_id:Optional[int], before:Tuple[int,int], limit:int, version:int):
+    return trades_page(venue, user_id, before, limit)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _candles_frame_v(db:str, venue:str, interval:int, limit:int, version:int):
+    return candles_frame(venue, interval, limit)
+
+def cached_wallet(uid:int)->Tuple[int,int]:
+    return _wallet_v(DB, uid, market_version("wallets"))
+
+def cached_price()->int:
+    return _price_v(DB, market_version("price"))
+
+def cached_trades_page(venue:Optional[str]=None, user_id:Optional[int]=None,
+                       before:Tuple[int,int]=PAGE_TOP, limit:int=50)->pd.DataFrame:
+    return _trades_page_v(DB, venue, user_id, before, limit, market_version("trades"))
+
+def cached_candles_frame(venue:str='all', interval:int=60, limit:int=120)->pd.DataFrame:
+    return _candles_frame_v(DB, venue, interval, limit, market_version("trades"))
 
 # ---------------------- BUSINESS LOGIC ----------------------
-DEALER_FEE_BPS = 200   # 2.00%
-EX_FEE_BPS     = 50    # 0.50%
-DEALER_ALPHA   = 0.05  # 需給で価格調整: 新価格 = 直近 + α*(買数量-売数量)
+# 手数料・価格調整と約定の規則は exchange.py（Exchange と共通）。ここは SQL での読み書きだけ
+LOCAL_TZ = tzlocal()   # OS のタイムゾーン（夏時間の規則込み）
 
 def format_ts(ts:int)->str:
     return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
 
-def dealer_buy(uid:int, qty:float)->Tuple[bool,str]:
-    """販売所で Y を買う（Mock -> Y）"""
-    price = get_price()
-    mock_cost = price * qty
-    fee = mock_cost * DEALER_FEE_BPS / 10000.0
-    need = mock_cost + fee
-    m,y = get_wallet(uid)
-    if m < need: return False, "Mock残高不足"
-    # 決済
-    set_wallet(uid, m - need, y + qty)
-    add_trade(int(time.time()), 'dealer', uid, None, price, qty, DEALER_FEE_BPS, fee, 0.0)
-    # 価格上方調整
-    newp = price + DEALER_ALPHA * qty
-    set_price(newp)
-    return True, f"{qty} Y を購入 (価格 {price} Mock, 手数料 {fee:.2f} Mock)"
-
-def dealer_sell(uid:int, qty:float)->Tuple[bool,str]:
-    """販売所で Y を売る（Y -> Mock）"""
-    price = get_price()
-    m,y = get_wallet(uid)
-    if y < qty: return False, "Y 残高不足"
-    proceeds = price * qty
-    fee = proceeds * DEALER_FEE_BPS / 10000.0
-    set_wallet(uid, m + (proceeds - fee), y - qty)
-    add_trade(int(time.time()), 'dealer', None, uid, price, qty, DEALER_FEE_BPS, 0.0, fee)
-    # 価格下方調整
-    newp = price - DEALER_ALPHA * qty
-    set_price(newp)
-    return True, f"{qty} Y を売却 (価格 {price} Mock, 手数料 {fee:.2f} Mock)"
-
-def match_orders():
-    """板の自動マッチング。成約ごとに残高と履歴を更新。"""
-    changed = False
-    while True:
-        buy, sell = list_orderbook()
-        if not buy or not sell: break
-        best_buy = buy[0]   # (id, username, side, price, qty_rem, ts)
-        best_sell= sell[0]
-        if best_buy[3] < best_sell[3]: break  # 価格が交差しない
-        # 約定価格：中間（シンプル）
-        trade_price = round((best_buy[3] + best_sell[3]) / 2.0, 6)
-        trade_qty   = min(best_buy[4], best_sell[4])
-
-        # 両サイドのユーザーID取得
-        ob = get_order(best_buy[0]);  # id,user_id,side,price,qty_rem,ts
-        os = get_order(best_sell[0])
-        buy_uid = ob[1]; sell_uid = os[1]
-
-        # 残高チェックと決済（Mock/Yの移転 + 手数料0.5%）
-        fee_rate = EX_FEE_BPS/10000.0
-        mock_cost = trade_price * trade_qty
-        fee_buy   = mock_cost * fee_rate
-        fee_sell  = mock_cost * fee_rate
-
-        mb,yb = get_wallet(buy_uid)
-        ms,ys = get_wallet(sell_uid)
-
-        # バイヤーは Mock が必要、セラーは Y が必要
-        if mb < mock_cost + fee_buy or ys < trade_qty:
-            # どちらか不足なら、該当注文は削除/縮小
-            if mb < mock_cost + fee_buy:
-                # 買い手の注文を削る
-                update_order_qty(best_buy[0], 0); delete_order(best_buy[0])
-            if ys < trade_qty:
-                update_order_qty(best_sell[0], 0); delete_order(best_sell[0])
-            continue
-
-        # 決済
-        set_wallet(buy_uid, mb - (mock_cost + fee_buy), yb + trade_qty)
-        set_wallet(sell_uid, ms + (mock_cost - fee_sell), ys - trade_qty)
-
-        # 注文数量更新
-        update_order_qty(best_buy[0], ob[4] - trade_qty)
-        update_order_qty(best_sell[0], os[4] - trade_qty)
-        if ob[4] - trade_qty <= 0: delete_order(best_buy[0])
-        if os[4] - trade_qty <= 0: delete_order(best_sell[0])
-
-        # 約定記録 & 価格更新（取引所の最後の約定を参照値に）
-        ts = int(time.time())
-        add_trade(ts, 'exchange', buy_uid, sell_uid, trade_price, trade_qty, EX_FEE_BPS, fee_buy, fee_sell)
-        set_price(trade_price)
-        changed = True
-    return changed
+def to_local_time(ts:pd.Series)->pd.Series:
+    """format_ts のベクトル版（UNIX 秒の列をローカル時刻の datetime 列に一括変換）。
+    オフセットは行ごとにその時刻のもの（夏時間をまたいでも format_ts と同じ）"""
+    return pd.to_datetime(ts, unit="s", utc=True).dt.tz_convert(LOCAL_TZ).dt.tz_localize(None)
+
+@metrics.timed()
+def ledger_audit()->List[tuple]:
+    """元帳（直近のチェックポイント + 以降の仕訳）と wallets の食い違い。空なら整合"""
+    return ledger.audit(db_conn().cursor())
+
+def ledger_rebuild()->int:
+    """wallets を元帳から作り直す"""
+    with book_transaction(get_book()) as cur:
+        n = ledger.rebuild(cur)
+    bump_version("wallets")
+    return n
+
+@metrics.timed()
+def dealer_batch(reqs:List[Tuple[int,str,int]], price:Optional[int]=None)->Tuple[List[Tuple[bool,str]],int]:
+    """販売所の売買 [(uid, 'buy'|'sell', qty), ...] を到着順に1トランザクションで約定させる。
+    1件ごとに直近価格で決済して α だけ価格を動かし、次の依頼はその価格で約定する。
+    price を渡すとそれを直近価格として使う（None なら DB から読む）。
+    戻り値は (依頼ごとの (ok, msg), 新しい価格)"""
+    con=db_conn(); cur=con.cursor()
+    ts=int(time.time())
+    wallets = {}     # user_id -> [mock, y]
+    results = []
+    trades = []
+
+    def wallet(uid):
+        if uid not in wallets:
+            cur.execute("SELECT mock,y FROM wallets WHERE user_id=?", (uid,))
+            r = cur.fetchone()
+            wallets[uid] = [r[0], r[1]] if r else [0, 0]
+        return wallets[uid]
+
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        if price is None:
+            cur.execute("SELECT v FROM state WHERE k='last_price'")
+            v = cur.fetchone()
+            price = int(v[0]) if v else to_mock(100)
+        for uid, side, qty in reqs:
+            trade, msg, price = dealer_fill(wallet(uid), uid, side, qty, price, ts)
+            results.append((trade is not None, msg))
+            if trade is not None:
+                trades.append(trade)
+        if trades:
+            cur.executemany("UPDATE wallets SET mock=?, y=? WHERE user_id=?",
+                            [(m, y, u) for u, (m, y) in wallets.items()])
+            cur.executemany("""INSERT INTO trades(ts,venue,buyer_id,seller_id,price,qty,fee_bps,fee_buyer_mock,fee_seller_mock)
+                               VALUES(?,?,?,?,?,?,?,?,?)""", trades)
+            ledger.post_trades(cur, trades)
+            upsert_candles(cur, [(t[0], t[1], t[4], t[5]) for t in trades])
+            cur.execute("INSERT OR REPLACE INTO state(k,v) VALUES ('last_price',?)", (str(price),))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    if trades: bump_version("wallets", "trades", "price")
+    return results, price
+
+@metrics.timed()
+def dealer_buy(uid:int, qty:int)->Tuple[bool,str]:
+    """販売所で Y を買う（Mock -> Y）。qty は lot。画面からは get_dealer().call(uid, 'buy', qty)"""
+    return dealer_batch([(uid, 'buy', qty)])[0][0]
+
+@metrics.timed()
+def dealer_sell(uid:int, qty:int)->Tuple[bool,str]:
+    """販売所で Y を売る（Y -> Mock）。qty は lot。画面からは get_dealer().call(uid, 'sell', qty)"""
+    return dealer_batch([(uid, 'sell', qty)])[0][0]
+
+@metrics.timed()
+def _sweep(cur, book:OrderBook, taker:Optional[list]=None)->int:
+    """板を約定させて決済し、約定件数を返す（book_transaction の中で呼ぶ）。
+    taker を渡すとその注文だけを反対側の板と指値まで約定させ、残りは板に残す。
+    taker なしなら板全体が交差しなくなるまで約定させる。"""
+    wallets = {}     # user_id -> [mock, y]（スイープ中の残高）
+
+    def wallet(uid):
+        if uid not in wallets:
+            cur.execute("SELECT mock,y FROM wallets WHERE user_id=?", (uid,))
+            r = cur.fetchone()
+            wallets[uid] = [r[0], r[1]] if r else [0, 0]
+        return wallets[uid]
+
+    fills, order_qty, touched, _ = sweep(book, wallet, taker)
+    cur.executemany("UPDATE wallets SET mock=?, y=? WHERE user_id=?",
+                    [(wallets[u][0], wallets[u][1], u) for u in touched])
+    cur.executemany("UPDATE orders SET qty_rem=? WHERE id=?",
+                    [(q, oid) for oid, q in order_qty.items() if q > 0])
+    cur.executemany("DELETE FROM orders WHERE id=?",
+                    [(oid,) for oid, q in order_qty.items() if q <= 0])
+    cur.executemany("""INSERT INTO trades(ts,venue,buyer_id,seller_id,price,qty,fee_bps,fee_buyer_mock,fee_seller_mock)
+                       VALUES(?,?,?,?,?,?,?,?,?)""", fills)
+    if fills:
+        ledger.post_trades(cur, fills)
+    upsert_candles(cur, [(f[0], f[1], f[4], f[5]) for f in fills])
+    # 約定記録 & 価格更新（取引所の最後の約定を参照値に）
+    if fills:
+        cur.execute("INSERT OR REPLACE INTO state(k,v) VALUES ('last_price',?)",
+                    (str(max(PRICE_SCALE, fills[-1][4])),))
+    return len(fills)
+
+@metrics.timed()
+def match_orders()->int:
+    """板全体の一括マッチング（1トランザクション）。約定件数を返す。
+    注文は place_order で到着時に約定するので、通常は交差が残っていない。"""
+    book = get_book()
+    with book_transaction(book) as cur:
+        n = _sweep(cur, book)
+    if n: bump_version("trades", "price", "wallets")
+    return n
+
+@metrics.timed()
+def place_orders(reqs:List[Tuple[int,str,int,int]])->list:
+    """注文 [(uid, side, price, qty), ...] を到着順に受け付け、1件ずつ反対側の板と指値まで
+    即時に約定させる（残りは板に載せる）。まとめて1トランザクションで、1件ごとに SAVEPOINT を切る。
+    戻り値は注文ごとの (order_id, 約定件数)。失敗した注文はその1件だけ巻き戻し、例外オブジェクトを返す"""
+    ts=int(time.time())
+    book = get_book()   # 挿入前に読み込んでおく（二重登録防止）
+    results = []
+    with book_transaction(book) as cur:
+        for uid, side, price, qty in reqs:
+            cur.execute("SAVEPOINT place_order")
+            try:
+                cur.execute("INSERT INTO orders(user_id,side,price,qty_rem,ts) VALUES(?,?,?,?,?)",
+                            (uid,side,price,qty,ts))
+                taker = book.add(cur.lastrowid, uid, side, price, qty, ts)
+                results.append((taker[0], _sweep(cur, book, taker)))
+            except Exception as e:
+                cur.execute("ROLLBACK TO place_order")
+                reload_book(book)   # 巻き戻した後の DB（同じトランザクション内）に板を合わせる
+                results.append(e)
+            cur.execute("RELEASE place_order")
+    if any(not isinstance(r, Exception) and r[1] for r in results): bump_version("trades", "price", "wallets")
+    maybe_snapshot()
+    return results
+
+@metrics.timed()
+def place_order(uid:int, side:str, price:int, qty:int)->int:
+    """注文を受け付け、反対側の板と指値まで即時に約定させる。残りは板に載せる。
+    price / qty は整数単位（to_mock / to_lots）。注文の登録と約定は1トランザクション。約定件数を返す。
+    画面からは get_matcher().call(place_order, ...) でマッチングワーカーに実行させる。"""
+    r = place_orders([(uid, side, price, qty)])[0]
+    if isinstance(r, Exception):
+        raise r
+    return r[1]
+
+def cancel_order(uid:int, order_id:int)->bool:
+    """uid 自身の未約定の注文を取り消す（書き込みワーカーで実行する）。取り消せたら True"""
+    r = get_order(order_id)
+    if not r or r[1] != uid or r[4] <= 0:
+        return False
+    delete_order(order_id)
+    return True
+
+# ---------------------- METRICS ----------------------
+ADMIN_USERS = ("Host",)       # 計測パネルを見られるユーザー
+METRICS_DUMP_INTERVAL = 15    # 秒（Prometheus 形式のファイルを書き直す間隔）
+METRICS_COLUMNS = {"name": "処理", "count": "回数", "per": "回/画面", "total_ms": "累計(ms)",
+                   "mean_ms": "平均(ms)", "p50_ms": "p50(ms)", "p99_ms": "p99(ms)", "max_ms": "最大(ms)"}
+
+def metrics_path()->str:
+    return DB + ".metrics.prom"
+
+@st.cache_resource
+def _metrics_clock(db:str)->list:
+    return [0.0]   # 最後に書き出した時刻
+
+def maybe_dump_metrics():
+    """計測が有効なら METRICS_DUMP_INTERVAL 秒ごとに metrics_path() へ書き出す"""
+    if not metrics.ENABLED:
+        return
+    clock = _metrics_clock(DB)
+    if time.monotonic() - clock[0] >= METRICS_DUMP_INTERVAL:
+        clock[0] = time.monotonic()
+        metrics.write_prometheus(metrics_path())
+
+def metrics_panel():
+    """管理者用のサイドバー: 関数・DB 呼び出しごとの時間と、画面1回あたりの呼び出し回数"""
+    if st.session_state.username not in ADMIN_USERS:
+        return
+    with st.sidebar.expander("計測（管理者）"):
+        if not metrics.ENABLED:
+            st.write("環境変数 SIMDEX_METRICS=1 で起動すると計測します。")
+            return
+        renders = metrics.counters().get("renders", 0)
+        st.write(f"画面 {renders:.0f} 回 / 書き込み待ち {get_matcher().pending()} 件 / 板 {len(get_book())} 件")
+        rows = metrics.summary(per="renders")
+        if rows:
+            st.dataframe(pd.DataFrame(rows)[list(METRICS_COLUMNS)].rename(columns=METRICS_COLUMNS).round(3))
+        c1, c2 = st.columns(2)
+        if c1.button("書き出し", key="metrics_dump"):
+            st.success(f"{metrics.write_prometheus(metrics_path())} に書き出しました")
+        if c2.button("リセット", key="metrics_reset"):
+            metrics.reset()
 
 # ---------------------- UI HELPERS ----------------------
+def _names(name:pd.Series, uid:pd.Series)->pd.Series:
+    """ユーザー名の列（相手なしは '-'、削除済みユーザーは 'unknown'）"""
+    return name.fillna("unknown").where(uid.notna(), "-")
+
+def dealer_history_table(df:pd.DataFrame)->pd.DataFrame:
+    is_buy = df["buyer_id"].notna()   # buyer_id exists -> 買
+    return pd.DataFrame({
+        "時刻": to_local_time(df["ts"]),
+        "種別": is_buy.map({True: "買", False: "売"}),
+        "ユーザー": _names(df["buyer"], df["buyer_id"]).where(is_buy, _names(df["seller"], df["seller_id"])),
+        "相手方": "Exchange",
+        "価格": df["price"] / PRICE_SCALE,
+        "数量": df["qty"] / QTY_SCALE,
+        "手数料(bps)": df["fee_bps"],
+    })
+
+def exchange_history_table(df:pd.DataFrame)->pd.DataFrame:
+    return pd.DataFrame({
+        "時刻": to_local_time(df["ts"]),
+        "買い手": _names(df["buyer"], df["buyer_id"]),
+        "売り手": _names(df["seller"], df["seller_id"]),
+        "価格": df["price"] / PRICE_SCALE,
+        "数量": df["qty"] / QTY_SCALE,
+        "手数料(bps)": df["fee_bps"],
+    })
+
+DEPTH_LEVELS = 10   # 板に表示する価格の段数
+
+@metrics.timed()
+def depth_table(side:str, n:int=DEPTH_LEVELS)->pd.DataFrame:
+    """メモリ上の板から最良気配 n 段の板情報（価格ごとの数量合計・注文数・累計）を作る"""
+    rows = get_book().depth(side, n)
+    df = pd.DataFrame(rows, columns=["price", "qty", "count"])
+    return pd.DataFrame({
+        "価格": df["price"] / PRICE_SCALE, "数量": df["qty"] / QTY_SCALE,
+        "注文数": df["count"], "累計": df["qty"].cumsum() / QTY_SCALE,
+    })
+
+# チャートの表示期間 -> (足の間隔, 本数)
+CHART_SPANS = {
+    "2時間（1分足）": (60, 120),
+    "1週間（1時間足）": (3600, 168),
+    "全期間（日足）": (86400, 3650),
+}
+
+HISTORY_PAGE = 50   # 取引履歴の1ページの行数
+
+def history_page(key:str, venue:str, user_id:Optional[int]=None)->pd.DataFrame:
+    """取引履歴の現在のページを返し、前後のページ送りボタンを出す。
+    各ページのカーソルは session_state に積み、表示するページだけを読む"""
+    cursors = st.session_state.setdefault(f"{key}_cursors", [PAGE_TOP])
+    df = cached_trades_page(venue, user_id, cursors[-1], HISTORY_PAGE + 1)   # 1行多く読んで次の有無を見る
+    has_next = len(df) > HISTORY_PAGE
+    df = df.iloc[:HISTORY_PAGE]
+    c1, c2, c3 = st.columns(3)
+    if c1.button("← 新しい", key=f"{key}_prev", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.experimental_rerun()
+    c2.write(f"{len(cursors)} ページ目")
+    if c3.button("古い →", key=f"{key}_next", disabled=not has_next):
+        cursors.append(page_cursor(df))
+        st.experimental_rerun()
+    return df
+
 def ensure_logged_in():
     st.session_state.setdefault("uid", None)
     st.session_state.setdefault("username", None)
@@ -327,10 +897,11 @@ def main_ui():
     st_autorefresh_counter.text(f"last refresh key={st_autorefresh_key}")
     st_autorefresh_widget = st.autorefresh(interval=3000, key="auto") if st_autorefresh else None
 
-    # 残高表示（常時DBから読む）
-    mock_bal, y_bal = get_wallet(st.session_state.uid)
-    st.sidebar.metric("Mock 残高", f"{mock_bal:.2f}")
-    st.sidebar.metric("Y 残高", f"{y_bal:.6f}")
+    # 残高表示（書き込みがあった時だけ DB から読み直す）
+    mock_bal, y_bal = cached_wallet(st.session_state.uid)
+    st.sidebar.metric("Mock 残高", f"{mock_value(mock_bal):.2f}")
+    st.sidebar.metric("Y 残高", f"{y_value(y_bal):.6f}")
+    metrics_panel()
 
     # 左右 2 カラム
     left, right = st.columns(2)
@@ -338,46 +909,40 @@ def main_ui():
     # ---------- 左：販売所 ----------
     with left:
         st.header("販売所（即時交換 / Fee 2%）")
-        price = get_price()
-        st.subheader(f"現在価格: {price:.6f} Mock / 1 Y")
+        price = cached_price()
+        st.subheader(f"現在価格: {mock_value(price):.6f} Mock / 1 Y")
         # 売買フォーム
         with st.form("dealer_buy"):
             buy_qty = st.number_input("購入数量 (Y)", min_value=0.0, step=1.0, value=0.0)
             buy_submit = st.form_submit_button("購入（Mock→Y）")
         if buy_submit and buy_qty > 0:
-            ok, msg = dealer_buy(st.session_state.uid, buy_qty)
+            ok, msg = get_dealer().call(st.session_state.uid, 'buy', to_lots(buy_qty))
             st.success(msg) if ok else st.error(msg)
 
         with st.form("dealer_sell"):
             sell_qty = st.number_input("売却数量 (Y)", min_value=0.0, step=1.0, value=0.0, key="dsell")
             sell_submit = st.form_submit_button("売却（Y→Mock）")
         if sell_submit and sell_qty > 0:
-            ok, msg = dealer_sell(st.session_state.uid, sell_qty)
+            ok, msg = get_dealer().call(st.session_state.uid, 'sell', to_lots(sell_qty))
             st.success(msg) if ok else st.error(msg)
 
         # 販売所の取引履歴と価格チャート
         st.subheader("販売所 取引履歴（誰⇄誰が見えるのは取引所側。販売所は相手=Exchange）")
-        trades = list_trades('dealer', 200)
-        if trades:
-            df = pd.DataFrame([{
-                "時刻": format_ts(r[0]),
-                "種別": "買" if r[2] else "売",  # buyer_id exists -> 買
-                "ユーザー": get_username(r[2]) if r[2] else get_username(r[3]) if r[3] else "-",
-                "相手方": "Exchange",
-                "価格": r[4],
-                "数量": r[5],
-                "手数料(bps)": r[6]
-            } for r in trades])
-            st.dataframe(df)
+        trades = history_page("dealer_hist", 'dealer')
+        if not trades.empty:
+            st.dataframe(dealer_history_table(trades))
         else:
             st.info("まだ販売所の取引はありません。")
 
-        # 価格推移（全体の取引の時系列から）
+        # 価格推移（全体の取引のローソク足から。期間に関係なく本数は上限まで）
         st.subheader("価格推移（年月日時分秒）")
-        all_tr = list_trades(None, 500)
-        if all_tr:
-            dfp = pd.DataFrame([{"time": format_ts(r[0]), "price": r[4]} for r in all_tr][::-1])
-            st.line_chart(dfp.set_index("time"))
+        span = st.radio("表示期間", list(CHART_SPANS), horizontal=True)
+        interval, limit = CHART_SPANS[span]
+        cdl = cached_candles_frame('all', interval, limit)
+        if not cdl.empty:
+            t = to_local_time(cdl["bucket"])
+            st.line_chart(pd.DataFrame({"time": t, "price": cdl["close"] / PRICE_SCALE}).set_index("time"))
+            st.bar_chart(pd.DataFrame({"time": t, "出来高": cdl["volume"] / QTY_SCALE}).set_index("time"))
         else:
             st.write("まだ価格データがありません。")
 
@@ -388,72 +953,80 @@ def main_ui():
         # 新規注文フォーム
         with st.form("new_order"):
             side = st.selectbox("売買区分", ["買い", "売り"])
-            price_in = st.number_input("価格 (Mock/1Y)", min_value=1.0, step=1.0, value=max(1.0, get_price()))
+            price_in = st.number_input("価格 (Mock/1Y)", min_value=1.0, step=1.0, value=max(1.0, mock_value(cached_price())))
             qty_in = st.number_input("数量 (Y)", min_value=1.0, step=1.0, value=1.0, key="oqty")
             submit = st.form_submit_button("板に注文を出す")
         if submit:
             if side == "買い":
                 # 必要Mock（上限価格×数量 + 手数料分）を目安に
-                need = price_in * qty_in * (1 + EX_FEE_BPS/10000.0)
+                cost = notional(to_mock(price_in), to_lots(qty_in))
+                need = cost + bps_fee(cost, EX_FEE_BPS)
                 mb, yb = get_wallet(st.session_state.uid)
                 if mb < need:
                     st.error("（目安）Mock不足の可能性がありますが、板マッチングで実際の約定金額は変動します。")
-                place_order(st.session_state.uid, 'buy', price_in, qty_in)
-                st.success("買い注文を板に出しました")
+                n_fills = get_matcher().call(place_order, st.session_state.uid, 'buy', to_mock(price_in), to_lots(qty_in))
+                st.success("買い注文を板に出しました" + (f"（{n_fills} 件約定）" if n_fills else ""))
             else:
                 mb, yb = get_wallet(st.session_state.uid)
-                if yb < qty_in:
+                if yb < to_lots(qty_in):
                     st.error("Y 残高不足の可能性があります。")
-                place_order(st.session_state.uid, 'sell', price_in, qty_in)
-                st.success("売り注文を板に出しました")
+                n_fills = get_matcher().call(place_order, st.session_state.uid, 'sell', to_mock(price_in), to_lots(qty_in))
+                st.success("売り注文を板に出しました" + (f"（{n_fills} 件約定）" if n_fills else ""))
 
-        # マッチング（全ユーザー共通で一括処理）
-        if st.button("板をマッチング/更新"):
-            changed = match_orders()
-            st.success("マッチングを実行しました" + ("（約定あり）" if changed else "（約定なし）"))
+        # 約定はマッチングワーカーが注文の到着時に行うので、ここでは表示を更新するだけ
+        st.button("板を更新")
 
-        # 現在の板
-        buy, sell = list_orderbook()
+        # 現在の板（価格ごとに集計、最良気配から DEPTH_LEVELS 段）
+        spread = get_book().spread()
+        st.write(f"スプレッド: {mock_value(spread):.2f} Mock" if spread is not None else "スプレッド: -")
+        buy = depth_table('buy')
         st.subheader("買い板（高い順）")
-        if buy:
-            dfb = pd.DataFrame([{
-                "注文ID": r[0], "ユーザー": r[1], "価格": r[3], "数量残": r[4], "時刻": format_ts(r[5])
-            } for r in buy])
-            st.dataframe(dfb)
+        if not buy.empty:
+            st.dataframe(buy)
         else:
             st.write("買い板なし")
 
+        sell = depth_table('sell')
         st.subheader("売り板（安い順）")
-        if sell:
-            dfs = pd.DataFrame([{
-                "注文ID": r[0], "ユーザー": r[1], "価格": r[3], "数量残": r[4], "時刻": format_ts(r[5])
-            } for r in sell])
-            st.dataframe(dfs)
+        if not sell.empty:
+            st.dataframe(sell)
         else:
             st.write("売り板なし")
 
         # 取引所の取引履歴（誰が誰に売ったか）
         st.subheader("取引所 取引履歴（誰→誰が分かる）")
-        ex_tr = list_trades('exchange', 200)
-        if ex_tr:
-            dfex = pd.DataFrame([{
-                "時刻": format_ts(r[0]),
-                "買い手": get_username(r[2]) if r[2] else "-",
-                "売り手": get_username(r[3]) if r[3] else "-",
-                "価格": r[4],
-                "数量": r[5],
-                "手数料(bps)": r[6]
-            } for r in ex_tr])
-            st.dataframe(dfex)
+        mine = st.checkbox("自分の約定のみ", key="ex_hist_mine")
+        if mine:
+            ex_tr = history_page("ex_hist_mine", 'exchange', st.session_state.uid)
+        else:
+            ex_tr = history_page("ex_hist", 'exchange')
+        if not ex_tr.empty:
+            st.dataframe(exchange_history_table(ex_tr))
         else:
             st.write("まだ取引所の約定はありません。")
 
+# ---------------------- GATEWAY ----------------------
+# 設定すると同じプロセスで HTTP / WebSocket のゲートウェイを起動する（板・書き込みワーカーを画面と共有）
+GATEWAY_PORT = int(os.environ.get("SIMDEX_GATEWAY_PORT") or 0)
+
+@st.cache_resource
+def _gateway(db:str, port:int)->threading.Thread:
+    # streamlit run ではこのファイルが __main__ なので、import し直さずにこのモジュールを渡す
+    return gateway.start_in_thread(sys.modules[__name__], port=port)
+
 # ---------------------- APP ENTRY ----------------------
-init_db()
-ensure_logged_in()
-
-# 未ログインならログイン画面、ログイン済みなら取引画面へ遷移
-if not st.session_state["uid"]:
-    login_ui()
-else:
-    main_ui()
+# streamlit run では __main__ として実行される（ベンチマーク等から import した時は UI を出さない）
+if __name__ == "__main__":
+    ensure_db()
+    if GATEWAY_PORT:
+        _gateway(DB, GATEWAY_PORT)
+    ensure_logged_in()
+
+    # 未ログインならログイン画面、ログイン済みなら取引画面へ遷移
+    if not st.session_state["uid"]:
+        login_ui()
+    else:
+        metrics.inc("renders")
+        with metrics.timer("render"):
+            main_ui()
+        maybe_dump_metrics()
@@ -7,25 +7,48 @@ Created on Sat Sep  6 19:53:32 2025
 
 # app.py
 import streamlit as st
-import json
-import os
 from datetime import datetime
-import matplotlib.pyplot as plt
+
+from charts import ChartCache, line_png
+from journal import Journal
+from matching import Book, dealer_trade, depth_rows, match_and_settle, place_order
+from worker import Worker
 
 DATA_FILE = "crypto_sim_data.json"
 
 # -------------------------
 # データ管理
 # -------------------------
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return {"users": {}, "exchange_orders": [], "transactions": [], "price": 100}
-    with open(DATA_FILE, "r") as f:
-        return json.load(f)
+def default_data():
+    return {"users": {}, "exchange_orders": [], "transactions": [], "price": 100}
+
+@st.cache_resource
+def get_journal():
+    """スナップショット + 追記ログから状態を組み立て、全セッションでメモリ上に共有する"""
+    return Journal(DATA_FILE, default_data)
+
+@st.cache_resource
+def get_book():
+    """ジャーナルの注文をソートして持つ板（全セッションで共有）"""
+    return Book()
+
+@st.cache_resource
+def get_matcher():
+    """注文の登録とマッチングを1本のスレッドで順に実行するワーカー"""
+    worker = Worker("matcher")
+    worker.submit(match_and_settle, get_journal(), get_book(), "Mock")   # 前回の起動から交差が残っていれば約定させる
+    return worker
 
-def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+def dealer_price(data):
+    return data["price"]
+
+def price_event(p:float)->dict:
+    return {"t": "price", "p": p}
+
+@st.cache_resource
+def get_charts():
+    """描画済みチャートのキャッシュ（取引が増えたときだけ描き直す）"""
+    return ChartCache()
 
 # -------------------------
 # 初期化
@@ -33,7 +56,8 @@ def save_data(data):
 if "user" not in st.session_state:
     st.session_state.user = None
 
-data = load_data()
+journal = get_journal()
+data = journal.data
 
 # -------------------------
 # ログイン & 新規登録
@@ -49,11 +73,10 @@ with col1:
         if username in data["users"]:
             st.error("既に存在するユーザー名です。")
         else:
-            data["users"][username] = {
+            journal.append({"t": "user", "name": username, "rec": {
                 "password": password,
                 "wallet": {"Mock": 1000, "Ycoin": 0},
-            }
-            save_data(data)
+            }})
             st.session_state.user = username
             st.success("新規登録成功！ウォレットが作成されました。")
 
@@ -88,41 +111,13 @@ if st.session_state.user:
         st.write(f"現在の販売所価格: **{current_price:.2f} Mock / Ycoin**")
         trade_amount = st.number_input("購入/売却量 (Ycoin)", min_value=0.0, step=1.0)
 
+        # 残高の読み書きは取引所の約定と同じワーカーで直列に行う
         if st.button("販売所で購入"):
-            cost = trade_amount * current_price
-            fee = cost * 0.02
-            total = cost + fee
-            if wallet["Mock"] >= total:
-                wallet["Mock"] -= total
-                wallet["Ycoin"] += trade_amount
-                data["transactions"].append({
-                    "type": "buy",
-                    "user": user,
-                    "amount": trade_amount,
-                    "price": current_price,
-                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "place": "dealer"
-                })
-                data["price"] *= 1.01  # 需給による価格上昇
-                save_data(data)
+            if get_matcher().call(dealer_trade, journal, "Mock", user, "buy", trade_amount, dealer_price, price_event):
                 st.success("購入しました！")
 
         if st.button("販売所で売却"):
-            if wallet["Ycoin"] >= trade_amount:
-                proceeds = trade_amount * current_price
-                fee = proceeds * 0.02
-                wallet["Ycoin"] -= trade_amount
-                wallet["Mock"] += proceeds - fee
-                data["transactions"].append({
-                    "type": "sell",
-                    "user": user,
-                    "amount": trade_amount,
-                    "price": current_price,
-                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "place": "dealer"
-                })
-                data["price"] *= 0.99  # 需給による価格下落
-                save_data(data)
+            if get_matcher().call(dealer_trade, journal, "Mock", user, "sell", trade_amount, dealer_price, price_event):
                 st.success("売却しました！")
 
         st.subheader("📈 販売所の取引履歴")
@@ -131,13 +126,8 @@ if st.session_state.user:
 
         # 価格推移チャート
         if dealer_tx:
-            times = [tx["time"] for tx in dealer_tx]
-            prices = [tx["price"] for tx in dealer_tx]
-            fig, ax = plt.subplots()
-            ax.plot(times, prices, marker="o")
-            ax.set_xticklabels(times, rotation=45, ha="right")
-            ax.set_ylabel("Price (Mock)")
-            st.pyplot(fig)
+            st.image(get_charts().get("dealer", len(dealer_tx), lambda: line_png(
+                [tx["time"] for tx in dealer_tx], [tx["price"] for tx in dealer_tx], ylabel="Price (Mock)")))
 
     # -------------------------
     # 取引所
@@ -157,53 +147,16 @@ if st.session_state.user:
                 "price": order_price,
                 "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             }
-            data["exchange_orders"].append(order)
-            save_data(data)
-            st.success("注文を出しました！")
-
-        # 板情報の表示
-        buy_orders = [o for o in data["exchange_orders"] if o["type"] == "buy"]
-        sell_orders = [o for o in data["exchange_orders"] if o["type"] == "sell"]
+            fills = get_matcher().call(place_order, journal, get_book(), "Mock", order)
+            st.success("注文を出しました！" + (f"（{len(fills)} 件約定）" if fills else ""))
 
+        # 板情報の表示（価格ごとに集計、最良気配から10段）
+        spread = get_book().spread()
+        st.write(f"スプレッド: {spread:.2f} Mock" if spread is not None else "スプレッド: -")
         st.subheader("📝 買い注文板")
-        st.table(buy_orders[-10:])
+        st.table(depth_rows(get_book(), "buy"))
         st.subheader("📝 売り注文板")
-        st.table(sell_orders[-10:])
-
-        # 簡易マッチング（同価格帯があれば約定）
-        matched = []
-        for buy in buy_orders:
-            for sell in sell_orders:
-                if buy["price"] >= sell["price"] and buy["amount"] > 0 and sell["amount"] > 0:
-                    qty = min(buy["amount"], sell["amount"])
-                    trade_price = (buy["price"] + sell["price"]) / 2
-                    fee = qty * trade_price * 0.005
-
-                    # 更新
-                    data["users"][buy["user"]]["wallet"]["Mock"] -= qty * trade_price + fee
-                    data["users"][buy["user"]]["wallet"]["Ycoin"] += qty
-                    data["users"][sell["user"]]["wallet"]["Mock"] += qty * trade_price - fee
-                    data["users"][sell["user"]]["wallet"]["Ycoin"] -= qty
-
-                    buy["amount"] -= qty
-                    sell["amount"] -= qty
-
-                    data["transactions"].append({
-                        "type": "exchange",
-                        "buyer": buy["user"],
-                        "seller": sell["user"],
-                        "amount": qty,
-                        "price": trade_price,
-                        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "place": "exchange"
-                    })
-                    matched.append((buy, sell))
-
-        # 完了した注文を削除
-        data["exchange_orders"] = [o for o in data["exchange_orders"] if o["amount"] > 0]
-        if matched:
-            save_data(data)
-            st.success(f"{len(matched)} 件の注文が約定しました！")
+        st.table(depth_rows(get_book(), "sell"))
 
         st.subheader("📊 取引所の取引履歴")
         exchange_tx = [tx for tx in data["transactions"] if tx["place"] == "exchange"]
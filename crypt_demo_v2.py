@@ -6,43 +6,73 @@ Created on Sat Sep  6 21:09:12 2025
 """
 
 import streamlit as st
-import json
-import os
-import random
 from datetime import datetime, timedelta
-import pandas as pd
+
+from journal import Journal
+from price_series import PriceSeries
+from price_process import GBM
+from matching import Book, dealer_trade, depth_rows, match_and_settle, place_order
+from worker import Worker
 
 DATA_FILE = "crypto_sim_data.json"
+TICK_INTERVAL = 1   # 秒（画面の再実行がこれより頻繁でも価格は進めない）
+CHART_SPANS = {"15分": 15 * 60, "1日": 24 * 3600, "全期間": None}
 
 # -------------------------
 # データ管理
 # -------------------------
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return {
-            "users": {},
-            "exchange_orders": [],
-            "transactions": [],
-            "price_history": [{"time": "2025-07-01 00:00:00", "price": 100}],
-        }
-    with open(DATA_FILE, "r") as f:
-        return json.load(f)
-
-def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+def default_data():
+    return {
+        "users": {},
+        "exchange_orders": [],
+        "transactions": [],
+        "price_history": PriceSeries.from_json([{"time": "2025-07-01 00:00:00", "price": 100}]),
+    }
+
+def decode_data(data):
+    # 旧形式（全ティックのリスト）もここで足に集計し直す
+    data["price_history"] = PriceSeries.from_json(data["price_history"])
+
+@st.cache_resource
+def get_journal():
+    """スナップショット + 追記ログから状態を組み立て、全セッションでメモリ上に共有する"""
+    return Journal(DATA_FILE, default_data, decode=decode_data)
+
+@st.cache_resource
+def get_book():
+    """ジャーナルの注文をソートして持つ板（全セッションで共有）"""
+    return Book()
+
+@st.cache_resource
+def get_matcher():
+    """注文の登録とマッチングを1本のスレッドで順に実行するワーカー"""
+    worker = Worker("matcher")
+    worker.submit(match_and_settle, get_journal(), get_book(), "円（Mock）")   # 前回の起動から交差が残っていれば約定させる
+    return worker
 
 # -------------------------
 # 価格シミュレーション
 # -------------------------
-def update_price(data):
-    last_price = data["price_history"][-1]["price"]
-    # ランダムな小幅変動
-    rand_factor = random.uniform(0.98, 1.02)
-    new_price = last_price * rand_factor
-    now = datetime.now()
-    data["price_history"].append({"time": now.strftime("%Y-%m-%d %H:%M:%S"), "price": new_price})
-    save_data(data)
+@st.cache_resource
+def get_price_process():
+    # 1ティックあたり約 1.15%（元の ±2% の一様乱数と同じ標準偏差）
+    return GBM(sigma=0.0115)
+
+def dealer_price(data):
+    return data["price_history"].last_price()
+
+def price_event(p:float)->dict:
+    return {"t": "tick", "tick": {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "price": p}}
+
+def update_price(journal):
+    # 販売所の売買と同時に走っても価格の更新を失わないよう、読みと追記をロックの中で行う
+    with journal.lock:
+        # 前のティックから TICK_INTERVAL 秒たっていなければ何もしない（再実行のたびに追記しない）
+        age = journal.data["price_history"].age(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        if age is not None and age < TICK_INTERVAL:
+            return
+        # ランダムな小幅変動
+        journal.append(price_event(get_price_process().next(dealer_price(journal.data))))
 
 # -------------------------
 # 初期化
@@ -50,8 +80,9 @@ def update_price(data):
 if "user" not in st.session_state:
     st.session_state.user = None
 
-data = load_data()
-update_price(data)
+journal = get_journal()
+data = journal.data
+update_price(journal)
 
 # -------------------------
 # ログイン & 新規登録
@@ -66,10 +97,9 @@ with col1:
         if username in data["users"]:
             st.error("既に存在するユーザー名です。")
         else:
-            data["users"][username] = {
+            journal.append({"t": "user", "name": username, "rec": {
                 "wallet": {"円（Mock）": 1000, "Ycoin": 0},
-            }
-            save_data(data)
+            }})
             st.session_state.user = username
             st.success("新規登録成功！ウォレットが作成されました。")
 
@@ -91,7 +121,7 @@ if st.session_state.user:
     st.subheader(f"👤 ログイン中: {user}")
 
     # 現在の価格
-    current_price = data["price_history"][-1]["price"]
+    current_price = data["price_history"].last_price()
 
     # 評価額計算
     total_value = wallet["円（Mock）"] + wallet["Ycoin"] * current_price
@@ -110,10 +140,11 @@ if st.session_state.user:
     # 履歴表示
     dealer_tx = [tx for tx in data["transactions"] if tx["place"] == "dealer"]
     st.subheader("📈 販売所の価格推移")
-    df_price = pd.DataFrame(data["price_history"])
-    df_price["time"] = pd.to_datetime(df_price["time"])
-    df_price = df_price[df_price["time"] >= datetime(2025, 7, 1)]
-    st.line_chart(df_price.set_index("time")["price"])
+    # 表示期間に応じて生ティック / 1秒足 / 1分足 / 1時間足から引く（点数は常に上限以下）
+    span = st.radio("表示期間", list(CHART_SPANS), index=len(CHART_SPANS) - 1, horizontal=True)
+    df_price = data["price_history"].frame(CHART_SPANS[span])
+    df_price = df_price[df_price.index >= datetime(2025, 7, 1)]
+    st.line_chart(df_price["close"].rename("price"))
 
     st.subheader("📜 販売所の取引履歴")
     st.table(dealer_tx[-10:])
@@ -122,50 +153,16 @@ if st.session_state.user:
     st.subheader("💱 販売所で取引する")
     trade_amount = st.number_input("数量 (Ycoin)", min_value=0.0, step=1.0)
 
+    # 残高の読み書きは取引所の約定と同じワーカーで直列に行う
     colb1, colb2 = st.columns(2)
     with colb1:
         if st.button("購入（円→Ycoin）"):
-            cost = trade_amount * current_price
-            fee = cost * 0.02
-            total = cost + fee
-            if wallet["円（Mock）"] >= total:
-                wallet["円（Mock）"] -= total
-                wallet["Ycoin"] += trade_amount
-                data["transactions"].append({
-                    "type": "buy",
-                    "user": user,
-                    "amount": trade_amount,
-                    "price": current_price,
-                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "place": "dealer"
-                })
-                data["price_history"].append({
-                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "price": current_price * 1.01
-                })
-                save_data(data)
+            if get_matcher().call(dealer_trade, journal, "円（Mock）", user, "buy", trade_amount, dealer_price, price_event):
                 st.success("購入しました！")
 
     with colb2:
         if st.button("売却（Ycoin→円）"):
-            if wallet["Ycoin"] >= trade_amount:
-                proceeds = trade_amount * current_price
-                fee = proceeds * 0.02
-                wallet["Ycoin"] -= trade_amount
-                wallet["円（Mock）"] += proceeds - fee
-                data["transactions"].append({
-                    "type": "sell",
-                    "user": user,
-                    "amount": trade_amount,
-                    "price": current_price,
-                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "place": "dealer"
-                })
-                data["price_history"].append({
-                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "price": current_price * 0.99
-                })
-                save_data(data)
+            if get_matcher().call(dealer_trade, journal, "円（Mock）", user, "sell", trade_amount, dealer_price, price_event):
                 st.success("売却しました！")
 
     # -------------------------
@@ -173,17 +170,16 @@ if st.session_state.user:
     # -------------------------
     st.header("🏛️ 取引所（手数料 0.5%）")
 
-    # 板表示
-    buy_orders = [o for o in data["exchange_orders"] if o["type"] == "buy"]
-    sell_orders = [o for o in data["exchange_orders"] if o["type"] == "sell"]
-
+    # 板表示（価格ごとに集計、最良気配から10段）
+    spread = get_book().spread()
+    st.write(f"スプレッド: {spread:.2f} 円" if spread is not None else "スプレッド: -")
     col_ex1, col_ex2 = st.columns(2)
     with col_ex1:
         st.subheader("📝 買い注文板")
-        st.table(buy_orders[-10:])
+        st.table(depth_rows(get_book(), "buy"))
     with col_ex2:
         st.subheader("📝 売り注文板")
-        st.table(sell_orders[-10:])
+        st.table(depth_rows(get_book(), "sell"))
 
     st.subheader("📊 取引所の取引履歴")
     exchange_tx = [tx for tx in data["transactions"] if tx["place"] == "exchange"]
@@ -202,50 +198,14 @@ if st.session_state.user:
             "price": order_price,
             "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         }
-        data["exchange_orders"].append(order)
-        save_data(data)
-        st.success("注文を出しました！")
-
-    # 自動マッチング
-    matched = []
-    for buy in buy_orders:
-        for sell in sell_orders:
-            if buy["price"] >= sell["price"] and buy["amount"] > 0 and sell["amount"] > 0:
-                qty = min(buy["amount"], sell["amount"])
-                trade_price = (buy["price"] + sell["price"]) / 2
-                fee = qty * trade_price * 0.005
-
-                # 更新
-                data["users"][buy["user"]]["wallet"]["円（Mock）"] -= qty * trade_price + fee
-                data["users"][buy["user"]]["wallet"]["Ycoin"] += qty
-                data["users"][sell["user"]]["wallet"]["円（Mock）"] += qty * trade_price - fee
-                data["users"][sell["user"]]["wallet"]["Ycoin"] -= qty
-
-                buy["amount"] -= qty
-                sell["amount"] -= qty
-
-                data["transactions"].append({
-                    "type": "exchange",
-                    "buyer": buy["user"],
-                    "seller": sell["user"],
-                    "amount": qty,
-                    "price": trade_price,
-                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "place": "exchange"
-                })
-                matched.append((buy, sell))
-
-    data["exchange_orders"] = [o for o in data["exchange_orders"] if o["amount"] > 0]
-    if matched:
-        save_data(data)
-        st.success(f"{len(matched)} 件の注文が約定しました！")
+        fills = get_matcher().call(place_order, journal, get_book(), "円（Mock）", order)
+        st.success("注文を出しました！" + (f"（{len(fills)} 件約定）" if fills else ""))
 
     # -------------------------
     # Host の管理機能
     # -------------------------
     if user == "Host":
         if st.button("🚨 全取引履歴を削除"):
-            data["transactions"] = []
-            data["exchange_orders"] = []
-            save_data(data)
+            journal.append({"t": "clear"})
+            get_matcher().call(match_and_settle, journal, get_book(), "円（Mock）")   # 板を空の注文リストに合わせる
             st.warning("全取引履歴を削除しました。")
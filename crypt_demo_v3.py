@@ -6,11 +6,14 @@ Created on Sat Sep  6 21:36:02 2025
 """
 
 import streamlit as st
-import random
 import datetime
-import matplotlib.pyplot as plt
 import pandas as pd
 
+from agents import AgentPool, MM
+from charts import line_png
+from fixedpoint import to_mock, mock_value, y_value
+from price_process import JumpDiffusion
+
 st.set_page_config(page_title="Y coin 取引", layout="wide")
 
 # ----------------------
@@ -20,26 +23,36 @@ if "user" not in st.session_state:
     st.session_state.user = None
 if "wallets" not in st.session_state:
     st.session_state.wallets = {}
+@st.cache_resource
+def get_price_process():
+    # 普段は1ティック 3% 前後、ときどき ±10% 程度のジャンプ（乱高下）
+    return JumpDiffusion(sigma=0.03, lam=0.05, jump_sigma=0.1)
+
 if "price_history" not in st.session_state:
     base_date = datetime.date(2025, 7, 1)
     st.session_state.price_history = [
-        (base_date + datetime.timedelta(days=i), 100 + random.randint(-10, 10))
-        for i in range(10)
+        (base_date + datetime.timedelta(days=i), round(p, 2))
+        for i, p in enumerate(get_price_process().advance(100, 10).tolist())
     ]
 if "market_price" not in st.session_state:
     st.session_state.market_price = st.session_state.price_history[-1][1]
 if "trade_history" not in st.session_state:
     st.session_state.trade_history = []
 
-dummy_users = ["UserA", "UserB", "UserC"]
+# ダミートレードの参加者（マーケットメイカー・モメンタム・ノイズ）。プロセスで1回だけ作る
+DUMMY_AGENTS = (30, 60, 210)
+DUMMY_TRADES_PER_RUN = 3   # 1回の再実行あたりの平均件数（ポアソン）
+
+@st.cache_resource
+def get_agents():
+    return AgentPool(*DUMMY_AGENTS)
 
 # ----------------------
 # 価格更新（ボラティリティを抑制）
 # ----------------------
 def update_price():
     last_price = st.session_state.market_price
-    change = random.randint(-50, 150)  # 乱高下はこの範囲
-    new_price = max(10, last_price + change)
+    new_price = max(10, round(get_price_process().next(last_price), 2))
     st.session_state.market_price = new_price
     st.session_state.price_history.append((datetime.date.today(), new_price))
     if len(st.session_state.price_history) > 100:
@@ -49,26 +62,30 @@ def update_price():
 # ダミートレード
 # ----------------------
 def simulate_dummy_trades():
-    if random.random() < 0.5:
-        user = random.choice(dummy_users)
-        side = random.choice(["buy", "sell"])
-        amount = round(random.uniform(0.1, 1.0), 2)
-        price = st.session_state.market_price
-        fee_rate = 0.02 if random.random() < 0.5 else 0.005
-        st.session_state.trade_history.insert(
-            0,
-            {
-                "user": user,
-                "side": side,
-                "amount": amount,
-                "price": price,
-                "fee": fee_rate,
-                "time": datetime.datetime.now().strftime("%H:%M:%S"),
-                "place": "販売所" if fee_rate == 0.02 else "取引所",
-            },
-        )
-        if len(st.session_state.trade_history) > 10:
-            st.session_state.trade_history.pop()
+    """エージェントの注文をまとめて生成し、取引履歴に流す。
+    マーケットメイカーは取引所、それ以外は販売所と取引所に半々"""
+    pool = get_agents()
+    n = int(pool.rng.poisson(DUMMY_TRADES_PER_RUN))
+    if n == 0:
+        return
+    hist = st.session_state.price_history
+    trend = (hist[-1][1] - hist[-2][1]) / hist[-2][1] if len(hist) > 1 else 0.0
+    agent, is_buy, price, qty = pool.batch(n, to_mock(st.session_state.market_price), trend)
+    dealer = (pool.kind[agent] != MM) & (pool.rng.random(n) < 0.5)
+    now = datetime.datetime.now().strftime("%H:%M:%S")
+    st.session_state.trade_history[:0] = [
+        {
+            "user": f"Agent{a}",
+            "side": "buy" if b else "sell",
+            "amount": round(y_value(q), 2),
+            "price": round(mock_value(p), 2),
+            "fee": 0.02 if d else 0.005,
+            "time": now,
+            "place": "販売所" if d else "取引所",
+        }
+        for a, b, p, q, d in zip(agent.tolist(), is_buy.tolist(), price.tolist(), qty.tolist(), dealer.tolist())
+    ]
+    del st.session_state.trade_history[10:]
 
 # ----------------------
 # トレード実行
@@ -151,12 +168,9 @@ else:
     st.markdown("## 🏦 販売所（手数料 2%）")
     update_price()
 
-    dates, prices = zip(*st.session_state.price_history)
-    fig, ax = plt.subplots()
-    ax.plot(dates, prices, marker="o")
-    ax.set_title("Price History")
-    ax.set_ylabel("Price")
-    st.pyplot(fig)
+    hist = st.session_state.price_history
+    # 価格は再実行ごとに動くので毎回描く（履歴は最大100件）
+    st.image(line_png([d for d, _ in hist], [p for _, p in hist], title="Price History", ylabel="Price"))
 
     st.write(f"現在価格: **1.00 Ycoin = {st.session_state.market_price:.2f} 円(Mock)**")
 
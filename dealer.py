@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+販売所の約定エンジン（crypt_demo_v0 の dealer_buy / dealer_sell をまとめて処理する）。
+
+販売所の売買は直近価格を読んで α だけ動かす読み書きなので、画面の再実行から
+並行に呼ぶと価格の更新が失われる。そこで依頼はすべてこのエンジンに積み、
+書き込みワーカー（worker.Worker）の上で短い窓（window 秒）に集まった分を
+到着順に1回で処理する。価格はエンジンがメモリに持ち、1バッチ = 1トランザクション。
+取引所の約定などで価格が外から書き換わったら（price_version が変わったら）
+次のバッチで読み直す。
+
+    engine = DealerEngine(worker, dealer_batch, lambda: market_version("price"))
+    ok, msg = engine.call(uid, 'buy', qty)
+
+execute(reqs, price) は [(uid, side, qty), ...] と手元の価格（None なら DB から読む）を
+受け取り、(依頼ごとの結果のリスト, 新しい価格) を返す。
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from worker import Worker, CALL_TIMEOUT
+
+DEALER_WINDOW = 0.002   # 秒（最初の依頼からこの間に届いた分を1バッチにする）
+MAX_BATCH = 256
+
+
+class DealerEngine:
+    def __init__(self, worker:Worker, execute:Callable[[list,Optional[int]],Tuple[list,int]],
+                 price_version:Callable[[],Hashable], window:float=DEALER_WINDOW, max_batch:int=MAX_BATCH):
+        self.worker = worker
+        self.execute = execute
+        self.price_version = price_version
+        self.window = window
+        self.max_batch = max_batch
+        self.price: Optional[int] = None   # メモリ上の直近価格（None は次のバッチで読み直す）
+        self._seen = None                  # price を持ったときの price_version
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[tuple,Future]] = []
+        self._first = 0.0                  # 未処理の先頭の依頼が届いた時刻
+
+    def submit(self, uid:int, side:str, qty:int)->Future:
+        """依頼を積み、(ok, msg) の Future を返す"""
+        fut = Future()
+        with self._lock:
+            self._pending.append(((uid, side, qty), fut))
+            if len(self._pending) == 1:
+                self._first = time.monotonic()
+                self.worker.submit(self._flush)
+        return fut
+
+    def call(self, uid:int, side:str, qty:int)->Tuple[bool,str]:
+        return self.submit(uid, side, qty).result(CALL_TIMEOUT)
+
+    def _flush(self):
+        """ワーカーのスレッドで実行: 窓が閉じるのを待ち、溜まった依頼を1トランザクションで処理する"""
+        wait = self._first + self.window - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        with self._lock:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            if self._pending:   # 積み残しは待たずに次のバッチへ
+                self._first = 0.0
+                self.worker.submit(self._flush)
+        if self._seen != self.price_version():
+            self.price = None   # 取引所の約定などで価格が変わった
+        try:
+            results, self.price = self.execute([req for req, _ in batch], self.price)
+            self._seen = self.price_version()
+        except BaseException as e:
+            self.price = None
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        for (_, fut), res in zip(batch, results):
+            fut.set_result(res)
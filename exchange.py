@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+販売所・取引所の業務ロジックを Storage の上に実装したもの。
+
+約定と販売所の規則（sweep / dealer_fill と手数料などの定数）はこのモジュールだけが持ち、
+crypt_demo_v0 も同じ関数を呼ぶ（v0 は SQL で直接まとめて書くので、決済後の書き込みだけが別）。
+
+状態はすべて storage.Storage 経由で読み書きするので、SQLite・ジャーナル・メモリの
+どのバックエンドでも同じように動く。板はメモリ上の OrderBook に持ち、
+起動時に storage.open_orders() から読み込む。注文の登録と約定、販売所の
+売買はそれぞれ1つの transaction() にまとめる。
+
+    ex = Exchange(MemoryStorage())
+    uid = ex.create_user("alice", "pw")
+    ex.place_order(uid, 'buy', to_mock(100), to_lots(1))
+"""
+
+import hashlib
+import secrets
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from fixedpoint import PRICE_SCALE, QTY_SCALE, to_mock, mock_value, y_value, notional, bps_fee
+from orderbook import OrderBook, OID, UID, SIDE, PRICE, QTY
+from storage import Storage
+
+DEALER_FEE_BPS = 200   # 2.00%
+EX_FEE_BPS     = 50    # 0.50%
+DEALER_ALPHA   = 0.05  # 需給で価格調整: 新価格 = 直近 + α*(買数量-売数量)
+DEALER_ALPHA_TICKS = to_mock(DEALER_ALPHA)   # 1 Y あたりの価格変化（1e-6 Mock）
+SIGNUP_MOCK = to_mock(1000)          # 初期配布
+
+
+# ---------------------- 約定・販売所の規則 ----------------------
+def dealer_fill(w:list, uid:int, side:str, qty:int, price:int, ts:int)->Tuple[Optional[tuple],str,int]:
+    """販売所の売買1件を直近価格 price で決済する。w は uid の [mock, y]（その場で書き換える）。
+    (約定の行（残高不足なら None）, メッセージ, 次の直近価格) を返す"""
+    if side == 'buy':
+        cost = notional(price, qty)
+        fee = bps_fee(cost, DEALER_FEE_BPS)
+        if w[0] < cost + fee: return None, "Mock残高不足", price
+        w[0] -= cost + fee; w[1] += qty
+        return ((ts, 'dealer', uid, None, price, qty, DEALER_FEE_BPS, fee, 0),
+                f"{y_value(qty)} Y を購入 (価格 {mock_value(price)} Mock, 手数料 {mock_value(fee):.2f} Mock)",
+                price + DEALER_ALPHA_TICKS * qty // QTY_SCALE)   # 価格上方調整
+    if w[1] < qty: return None, "Y 残高不足", price
+    proceeds = notional(price, qty)
+    fee = bps_fee(proceeds, DEALER_FEE_BPS)
+    w[0] += proceeds - fee; w[1] -= qty
+    return ((ts, 'dealer', None, uid, price, qty, DEALER_FEE_BPS, 0, fee),
+            f"{y_value(qty)} Y を売却 (価格 {mock_value(price)} Mock, 手数料 {mock_value(fee):.2f} Mock)",
+            max(PRICE_SCALE, price - DEALER_ALPHA_TICKS * qty // QTY_SCALE))   # 価格下方調整（下限 1 Mock）
+
+def sweep(book:OrderBook, wallet:Callable[[int],list], taker:Optional[list]=None
+          )->Tuple[List[tuple],Dict[int,int],Set[int],bool]:
+    """板を約定させて決済する（book は更新するが、ストレージには書かない）。
+    wallet(uid) はスイープ中の [mock, y] を返す（同じ uid には同じリスト。その場で書き換える）。
+    taker を渡すとその注文だけを反対側の板と指値まで約定させ、残りは板に残す。
+    taker なしなら板全体が交差しなくなるまで約定させる。
+    戻り値は (約定の行, {order_id: 新しい残数量（0 以下は削除）}, 残高が変わったユーザー,
+    残高不足で約定なしに消した注文があるか)"""
+    order_qty = {}
+    touched = set()
+    fills = []
+    cancelled = False
+
+    while True:
+        if taker is None:
+            best_buy, best_sell = book.best('buy'), book.best('sell')
+        elif taker[OID] not in book.orders:
+            break  # 全量約定、または残高不足で削除済み
+        elif taker[SIDE] == 'buy':
+            best_buy, best_sell = taker, book.best('sell')
+        else:
+            best_buy, best_sell = book.best('buy'), taker
+        if not best_buy or not best_sell: break
+        if best_buy[PRICE] < best_sell[PRICE]: break  # 価格が交差しない
+        # 約定価格：中間（シンプル）
+        trade_price = (best_buy[PRICE] + best_sell[PRICE]) // 2
+        trade_qty = min(best_buy[QTY], best_sell[QTY])
+        buy_uid = best_buy[UID]; sell_uid = best_sell[UID]
+
+        # 残高チェックと決済（Mock/Yの移転 + 手数料0.5%）
+        cost = notional(trade_price, trade_qty)
+        fee = bps_fee(cost, EX_FEE_BPS)
+        wb = wallet(buy_uid); ws = wallet(sell_uid)
+        if wb[0] < cost + fee or ws[1] < trade_qty:
+            # 残高不足の側の注文は取り消す
+            cancelled = True
+            if wb[0] < cost + fee:
+                order_qty[best_buy[OID]] = 0; book.remove(best_buy[OID])
+            if ws[1] < trade_qty:
+                order_qty[best_sell[OID]] = 0; book.remove(best_sell[OID])
+            continue
+        wb[0] -= cost + fee; wb[1] += trade_qty
+        ws[0] += cost - fee; ws[1] -= trade_qty
+        touched.update((buy_uid, sell_uid))
+
+        for o in (best_buy, best_sell):
+            rem = o[QTY] - trade_qty
+            order_qty[o[OID]] = rem
+            book.update_qty(o[OID], rem)
+        fills.append((int(time.time()), 'exchange', buy_uid, sell_uid, trade_price, trade_qty,
+                      EX_FEE_BPS, fee, fee))
+    return fills, order_qty, touched, cancelled
+
+
+def _pw_hash(password:str, salt:str)->str:
+    return hashlib.sha256((password+salt).encode()).hexdigest()
+
+
+class Exchange:
+    def __init__(self, storage:Storage):
+        self.storage = storage
+        self.book = OrderBook()
+        self.book.load(storage.open_orders())
+
+    # ---- ユーザー ----
+    def create_user(self, username:str, password:str)->Optional[int]:
+        """登録して user_id を返す（既に存在すれば None）"""
+        if self.storage.get_user(username):
+            return None
+        salt = secrets.token_hex(8)
+        return self.storage.add_user(username, _pw_hash(password, salt), salt, SIGNUP_MOCK, 0)
+
+    def check_password(self, username:str, password:str)->Optional[int]:
+        r = self.storage.get_user(username)
+        if r and _pw_hash(password, r[2]) == r[1]:
+            return r[0]
+        return None
+
+    # ---- 読み取り ----
+    def wallet(self, uid:int)->Tuple[int,int]:
+        return self.storage.get_wallet(uid)
+
+    def price(self)->int:
+        return self.storage.get_price()
+
+    def trades(self, venue:Optional[str]=None, limit:int=200)->list:
+        return self.storage.trades(venue, limit)
+
+    # ---- 販売所 ----
+    def dealer_buy(self, uid:int, qty:int)->Tuple[bool,str]:
+        """販売所で Y を買う（Mock -> Y）。qty は lot"""
+        return self._dealer(uid, 'buy', qty)
+
+    def dealer_sell(self, uid:int, qty:int)->Tuple[bool,str]:
+        """販売所で Y を売る（Y -> Mock）。qty は lot"""
+        return self._dealer(uid, 'sell', qty)
+
+    def _dealer(self, uid:int, side:str, qty:int)->Tuple[bool,str]:
+        s = self.storage
+        with s.transaction():
+            w = list(s.get_wallet(uid))
+            trade, msg, price = dealer_fill(w, uid, side, qty, s.get_price(), int(time.time()))
+            if trade is None: return False, msg
+            s.set_wallets([(uid, w[0], w[1])])
+            s.add_trades([trade])
+            s.set_price(price)
+        return True, msg
+
+    # ---- 取引所 ----
+    def place_order(self, uid:int, side:str, price:int, qty:int)->int:
+        """注文を登録し、反対側の板と指値まで約定させる（残りは板に残す）。約定件数を返す"""
+        ts = int(time.time())
+        with self.book.lock:
+            try:
+                with self.storage.transaction():
+                    oid = self.storage.add_order(uid, side, price, qty, ts)
+                    taker = self.book.add(oid, uid, side, price, qty, ts)
+                    return self._sweep(taker)
+            except Exception:
+                self.book.load(self.storage.open_orders())
+                raise
+
+    def _sweep(self, taker:list)->int:
+        """taker を反対側の最良気配から順に約定させ、結果をまとめて書く"""
+        s = self.storage
+        wallets = {}     # user_id -> [mock, y]
+
+        def wallet(u):
+            if u not in wallets:
+                wallets[u] = list(s.get_wallet(u))
+            return wallets[u]
+
+        fills, order_qty, touched, _ = sweep(self.book, wallet, taker)
+        if order_qty:
+            s.set_order_qtys(order_qty.items())
+        if fills:
+            s.set_wallets((u, wallets[u][0], wallets[u][1]) for u in touched)
+            s.add_trades(fills)
+            s.set_price(max(PRICE_SCALE, fills[-1][4]))
+        return len(fills)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+固定小数点の単位と換算（crypt_demo_v0 / storage / exchange で共通）。
+
+価格・Mock 金額は 1e-6 Mock 単位、数量は 1e-6 Y 単位（lot）の整数で持つ。
+"""
+
+PRICE_SCALE = 1_000_000
+QTY_SCALE   = 1_000_000
+
+def to_mock(x:float)->int:
+    """Mock 金額・価格（float）を整数単位に"""
+    return int(round(x * PRICE_SCALE))
+
+def to_lots(x:float)->int:
+    """Y 数量（float）を lot に"""
+    return int(round(x * QTY_SCALE))
+
+def mock_value(u:int)->float:
+    return u / PRICE_SCALE
+
+def y_value(q:int)->float:
+    return q / QTY_SCALE
+
+def notional(price:int, qty:int)->int:
+    """価格 × 数量（Mock 単位、四捨五入）"""
+    return (price * qty + QTY_SCALE // 2) // QTY_SCALE
+
+def bps_fee(amount:int, bps:int)->int:
+    """金額 × bps（Mock 単位、四捨五入）"""
+    return (amount * bps + 5000) // 10000
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+crypt_demo_v0 のコア（注文受付・取消・販売所・板・約定履歴）を HTTP / WebSocket で公開する
+ヘッドレスのゲートウェイ（標準ライブラリの asyncio だけで動く）。
+
+Streamlit のフォームは1回の操作ごとにスクリプト全体を再実行するので、プログラムからの
+発注や負荷試験には向かない。ゲートウェイは1本のイベントループで多数の接続を受け、
+同時に届いた注文を OrderBatcher でまとめて書き込みワーカーに渡す（1バッチ = 1トランザクション）。
+販売所の依頼は DealerEngine、取消は書き込みワーカーにそのまま積む。DB の読み取りは
+スレッドプールで行い、イベントループを止めない。
+
+板はプロセスのメモリにあるので、同じ DB を別プロセスの Streamlit と同時に使わないこと。
+画面と一緒に使うときは SIMDEX_GATEWAY_PORT を設定して streamlit run すると、
+crypt_demo_v0 が同じプロセスの中でゲートウェイを起動する。単体なら:
+
+    python gateway.py --db simdex.db --port 8765
+
+    POST   /signup    {"username", "password"}         -> {"uid", "token"}
+    POST   /login     {"username", "password"}         -> {"uid", "token"}
+    GET    /wallet                                     -> {"mock", "y"}
+    POST   /orders    {"side", "price", "qty"}         -> {"order_id", "fills"}
+    GET    /orders                                     -> 自分の未約定の注文
+    DELETE /orders/<id>                                -> {"cancelled"}
+    POST   /dealer    {"side", "qty"}                  -> {"ok", "message"}
+    GET    /price, /book?levels=10, /trades?venue=exchange&limit=50
+    GET    /metrics                                    -> Prometheus テキスト（SIMDEX_METRICS=1 のとき）
+    GET    /stream    (WebSocket)                      -> 市場が動くたびに価格・板・直近の約定を JSON で送る
+
+認証は /login で受け取ったトークンを Authorization: Bearer <token> で送る。
+金額・数量は画面と同じく Mock / Y の小数で受け渡す。
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import secrets
+import sqlite3
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+from fixedpoint import to_mock, to_lots, mock_value, y_value
+from worker import Worker
+
+GATEWAY_HOST = "127.0.0.1"
+GATEWAY_PORT = 8765
+MAX_BODY = 64 * 1024       # リクエスト本文の上限（バイト）
+MAX_BATCH = 256            # 1トランザクションにまとめる注文数の上限
+MAX_PRICE = 1e9            # Mock（整数単位で int64 に収まる範囲に抑える）
+MAX_QTY = 1e9              # Y
+STREAM_INTERVAL = 0.25     # 秒（市場データの変化を調べる間隔）
+STREAM_LEVELS = 10         # /stream で送る板の段数
+STREAM_TRADES = 20         # /stream で送る直近の約定数
+STREAM_QUEUE = 8           # 遅いクライアントに溜める上限（超えたら古いものを捨てる）
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+           405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status:int, message:str):
+        super().__init__(message)
+        self.status = status
+
+
+class OrderBatcher:
+    """イベントループ側で注文をまとめる。書き込み中のバッチが無ければすぐに出し、
+    あればその間に届いた分を次のバッチにする（負荷が高いほど大きなバッチになる）"""
+    def __init__(self, worker:Worker, execute:Callable[[list],list], max_batch:int=MAX_BATCH):
+        self.worker = worker
+        self.execute = execute
+        self.max_batch = max_batch
+        self._pending: List[Tuple[tuple,asyncio.Future]] = []
+        self._busy = False
+
+    async def submit(self, *req):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((req, fut))
+        if not self._busy:
+            self._kick()
+        return await fut
+
+    def _kick(self):
+        batch = self._pending[:self.max_batch]
+        del self._pending[:self.max_batch]
+        self._busy = True
+        done = asyncio.wrap_future(self.worker.submit(self.execute, [req for req, _ in batch]))
+        done.add_done_callback(lambda f: self._done(batch, f))
+
+    def _done(self, batch:list, f:asyncio.Future):
+        self._busy = False
+        err = f.exception()
+        for i, (_, fut) in enumerate(batch):
+            if fut.done():
+                continue
+            res = err if err is not None else f.result()[i]
+            if isinstance(res, BaseException): fut.set_exception(res)   # その注文だけが失敗
+            else: fut.set_result(res)
+        if self._pending:
+            self._kick()
+
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method:str, path:str, query:dict, headers:dict, body:bytes):
+        self.method, self.path, self.query, self.headers, self.body = method, path, query, headers, body
+
+    def json(self)->dict:
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "JSON を読めません")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "JSON オブジェクトを送ってください")
+        return data
+
+    def arg(self, name:str, default:str)->str:
+        return self.query.get(name, [default])[0]
+
+    def int_arg(self, name:str, default:int, hi:int)->int:
+        try:
+            v = int(self.arg(name, str(default)))
+        except ValueError:
+            raise HTTPError(400, f"{name} は整数で指定してください")
+        return max(1, min(v, hi))
+
+
+def _number(data:dict, key:str, hi:float)->float:
+    v = data.get(key)
+    if isinstance(v, bool) or not isinstance(v, (int, float)) or not 0 < v <= hi:
+        raise HTTPError(400, f"{key} は 0 より大きく {hi:g} 以下の数で指定してください")
+    return float(v)
+
+def _side(data:dict)->str:
+    side = data.get("side")
+    if side not in ("buy", "sell"):
+        raise HTTPError(400, "side は buy / sell のどちらか")
+    return side
+
+
+# ---------------------- WebSocket ----------------------
+def ws_accept(key:str)->str:
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+def ws_frame(payload:bytes, opcode:int=0x1)->bytes:
+    """サーバーから送るフレーム（マスクなし・分割なし）"""
+    n = len(payload)
+    if n < 126:
+        head = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 1 << 16:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return head + payload
+
+async def ws_read(reader:asyncio.StreamReader)->Tuple[int,bytes]:
+    """クライアントのフレームを1つ読む（マスクを外して (opcode, payload) を返す）"""
+    b0, b1 = await reader.readexactly(2)
+    n = b1 & 0x7F
+    if n == 126:
+        n = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif n == 127:
+        n = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if n > MAX_BODY:
+        raise ConnectionError("frame too large")
+    mask = await reader.readexactly(4) if b1 & 0x80 else b"\0\0\0\0"
+    data = await reader.readexactly(n)
+    return b0 & 0x0F, bytes(c ^ mask[i % 4] for i, c in enumerate(data))
+
+
+# ---------------------- ゲートウェイ ----------------------
+class Gateway:
+    def __init__(self, core):
+        """core は crypt_demo_v0 モジュール（streamlit run では __main__ なので呼び出し側から渡す）"""
+        self.core = core
+        self.tokens: Dict[str, int] = {}   # token -> user_id（プロセスのメモリだけに持つ）
+        self.orders = OrderBatcher(core.get_matcher(), core.place_orders)
+        self.streams: set = set()           # 購読中のクライアントのキュー
+        self._market: Optional[bytes] = None
+        # (メソッド, パスの先頭) -> (ハンドラ, 後ろに続くパス要素の数)
+        self.routes = {
+            ("POST", "signup"): (self.signup, 0), ("POST", "login"): (self.login, 0),
+            ("GET", "wallet"): (self.wallet, 0), ("GET", "price"): (self.price, 0),
+            ("GET", "book"): (self.book, 0), ("GET", "trades"): (self.trades, 0),
+            ("GET", "orders"): (self.open_orders, 0), ("POST", "orders"): (self.place, 0),
+            ("DELETE", "orders"): (self.cancel, 1), ("POST", "dealer"): (self.dealer, 0),
+            ("GET", "metrics"): (self.prometheus, 0),
+        }
+
+    async def serve(self, host:str=GATEWAY_HOST, port:int=GATEWAY_PORT):
+        server = await asyncio.start_server(self._client, host, port)
+        asyncio.create_task(self._broadcast())
+        async with server:
+            await server.serve_forever()
+
+    def _uid(self, req:Request)->int:
+        auth = req.headers.get("authorization", "")
+        uid = self.tokens.get(auth[7:]) if auth.startswith("Bearer ") else None
+        if uid is None:
+            raise HTTPError(401, "ログインしてください")
+        return uid
+
+    # ---- HTTP ----
+    async def _client(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                url = urlsplit(target)
+                if url.path == "/stream" and headers.get("upgrade", "").lower() == "websocket":
+                    await self._stream(reader, writer, headers)
+                    return
+                n = int(headers.get("content-length") or 0)
+                if n > MAX_BODY:
+                    writer.write(self._response(413, {"error": REASONS[413]}, False))
+                    break
+                body = await reader.readexactly(n) if n else b""
+                keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                status, payload = await self._dispatch(Request(method, url.path, parse_qs(url.query), headers, body))
+                writer.write(self._response(status, payload, keep))
+                await writer.drain()
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, req:Request):
+        parts = req.path.strip("/").split("/")
+        route = self.routes.get((req.method, parts[0]))
+        if route is None or len(parts) != route[1] + 1:
+            known = route is not None or any(p == parts[0] for _, p in self.routes)
+            status = 405 if known and route is None else 404
+            return status, {"error": REASONS[status]}
+        try:
+            with metrics.timer(f"gateway_{req.method.lower()}_{parts[0]}"):
+                return 200, await route[0](req, *parts[1:])
+        except HTTPError as e:
+            return e.status, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    @staticmethod
+    def _response(status:int, payload, keep:bool)->bytes:
+        if isinstance(payload, str):
+            body, ctype = payload.encode(), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, ctype = json.dumps(payload, ensure_ascii=False).encode(), "application/json; charset=utf-8"
+        head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n")
+        return head.encode() + body
+
+    # ---- ユーザー ----
+    async def signup(self, req:Request):
+        data = req.json()
+        username, password = data.get("username"), data.get("password")
+        if not isinstance(username, str) or not isinstance(password, str) or not username or not password:
+            raise HTTPError(400, "ユーザー名とパスワードを入力してください")
+        if await asyncio.to_thread(self.core.get_user_by_name, username):
+            raise HTTPError(409, "そのユーザー名は既に存在します")
+        try:
+            uid = await asyncio.to_thread(self.core.create_user, username, password)
+        except sqlite3.IntegrityError:   # 同時に同じ名前で登録された
+            raise HTTPError(409, "そのユーザー名は既に存在します")
+        return self._session(uid)
+
+    async def login(self, req:Request):
+        data = req.json()
+        uid = await asyncio.to_thread(self.core.check_password, str(data.get("username", "")), str(data.get("password", "")))
+        if not uid:
+            raise HTTPError(401, "ユーザー名またはパスワードが違います")
+        return self._session(uid)
+
+    def _session(self, uid:int)->dict:
+        token = secrets.token_urlsafe(24)
+        self.tokens[token] = uid
+        return {"uid": uid, "token": token}
+
+    async def wallet(self, req:Request):
+        m, y = await asyncio.to_thread(self.core.get_wallet, self._uid(req))
+        return {"mock": mock_value(m), "y": y_value(y)}
+
+    # ---- 市場データ ----
+    async def price(self, req:Request):
+        return {"price": mock_value(await asyncio.to_thread(self.core.get_price))}
+
+    async def book(self, req:Request):
+        # 板のロックは書き込みワーカーがトランザクションの間持つので、イベントループでは取らない
+        return await asyncio.to_thread(self._book, req.int_arg("levels", STREAM_LEVELS, 1000))
+
+    def _book(self, levels:int)->dict:
+        """板の上位 levels 段（板のロックを取るのでスレッドプールで実行する）"""
+        book = self.core.get_book()
+        spread = book.spread()
+        return {
+            "spread": None if spread is None else mock_value(spread),
+            "buy": [[mock_value(p), y_value(q), n] for p, q, n in book.depth("buy", levels)],
+            "sell": [[mock_value(p), y_value(q), n] for p, q, n in book.depth("sell", levels)],
+        }
+
+    async def trades(self, req:Request):
+        venue = req.arg("venue", "") or None
+        rows = await asyncio.to_thread(self.core.list_trades, venue, req.int_arg("limit", 50, 1000))
+        return {"trades": [_trade(r) for r in rows]}
+
+    async def prometheus(self, req:Request):
+        if not metrics.ENABLED:
+            raise HTTPError(404, "SIMDEX_METRICS=1 で起動すると計測します")
+        return metrics.prometheus_text()
+
+    # ---- 注文 ----
+    async def open_orders(self, req:Request):
+        uid = self._uid(req)
+        mine = await asyncio.to_thread(lambda: self.core.get_book().user_orders(uid))
+        return {"orders": [{"order_id": o[0], "side": o[2], "price": mock_value(o[3]), "qty": y_value(o[4]), "ts": o[5]}
+                           for o in mine]}
+
+    async def place(self, req:Request):
+        uid = self._uid(req)
+        data = req.json()
+        side = _side(data)
+        price, qty = to_mock(_number(data, "price", MAX_PRICE)), to_lots(_number(data, "qty", MAX_QTY))
+        if price <= 0 or qty <= 0:
+            raise HTTPError(400, "価格・数量が小さすぎます")
+        order_id, fills = await self.orders.submit(uid, side, price, qty)
+        return {"order_id": order_id, "fills": fills}
+
+    async def cancel(self, req:Request, order_id:str):
+        uid = self._uid(req)
+        if not order_id.isdigit():
+            raise HTTPError(404, REASONS[404])
+        ok = await asyncio.wrap_future(self.core.get_matcher().submit(self.core.cancel_order, uid, int(order_id)))
+        if not ok:
+            raise HTTPError(404, "取り消せる注文がありません")
+        return {"cancelled": int(order_id)}
+
+    async def dealer(self, req:Request):
+        uid = self._uid(req)
+        data = req.json()
+        side = _side(data)
+        qty = to_lots(_number(data, "qty", MAX_QTY))
+        if qty <= 0:
+            raise HTTPError(400, "数量が小さすぎます")
+        ok, msg = await asyncio.wrap_future(self.core.get_dealer().submit(uid, side, qty))
+        return {"ok": ok, "message": msg}
+
+    # ---- /stream ----
+    def _snapshot(self)->bytes:
+        """価格・板・直近の約定（スレッドプールで実行する）"""
+        msg = {"type": "market", "ts": time.time(), "price": mock_value(self.core.get_price()),
+               **self._book(STREAM_LEVELS),
+               "trades": [_trade(r) for r in self.core.list_trades(None, STREAM_TRADES)]}
+        return ws_frame(json.dumps(msg, ensure_ascii=False).encode())
+
+    async def _broadcast(self):
+        """市場バージョンが変わったら全購読者に1回だけ作ったメッセージを配る"""
+        seen = None
+        while True:
+            await asyncio.sleep(STREAM_INTERVAL)
+            if not self.streams:
+                continue
+            versions = tuple(self.core.market_version(t) for t in self.core.MARKET_TOPICS)
+            if versions == seen:
+                continue
+            seen = versions
+            self._market = await asyncio.to_thread(self._snapshot)
+            for q in list(self.streams):
+                _offer(q, self._market)
+
+    async def _stream(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter, headers:dict):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            writer.write(self._response(400, {"error": "Sec-WebSocket-Key がありません"}, False))
+            return
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {ws_accept(key)}\r\n\r\n").encode())
+        q: asyncio.Queue = asyncio.Queue(STREAM_QUEUE)
+
+        async def recv():
+            # 受け取るのは ping と close だけ（close はそのまま返して終わる）
+            while True:
+                op, data = await ws_read(reader)
+                if op == 0x8:
+                    _offer(q, ws_frame(data[:2], 0x8))
+                    return
+                if op == 0x9:
+                    _offer(q, ws_frame(data, 0xA))
+
+        def closed(t:asyncio.Task):
+            # close フレームなしで切断されても（読み取りが例外で終わっても）送信側を止める
+            if not t.cancelled():
+                t.exception()
+            _offer(q, None)
+
+        task = None
+        try:
+            # 購読者がいない間は配信を止めているので、最初の1人には作り直して送る
+            q.put_nowait(self._market if self.streams and self._market else await asyncio.to_thread(self._snapshot))
+            self.streams.add(q)
+            task = asyncio.create_task(recv())
+            task.add_done_callback(closed)
+            while True:
+                frame = await q.get()
+                if frame is None:
+                    break
+                writer.write(frame)
+                await writer.drain()
+        finally:
+            self.streams.discard(q)
+            if task is not None:
+                task.cancel()
+
+
+def _trade(r:tuple)->dict:
+    """list_trades の行 (ts,venue,buyer_id,seller_id,price,qty,fee_bps)"""
+    return {"ts": r[0], "venue": r[1], "buyer_id": r[2], "seller_id": r[3],
+            "price": mock_value(r[4]), "qty": y_value(r[5]), "fee_bps": r[6]}
+
+def _offer(q:asyncio.Queue, item):
+    """キューが一杯なら一番古いものを捨てて入れる（遅いクライアントで配信を止めない）"""
+    if q.full():
+        q.get_nowait()
+    q.put_nowait(item)
+
+
+def start_in_thread(core, host:str=GATEWAY_HOST, port:int=GATEWAY_PORT)->threading.Thread:
+    """別スレッドのイベントループでゲートウェイを動かす（Streamlit のプロセスに同居させる用）"""
+    gw = Gateway(core)
+    t = threading.Thread(target=asyncio.run, args=(gw.serve(host, port),), name=f"gateway:{port}", daemon=True)
+    t.start()
+    return t
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--db", default="simdex.db")
+    ap.add_argument("--host", default=GATEWAY_HOST)
+    ap.add_argument("--port", type=int, default=GATEWAY_PORT)
+    args = ap.parse_args()
+
+    import crypt_demo_v0 as core
+    core.DB = args.db
+    core.ensure_db()
+    print(f"gateway: http://{args.host}:{args.port} (db {args.db})")
+    try:
+        asyncio.run(Gateway(core).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+JSON 版アプリ（crypt_demo_v1 / v2）用の追記専用ジャーナル。
+
+状態の変更は1件1行のコンパクトな JSON イベントとして <DATA_FILE>.log に追記し、
+イベントが SNAPSHOT_EVERY 件たまったら状態全体を DATA_FILE に書き出して
+ログを空にする（スナップショットは従来の DATA_FILE と同じ形式 + "_seq"）。
+起動時はスナップショット + ログの残りから状態を組み立て、以後はメモリ上に持つ。
+状態に JSON にできないオブジェクト（to_json() を持つもの）を入れる場合は、
+読み込み時に元に戻す decode を渡す。別のイベント体系を使う場合は apply を渡す
+（storage.JournalStorage）。
+
+イベント（"t" が種類、"seq" は追記時に振る通し番号）:
+    user       {"name", "rec"}        ユーザー登録
+    wallet     {"user", "w"}          ウォレット残高の上書き
+    order      {"o"}                  注文の追加（id は適用時に採番）
+    order_amt  {"id", "amount"}       注文残数量の更新（0 以下で板から外す）
+    tx         {"tx"}                 取引履歴の追加
+    price      {"p"}                  現在価格（v1）
+    tick       {"tick"}               価格履歴の追加（v2。price_history.append に渡す）
+    clear      {}                     取引履歴と板の全削除（Host）
+"""
+
+import json
+import os
+import threading
+from typing import Callable, Optional
+
+SNAPSHOT_EVERY = 1000
+
+
+class _Orders(list):
+    """exchange_orders のリスト（JSON にはそのままリストとして書ける）に id -> 注文の索引を付けたもの。
+    残数量が 0 以下になった注文はすぐには詰めず、半分を超えたら（とスナップショットの前に）
+    まとめて取り除く。順序とリストの同一性は保つ（matching.Book が末尾から新しい注文を読む）"""
+
+    def __init__(self, orders=()):
+        super().__init__(orders)
+        self.by_id = {o["id"]: o for o in self if o["amount"] > 0}
+        self.dead = len(self) - len(self.by_id)
+
+    def append(self, o:dict):
+        super().append(o)
+        self.by_id[o["id"]] = o
+
+    def set_amount(self, oid:int, amount):
+        o = self.by_id.get(oid)
+        if o is None:
+            return
+        o["amount"] = amount
+        if amount <= 0:
+            del self.by_id[oid]
+            self.dead += 1
+            if self.dead * 2 > len(self):
+                self.compact()
+
+    def compact(self):
+        if self.dead:
+            self[:] = [o for o in self if o["amount"] > 0]
+            self.dead = 0
+
+
+def _orders(data:dict)->_Orders:
+    orders = data["exchange_orders"]
+    if not isinstance(orders, _Orders):
+        orders = data["exchange_orders"] = _Orders(orders)
+    return orders
+
+
+def _index_orders(data:dict):
+    """id のない旧形式の注文に id を振り、索引付きのリストにする"""
+    next_id = data.get("next_order_id", 1)
+    for o in data.get("exchange_orders", []):
+        if "id" not in o:
+            o["id"] = next_id
+        next_id = max(next_id, o["id"] + 1)
+    data["next_order_id"] = next_id
+    if "exchange_orders" in data:
+        _orders(data)
+
+
+def _encode(o):
+    return o.to_json()
+
+
+def apply_event(data:dict, ev:dict):
+    t = ev["t"]
+    if t == "user":
+        data["users"][ev["name"]] = ev["rec"]
+    elif t == "wallet":
+        data["users"][ev["user"]]["wallet"].update(ev["w"])
+    elif t == "order":
+        o = dict(ev["o"], id=data["next_order_id"])
+        data["next_order_id"] += 1
+        if o["amount"] > 0:
+            _orders(data).append(o)
+    elif t == "order_amt":
+        _orders(data).set_amount(ev["id"], ev["amount"])
+    elif t == "tx":
+        data["transactions"].append(ev["tx"])
+    elif t == "price":
+        data["price"] = ev["p"]
+    elif t == "tick":
+        data["price_history"].append(ev["tick"])
+    elif t == "clear":
+        data["transactions"] = []
+        data["exchange_orders"] = _Orders()
+    else:
+        raise ValueError(f"unknown event: {t}")
+
+
+class Journal:
+    def __init__(self, path:str, default:Callable[[], dict], snapshot_every:int=SNAPSHOT_EVERY,
+                 decode:Optional[Callable[[dict], None]]=None,
+                 apply:Callable[[dict, dict], None]=apply_event):
+        self.path = path
+        self.apply = apply
+        self.log_path = path + ".log"
+        self.snapshot_every = snapshot_every
+        self.lock = threading.RLock()
+        self.data, self.seq, self.pending, torn = self._recover(default, decode)
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        if self.pending or torn:
+            self.snapshot()   # 起動時に畳んでおく（途中で切れた末尾行もここで消える）
+
+    def _recover(self, default, decode):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        else:
+            data = default()
+        seq = data.pop("_seq", 0)
+        _index_orders(data)
+        if decode:
+            decode(data)
+        pending = 0; torn = False
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        ev = json.loads(line)
+                    except json.JSONDecodeError:
+                        torn = True
+                        break   # 書き込み途中で落ちた末尾の行
+                    if ev["seq"] <= seq:
+                        continue   # スナップショットに含まれている
+                    self.apply(data, ev)
+                    seq = ev["seq"]; pending += 1
+        return data, seq, pending, torn
+
+    def append(self, *events:dict):
+        """イベントを状態に適用し、ログに追記する（1回の write と flush）"""
+        with self.lock:
+            lines = []
+            for ev in events:
+                self.seq += 1
+                ev = dict(ev, seq=self.seq)
+                self.apply(self.data, ev)
+                lines.append(json.dumps(ev, ensure_ascii=False, separators=(",", ":")))
+            self._log.write("\n".join(lines) + "\n")
+            self._log.flush()
+            self.pending += len(events)
+            if self.pending >= self.snapshot_every:
+                self.snapshot()
+
+    def snapshot(self):
+        """状態全体を書き出してログを空にする"""
+        with self.lock:
+            orders = self.data.get("exchange_orders")
+            if isinstance(orders, _Orders):
+                orders.compact()
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(dict(self.data, _seq=self.seq), f, separators=(",", ":"), default=_encode)
+            os.replace(tmp, self.path)
+            # ここで落ちてもログのイベントは seq で読み飛ばされる
+            self._log.close()
+            self._log = open(self.log_path, "w", encoding="utf-8")
+            self.pending = 0
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+複式簿記の元帳（SQLite の残高変更の記録。crypt_demo_v0 と storage.SQLiteStorage が書く）。
+
+残高の変更はすべて ledger テーブルへの追記（勘定・資産・増減）として記録し、
+wallets はその結果をユーザーごとに持つ実体化ビューとして同じトランザクションで更新する。
+1回の仕訳（約定1件・販売所の売買1件など）は資産ごとに増減の合計が 0 になる。
+相手がユーザーでない分はシステム勘定に付ける。
+
+    ISSUER   初期配布・残高の直接修正（set_wallet）・移行時の開始残高の相手
+    DEALER   販売所の在庫（Mock / Y）
+    FEE      手数料収入
+
+ledger は追記のみ（UPDATE / DELETE はトリガーで拒否）。LEDGER_CHECKPOINT_EVERY 件ごとに
+全勘定の残高をチェックポイントとして保存するので、監査（audit）と作り直し（rebuild）は
+直近のチェックポイント以降の仕訳だけを GROUP BY で集計すればよい。
+
+    python ledger.py audit simdex.db
+"""
+
+import argparse
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from fixedpoint import notional
+
+ISSUER, DEALER, FEE = -1, -2, -3   # システム勘定（user_id と重ならない負の番号）
+MOCK, Y = 0, 1                      # 資産（1e-6 Mock / 1e-6 Y）
+ACCOUNT_NAMES = {ISSUER: "ISSUER", DEALER: "DEALER", FEE: "FEE"}
+LEDGER_CHECKPOINT_EVERY = 10000     # 仕訳の行数
+
+def dealer_legs(uid:int, side:str, amount:int, qty:int, fee:int)->list:
+    """販売所の売買1件の仕訳（amount は約定代金、手数料はユーザー負担）"""
+    if side == 'buy':
+        return [(uid, MOCK, -(amount + fee)), (DEALER, MOCK, amount), (FEE, MOCK, fee),
+                (uid, Y, qty), (DEALER, Y, -qty)]
+    return [(uid, MOCK, amount - fee), (DEALER, MOCK, -amount), (FEE, MOCK, fee),
+            (uid, Y, -qty), (DEALER, Y, qty)]
+
+def fill_legs(buyer:int, seller:int, amount:int, qty:int, fee_buyer:int, fee_seller:int)->list:
+    """取引所の約定1件の仕訳"""
+    return [(buyer, MOCK, -(amount + fee_buyer)), (seller, MOCK, amount - fee_seller),
+            (FEE, MOCK, fee_buyer + fee_seller), (buyer, Y, qty), (seller, Y, -qty)]
+
+def trade_legs(t:tuple)->Tuple[str,list]:
+    """trades の行 (ts, venue, buyer, seller, price, qty, fee_bps, fee_buyer, fee_seller) の (kind, 仕訳)"""
+    amount = notional(t[4], t[5])
+    if t[1] == 'exchange':
+        return 'fill', fill_legs(t[2], t[3], amount, t[5], t[7], t[8])
+    if t[2] is not None:
+        return 'dealer', dealer_legs(t[2], 'buy', amount, t[5], t[7])
+    return 'dealer', dealer_legs(t[3], 'sell', amount, t[5], t[8])
+
+def inserted_ids(cur, n:int)->range:
+    """直前の executemany で挿入した n 行の rowid（書き込みトランザクション内なので連番）"""
+    last = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+    return range(last - n + 1, last + 1)
+
+def post_trades(cur, trades:list):
+    """直前に挿入した trades の行（同じ順）を元帳に仕訳する"""
+    p = Postings(int(time.time()))
+    for tid, t in zip(inserted_ids(cur, len(trades)), trades):
+        kind, legs = trade_legs(t)
+        p.post(kind, tid, legs)
+    p.write(cur)
+
+def create_ledger_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ledger(
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        kind TEXT NOT NULL,        -- 'signup' / 'adjust' / 'opening' / 'dealer' / 'fill'
+        ref INTEGER,               -- trades.id（約定の仕訳）
+        account INTEGER NOT NULL,  -- user_id、またはシステム勘定（負）
+        asset INTEGER NOT NULL,    -- MOCK / Y
+        delta INTEGER NOT NULL
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ledger_checkpoints(
+        id INTEGER PRIMARY KEY,
+        ledger_id INTEGER NOT NULL,   -- この id までの仕訳を含む
+        ts INTEGER NOT NULL
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ledger_balances(
+        checkpoint_id INTEGER,
+        account INTEGER,
+        asset INTEGER,
+        balance INTEGER NOT NULL,
+        PRIMARY KEY(checkpoint_id, account, asset)
+    ) WITHOUT ROWID;""")
+    for op in ("UPDATE", "DELETE"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS ledger_no_{op.lower()} BEFORE {op} ON ledger
+        BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END;""")
+
+
+class Postings:
+    """1トランザクション分の仕訳をためて、write() でまとめて追記する"""
+
+    def __init__(self, ts:int):
+        self.ts = ts
+        self.rows = []
+
+    def post(self, kind:str, ref, legs:Iterable[Tuple[int,int,int]]):
+        """(勘定, 資産, 増減) の組を1つの仕訳として積む（資産ごとの合計は 0 でなければならない）"""
+        legs = [(a, s, d) for a, s, d in legs if d]
+        total = {}
+        for _, s, d in legs:
+            total[s] = total.get(s, 0) + d
+        if any(total.values()):
+            raise ValueError(f"unbalanced posting ({kind}): {legs}")
+        self.rows += [(self.ts, kind, ref, a, s, d) for a, s, d in legs]
+
+    def write(self, cur):
+        if self.rows:
+            cur.executemany("INSERT INTO ledger(ts,kind,ref,account,asset,delta) VALUES(?,?,?,?,?,?)", self.rows)
+            maybe_checkpoint(cur, self.ts)
+
+
+# ---------------------- チェックポイント・監査 ----------------------
+def last_checkpoint(cur)->Tuple[int,int]:
+    """(checkpoint_id, ledger_id)。まだ無ければ (0, 0)"""
+    r = cur.execute("SELECT id, ledger_id FROM ledger_checkpoints ORDER BY id DESC LIMIT 1").fetchone()
+    return (r[0], r[1]) if r else (0, 0)
+
+def balances(cur)->Tuple[Dict[Tuple[int,int],int],int]:
+    """全勘定の残高 {(勘定, 資産): 残高} と、含む最後の仕訳 id。
+    直近のチェックポイントに、それ以降の仕訳の合計を足す"""
+    cp, since = last_checkpoint(cur)
+    bal = {(a, s): b for a, s, b in
+           cur.execute("SELECT account, asset, balance FROM ledger_balances WHERE checkpoint_id=?", (cp,))}
+    upto = since
+    for a, s, d, last in cur.execute("""SELECT account, asset, SUM(delta), MAX(id) FROM ledger
+                                        WHERE id>? GROUP BY account, asset""", (since,)).fetchall():
+        bal[(a, s)] = bal.get((a, s), 0) + d
+        upto = max(upto, last)
+    return bal, upto
+
+def checkpoint(cur, ts:int)->int:
+    """現在の残高をチェックポイントとして保存し、その id を返す"""
+    bal, upto = balances(cur)
+    cp = cur.execute("INSERT INTO ledger_checkpoints(ledger_id, ts) VALUES(?,?)", (upto, ts)).lastrowid
+    cur.executemany("INSERT INTO ledger_balances(checkpoint_id, account, asset, balance) VALUES(?,?,?,?)",
+                    [(cp, a, s, b) for (a, s), b in bal.items() if b])
+    return cp
+
+def maybe_checkpoint(cur, ts:int, every:int=LEDGER_CHECKPOINT_EVERY):
+    """前回のチェックポイントから every 行以上たまっていればチェックポイントを取る"""
+    _, since = last_checkpoint(cur)
+    last = cur.execute("SELECT MAX(id) FROM ledger").fetchone()[0] or 0
+    if last - since >= every:
+        checkpoint(cur, ts)
+
+def post_opening(cur, ts:int):
+    """wallets の現在の残高を開始残高として ISSUER から仕訳する（元帳導入時の移行）"""
+    p = Postings(ts)
+    for uid, m, y in cur.execute("SELECT user_id, mock, y FROM wallets").fetchall():
+        p.post('opening', None, [(uid, MOCK, m), (ISSUER, MOCK, -m), (uid, Y, y), (ISSUER, Y, -y)])
+    p.write(cur)
+    checkpoint(cur, ts)
+
+def audit(cur)->List[tuple]:
+    """元帳と wallets の食い違いを返す（空なら整合）。
+    (user_id, 元帳の mock, y, wallets の mock, y) と、資産ごとの合計が 0 でなければ ('total', 資産, 合計)"""
+    bal, _ = balances(cur)
+    bad = []
+    for s in (MOCK, Y):
+        total = sum(b for (_, a), b in bal.items() if a == s)
+        if total:
+            bad.append(('total', s, total))
+    seen = set()
+    for uid, m, y in cur.execute("SELECT user_id, mock, y FROM wallets").fetchall():
+        seen.add(uid)
+        lm, ly = bal.get((uid, MOCK), 0), bal.get((uid, Y), 0)
+        if (lm, ly) != (m, y):
+            bad.append((uid, lm, ly, m, y))
+    for (a, s), b in bal.items():
+        if a > 0 and a not in seen and b:
+            bad.append((a, bal.get((a, MOCK), 0), bal.get((a, Y), 0), None, None))
+            seen.add(a)
+    return bad
+
+def rebuild(cur)->int:
+    """wallets を元帳の残高で作り直し、書き換えた行数を返す"""
+    bal, _ = balances(cur)
+    rows = [(bal.get((uid, MOCK), 0), bal.get((uid, Y), 0), uid)
+            for (uid,) in cur.execute("SELECT user_id FROM wallets").fetchall()]
+    cur.executemany("UPDATE wallets SET mock=?, y=? WHERE user_id=?", rows)
+    return len(rows)
+
+def system_balances(cur)->Dict[str,Tuple[int,int]]:
+    """システム勘定の (mock, y)"""
+    bal, _ = balances(cur)
+    return {name: (bal.get((a, MOCK), 0), bal.get((a, Y), 0)) for a, name in ACCOUNT_NAMES.items()}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("command", choices=("audit", "rebuild", "checkpoint"))
+    ap.add_argument("db", nargs="?", default="simdex.db")
+    args = ap.parse_args()
+
+    con = sqlite3.connect(args.db, isolation_level=None)
+    cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    t = time.perf_counter()
+    try:
+        if args.command == "audit":
+            bad = audit(cur)
+            for r in bad:
+                print("MISMATCH", r)
+            print(f"audit: {'OK' if not bad else f'{len(bad)} mismatches'} ({(time.perf_counter() - t) * 1e3:.1f} ms)")
+            for name, (m, y) in system_balances(cur).items():
+                print(f"  {name:<7} mock {m:>18} y {y:>18}")
+        elif args.command == "rebuild":
+            print(f"rebuild: {rebuild(cur)} wallets")
+        else:
+            print(f"checkpoint: {checkpoint(cur, int(time.time()))}")
+        cur.execute("COMMIT")
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+JSON 版アプリ（crypt_demo_v1 / v2）共通のマッチングエンジン。
+
+買い・売りの注文を価格優先・時間優先（注文 id 順）でソートして持ち、
+最良気配どうしが交差しなくなったところで打ち切る。
+板に変化（新規注文）がなければ何もしない。約定はまとめて返し、
+ジャーナルのイベントとして一括で追記する。
+注文の登録とマッチングは worker.Worker のスレッドで place_order を実行して直列化する。
+販売所の売買（dealer_trade）も同じワーカーで実行し、残高の読み書きを1本にまとめる。
+価格ごとの数量合計・注文数（板情報）も注文の取り込みと約定のたびに差分で更新する。
+
+約定価格は従来どおり買い値と売り値の中間、手数料は双方 0.5%。
+"""
+
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+from datetime import datetime
+from itertools import accumulate
+from typing import Callable, Iterable, List, Optional, Tuple
+
+EX_FEE_RATE = 0.005
+DEALER_FEE_RATE = 0.02
+DEALER_IMPACT = 0.01   # 販売所の1回の売買で価格を動かす割合
+
+Fill = namedtuple("Fill", "buy sell qty price")
+
+
+class Book:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._reset(None)
+
+    def _reset(self, src):
+        self._src = src         # 元の exchange_orders リスト（"clear" で差し替わったら作り直す）
+        self._last_id = 0       # 取り込み済みの最大注文 id
+        self._orders = {}       # id -> 注文 dict（ジャーナルの状態と同じオブジェクト）
+        # 末尾が最良: 買いは (price, -id)、売りは (-price, -id) の昇順
+        self._bids = []
+        self._asks = []
+        self.dirty = False
+        # 板情報: 価格キー（買い price、売り -price）の昇順リストと key -> [数量合計, 注文数]
+        self._keys = {"buy": [], "sell": []}
+        self._depth = {"buy": {}, "sell": {}}
+        self._counted = {}      # id -> 板情報に計上済みの残数量
+
+    def _add(self, o:dict):
+        self._orders[o["id"]] = o
+        if o["type"] == "buy":
+            insort(self._bids, (o["price"], -o["id"]))
+        else:
+            insort(self._asks, (-o["price"], -o["id"]))
+        self._last_id = max(self._last_id, o["id"])
+        self.dirty = True
+        if o["amount"] > 0:
+            self._counted[o["id"]] = o["amount"]
+            self._level(o, o["amount"], 1)
+
+    def _level(self, o:dict, dqty:float, dcount:int):
+        side = o["type"]
+        k = o["price"] if side == "buy" else -o["price"]
+        d = self._depth[side]
+        lv = d.get(k)
+        if lv is None:
+            lv = d[k] = [0, 0]
+            insort(self._keys[side], k)
+        lv[0] += dqty; lv[1] += dcount
+        if lv[1] == 0:
+            del d[k]
+            keys = self._keys[side]
+            del keys[bisect_left(keys, k)]
+
+    def sync(self, orders:Iterable[dict]):
+        """約定で残数量が変わった注文を板情報に反映する"""
+        with self.lock:
+            for o in orders:
+                old = self._counted.get(o["id"])
+                if old is None:
+                    continue
+                if o["amount"] <= 0:
+                    del self._counted[o["id"]]
+                    self._level(o, -old, -1)
+                else:
+                    self._counted[o["id"]] = o["amount"]
+                    self._level(o, o["amount"] - old, 0)
+
+    def refresh(self, orders:list):
+        """exchange_orders の新しい注文を取り込む（末尾から未取り込み分だけ見る）"""
+        with self.lock:
+            if orders is not self._src:
+                self._reset(orders)
+                for o in orders:
+                    self._add(o)
+                return
+            new = []
+            for o in reversed(orders):
+                if o["id"] <= self._last_id:
+                    break
+                new.append(o)
+            for o in reversed(new):
+                self._add(o)
+
+    def _prune(self, side:list):
+        """約定済み・取消済み（amount <= 0）の注文を最良側から外す"""
+        while side and self._orders[-side[-1][1]]["amount"] <= 0:
+            del self._orders[-side.pop()[1]]
+
+    def match(self)->List[Fill]:
+        """交差している分を価格・時間優先で約定させ、約定の一覧を返す（状態は変更しない）"""
+        with self.lock:
+            self._prune(self._bids); self._prune(self._asks)
+            if not self.dirty:
+                return []
+            self.dirty = False
+            fills = []
+            rem = {}
+            bi, ai = len(self._bids) - 1, len(self._asks) - 1
+            while bi >= 0 and ai >= 0:
+                buy = self._orders[-self._bids[bi][1]]
+                sell = self._orders[-self._asks[ai][1]]
+                rb = rem.get(buy["id"], buy["amount"])
+                ra = rem.get(sell["id"], sell["amount"])
+                if rb <= 0: bi -= 1; continue
+                if ra <= 0: ai -= 1; continue
+                if buy["price"] < sell["price"]:
+                    break   # 最良気配が交差しない
+                qty = min(rb, ra)
+                fills.append(Fill(buy, sell, qty, (buy["price"] + sell["price"]) / 2))
+                rem[buy["id"]] = rb - qty
+                rem[sell["id"]] = ra - qty
+            return fills
+
+    # ---- 板情報 ----
+    def best_price(self, side:str)->Optional[float]:
+        with self.lock:
+            keys = self._keys[side]
+            if not keys:
+                return None
+            return keys[-1] if side == "buy" else -keys[-1]
+
+    def spread(self)->Optional[float]:
+        """最良売り - 最良買い（どちらかの板が空なら None）"""
+        with self.lock:
+            b = self.best_price("buy"); s = self.best_price("sell")
+            return None if b is None or s is None else s - b
+
+    def depth(self, side:str, n:int=10)->List[Tuple[float,float,int]]:
+        """最良気配から n 段の (価格, 数量合計, 注文数)"""
+        with self.lock:
+            d = self._depth[side]
+            return [(k if side == "buy" else -k, *d[k]) for k in self._keys[side][:-n-1:-1]]
+
+
+def depth_rows(book:Book, side:str, n:int=10)->List[dict]:
+    """画面表示用の板情報（最良気配から n 段、累計数量つき）"""
+    rows = book.depth(side, n)
+    return [{"価格": p, "数量": round(q, 6), "注文数": c, "累計": round(cum, 6)}
+            for (p, q, c), cum in zip(rows, accumulate(r[1] for r in rows))]
+
+
+def fill_events(data:dict, fills:List[Fill], cash:str)->list:
+    """約定をジャーナルのイベント（取引履歴・ウォレット・注文残数量）に変換する。
+    cash はウォレットの現金キー（v1: "Mock"、v2: "円（Mock）"）"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    wallets = {}
+    amounts = {}
+    events = []
+    for f in fills:
+        fee = f.qty * f.price * EX_FEE_RATE
+        wb = wallets.setdefault(f.buy["user"], dict(data["users"][f.buy["user"]]["wallet"]))
+        ws = wallets.setdefault(f.sell["user"], dict(data["users"][f.sell["user"]]["wallet"]))
+        wb[cash] -= f.qty * f.price + fee
+        wb["Ycoin"] += f.qty
+        ws[cash] += f.qty * f.price - fee
+        ws["Ycoin"] -= f.qty
+        amounts[f.buy["id"]] = amounts.get(f.buy["id"], f.buy["amount"]) - f.qty
+        amounts[f.sell["id"]] = amounts.get(f.sell["id"], f.sell["amount"]) - f.qty
+        events.append({"t": "tx", "tx": {
+            "type": "exchange",
+            "buyer": f.buy["user"],
+            "seller": f.sell["user"],
+            "amount": f.qty,
+            "price": f.price,
+            "time": now,
+            "place": "exchange"
+        }})
+    events += [{"t": "wallet", "user": u, "w": w} for u, w in wallets.items()]
+    events += [{"t": "order_amt", "id": oid, "amount": a} for oid, a in amounts.items()]
+    return events
+
+
+def match_and_settle(journal, book:Book, cash:str)->List[Fill]:
+    """板の変化を取り込んでマッチングし、約定をまとめてジャーナルに追記する"""
+    with journal.lock:
+        book.refresh(journal.data["exchange_orders"])
+        fills = book.match()
+        if fills:
+            journal.append(*fill_events(journal.data, fills, cash))
+            book.sync(o for f in fills for o in (f.buy, f.sell))
+        return fills
+
+
+def dealer_trade(journal, cash:str, user:str, side:str, amount:float,
+                 price:Callable[[dict],float], price_event:Callable[[float],dict])->bool:
+    """販売所の売買（マッチングワーカーで呼ぶ）。残高と価格は journal.lock の中で読み、
+    新しい残高・取引履歴・価格を同じロックの中で追記する。残高不足なら False。
+    price(data) は現在価格、price_event(新価格) は価格更新のイベントを返す（v1 と v2 で形式が違う）"""
+    with journal.lock:
+        data = journal.data
+        w = data["users"][user]["wallet"]
+        p = price(data)
+        if side == "buy":
+            total = amount * p * (1 + DEALER_FEE_RATE)
+            if w[cash] < total:
+                return False
+            new = {cash: w[cash] - total, "Ycoin": w["Ycoin"] + amount}
+            next_price = p * (1 + DEALER_IMPACT)   # 需給による価格上昇
+        else:
+            if w["Ycoin"] < amount:
+                return False
+            new = {cash: w[cash] + amount * p * (1 - DEALER_FEE_RATE), "Ycoin": w["Ycoin"] - amount}
+            next_price = p * (1 - DEALER_IMPACT)   # 需給による価格下落
+        journal.append(
+            {"t": "wallet", "user": user, "w": new},
+            {"t": "tx", "tx": {
+                "type": side,
+                "user": user,
+                "amount": amount,
+                "price": p,
+                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "place": "dealer"
+            }},
+            price_event(next_price),
+        )
+        return True
+
+
+def place_order(journal, book:Book, cash:str, order:dict)->List[Fill]:
+    """注文をジャーナルに追記し、すぐにマッチングして約定の一覧を返す（マッチングワーカーで呼ぶ）"""
+    with journal.lock:
+        journal.append({"t": "order", "o": order})
+        return match_and_settle(journal, book, cash)
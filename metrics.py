@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+ホットパスの計測（カウンタとレイテンシのヒストグラム）。
+
+環境変数 SIMDEX_METRICS=1 のときだけ有効。無効なら timed() は関数をそのまま返し、
+timer() は何もしない共有のコンテキストを返すので、計測のコストはほぼ 0。
+有効なときは関数ごとの呼び出し回数・累計時間・固定バケットのヒストグラムを
+プロセス内に持ち、Prometheus のテキスト形式でファイルに書き出せる。
+
+    @metrics.timed("match_orders")
+    def match_orders(): ...
+
+    with metrics.timer("render"):
+        ...
+    metrics.write_prometheus("simdex.db.metrics.prom")
+
+DB の往復は TimedConnection（sqlite3.connect の factory）で execute / fetch / commit
+ごとに測る。
+"""
+
+import functools
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional
+
+ENABLED = os.environ.get("SIMDEX_METRICS", "") not in ("", "0")
+PREFIX = "simdex"
+
+# ヒストグラムのバケット上限（秒）。SQLite の1文（数十 µs）から画面1回分（数百 ms）まで
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)   # 末尾は +Inf
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self)->int:
+        return sum(self.counts)
+
+    def observe(self, seconds:float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def quantile(self, q:float)->float:
+        """q 分位点（histogram_quantile と同じくバケット内を線形補間。最大値を超えない）"""
+        n = self.count
+        if n == 0: return 0.0
+        rank = q * n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lo = BUCKETS[i - 1] if i > 0 else 0.0
+                hi = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lo + (hi - lo) * (rank - seen) / c, self.max)
+            seen += c
+        return self.max
+
+
+_lock = threading.Lock()
+_hist: Dict[str, Histogram] = {}
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, Callable[[], float]] = {}
+_started = time.time()
+
+
+def observe(name:str, seconds:float):
+    with _lock:
+        h = _hist.get(name)
+        if h is None:
+            h = _hist[name] = Histogram()
+        h.observe(seconds)
+
+def inc(name:str, n:float=1):
+    if not ENABLED: return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def gauge(name:str, fn:Callable[[], float]):
+    """書き出しのたびに fn() を読む値（ワーカーのキュー長など）を登録する"""
+    _gauges[name] = fn
+
+def reset():
+    global _started
+    with _lock:
+        _hist.clear(); _counters.clear()
+        _started = time.time()
+
+
+# ---------------------- 計測 ----------------------
+class _Timer:
+    __slots__ = ("name", "t")
+
+    def __init__(self, name:str):
+        self.name = name
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.t)
+        return False
+
+_NULL = nullcontext()
+
+def timer(name:str):
+    """with ブロックの経過時間を name のヒストグラムに入れる（無効なら何もしない）"""
+    return _Timer(name) if ENABLED else _NULL
+
+def timed(name:Optional[str]=None):
+    """関数の呼び出しを計測するデコレータ。無効なら関数をそのまま返す（ラップしない）"""
+    def deco(fn):
+        if not ENABLED:
+            return fn
+        key = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(key, time.perf_counter() - t)
+        return wrapper
+    return deco
+
+
+class TimedCursor(sqlite3.Cursor):
+    """計った時間は接続の _observe に渡す"""
+    def execute(self, *args):
+        t = time.perf_counter()
+        try: return super().execute(*args)
+        finally: self.connection._observe("db_execute", time.perf_counter() - t)
+
+    def executemany(self, *args):
+        t = time.perf_counter()
+        try: return super().executemany(*args)
+        finally: self.connection._observe("db_executemany", time.perf_counter() - t)
+
+    def fetchone(self):
+        t = time.perf_counter()
+        try: return super().fetchone()
+        finally: self.connection._observe("db_fetch", time.perf_counter() - t)
+
+    def fetchall(self):
+        t = time.perf_counter()
+        try: return super().fetchall()
+        finally: self.connection._observe("db_fetch", time.perf_counter() - t)
+
+class TimedConnection(sqlite3.Connection):
+    """DB の往復（文の実行・読み出し・コミット）を計測する接続クラス。
+    計測値の行き先を変えるときは _observe を上書きする（bench_v0 など）"""
+    def _observe(self, name:str, seconds:float):
+        observe(name, seconds)
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        t = time.perf_counter()
+        try: return super().commit()
+        finally: self._observe("db_commit", time.perf_counter() - t)
+
+
+# ---------------------- 出力 ----------------------
+def summary(per:Optional[str]=None)->List[dict]:
+    """ヒストグラムごとの集計（回数・累計・平均・p50・p99・最大、ms）を累計時間の多い順に返す。
+    per にカウンタ名（例: 'renders'）を渡すと、その1回あたりの呼び出し回数を per に入れる"""
+    with _lock:
+        items = [(k, h.count, h.total, h.quantile(0.5), h.quantile(0.99), h.max) for k, h in _hist.items()]
+        denom = _counters.get(per, 0) if per else 0
+    rows = []
+    for k, n, total, p50, p99, mx in sorted(items, key=lambda r: -r[2]):
+        row = {"name": k, "count": n, "total_ms": total * 1e3, "mean_ms": total / n * 1e3 if n else 0.0,
+               "p50_ms": p50 * 1e3, "p99_ms": p99 * 1e3, "max_ms": mx * 1e3}
+        if per:
+            row["per"] = n / denom if denom else 0.0
+        rows.append(row)
+    return rows
+
+def counters()->Dict[str, float]:
+    with _lock:
+        return dict(_counters)
+
+def _fmt(v:float)->str:
+    return repr(float(v)) if v != float("inf") else "+Inf"
+
+def prometheus_text()->str:
+    """Prometheus のテキスト形式（ヒストグラムは1つのメトリクスに name ラベルでまとめる）"""
+    with _lock:
+        hist = [(k, list(h.counts), h.total) for k, h in sorted(_hist.items())]
+        cnt = sorted(_counters.items())
+    out = []
+    m = f"{PREFIX}_call_duration_seconds"
+    out.append(f"# HELP {m} Duration of instrumented function and DB calls")
+    out.append(f"# TYPE {m} histogram")
+    for k, counts, total in hist:
+        acc = 0
+        for le, c in zip(BUCKETS + (float("inf"),), counts):
+            acc += c
+            out.append(f'{m}_bucket{{name="{k}",le="{_fmt(le)}"}} {acc}')
+        out.append(f'{m}_sum{{name="{k}"}} {_fmt(total)}')
+        out.append(f'{m}_count{{name="{k}"}} {acc}')
+    for k, v in cnt:
+        out.append(f"# TYPE {PREFIX}_{k}_total counter")
+        out.append(f"{PREFIX}_{k}_total {_fmt(v)}")
+    for k, fn in sorted(_gauges.items()):
+        try: v = fn()
+        except Exception: continue
+        out.append(f"# TYPE {PREFIX}_{k} gauge")
+        out.append(f"{PREFIX}_{k} {_fmt(v)}")
+    out.append(f"# TYPE {PREFIX}_metrics_start_time_seconds gauge")
+    out.append(f"{PREFIX}_metrics_start_time_seconds {_fmt(_started)}")
+    return "\n".join(out) + "\n"
+
+def write_prometheus(path:str)->str:
+    """prometheus_text() を path に書き出す（一時ファイル経由で置き換える。node_exporter の textfile 向け）"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+    return path
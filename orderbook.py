@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+取引所の板（価格優先・時間優先）のインメモリ実装。
+
+価格・数量は整数（価格 tick / 数量 lot）。価格レベルは売買それぞれ
+ソート済みの int64 配列で持ち、最良気配が常に末尾に来るようにする
+（買いは price、売りは -price をキーにした昇順）。各レベル内は FIFO キュー。
+注文IDのインデックスを持つので、取消・数量更新は O(1)。ユーザーごとの注文も索引する。
+取消・約定済みの注文はキューから遅延削除する。
+
+価格レベルごとの数量合計と注文数（L2 の板情報）も注文・取消・約定のたびに
+差分で更新する。注文が無くなったレベルはその場で外すので、最良気配と
+スプレッドは O(1)、上位 n 段の板情報は O(n) で返せる。
+"""
+
+import threading
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 注文レコード: [id, user_id, side, price, qty_rem, ts]
+OID, UID, SIDE, PRICE, QTY, TS = range(6)
+
+
+def _key(side:str, price:int)->int:
+    return price if side == 'buy' else -price
+
+_price = _key   # キー -> 価格（符号を戻すだけなので同じ式）
+
+
+class OrderBook:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.orders: Dict[int, list] = {}
+        self._by_user: Dict[int, Dict[int, list]] = {}                # user_id -> {order_id: order}
+        self._levels = {'buy': {}, 'sell': {}}                   # key -> deque[order]
+        self._keys = {'buy': array('q'), 'sell': array('q')}     # 昇順、末尾が最良
+        self._depth = {'buy': {}, 'sell': {}}                    # key -> [数量合計, 注文数]
+
+    def __len__(self):
+        return len(self.orders)
+
+    def load(self, rows:Iterable[tuple]):
+        """(id,user_id,side,price,qty_rem,ts) の行（時刻順）から板を作り直す"""
+        with self.lock:
+            self.orders.clear()
+            self._by_user.clear()
+            for side in ('buy', 'sell'):
+                self._levels[side].clear()
+                del self._keys[side][:]
+                self._depth[side].clear()
+            # 1件ずつ add() するとレベルごとに二分探索の挿入になるので、まとめて作って最後に並べる
+            orders = self.orders; by_user = self._by_user
+            for r in rows:
+                o = list(r)
+                side = o[SIDE]
+                k = _key(side, o[PRICE])
+                orders[o[OID]] = o
+                by_user.setdefault(o[UID], {})[o[OID]] = o
+                lv = self._levels[side].get(k)
+                if lv is None:
+                    lv = self._levels[side][k] = deque()
+                    self._depth[side][k] = [0, 0]
+                lv.append(o)
+                d = self._depth[side][k]
+                d[0] += o[QTY]; d[1] += 1
+            for side in ('buy', 'sell'):
+                self._keys[side].extend(sorted(self._levels[side]))
+
+    def add(self, order_id:int, uid:int, side:str, price:int, qty:int, ts:int)->list:
+        o = [order_id, uid, side, price, qty, ts]
+        k = _key(side, price)
+        with self.lock:
+            self.orders[order_id] = o
+            self._by_user.setdefault(uid, {})[order_id] = o
+            levels = self._levels[side]
+            lv = levels.get(k)
+            if lv is None:
+                lv = levels[k] = deque()
+                self._depth[side][k] = [0, 0]
+                keys = self._keys[side]
+                keys.insert(bisect_left(keys, k), k)
+            lv.append(o)
+            self._level(side, k, qty, 1)
+        return o
+
+    def _level(self, side:str, k:int, dqty:int, dcount:int):
+        """レベル k の数量合計・注文数を差分で更新し、注文が無くなったらレベルごと外す"""
+        d = self._depth[side][k]
+        d[0] += dqty; d[1] += dcount
+        if d[1] == 0:
+            del self._depth[side][k]
+            del self._levels[side][k]
+            keys = self._keys[side]
+            del keys[bisect_left(keys, k)]
+
+    def remove(self, order_id:int)->Optional[list]:
+        with self.lock:
+            o = self.orders.pop(order_id, None)
+            if o is not None:
+                mine = self._by_user[o[UID]]
+                del mine[order_id]
+                if not mine: del self._by_user[o[UID]]
+                self._level(o[SIDE], _key(o[SIDE], o[PRICE]), -o[QTY], -1)
+                o[QTY] = 0   # キューからは best() で遅延削除
+            return o
+
+    def update_qty(self, order_id:int, qty:int):
+        if qty <= 0:
+            self.remove(order_id)
+            return
+        with self.lock:
+            o = self.orders.get(order_id)
+            if o is not None:
+                self._level(o[SIDE], _key(o[SIDE], o[PRICE]), qty - o[QTY], 0)
+                o[QTY] = qty
+
+    def user_orders(self, uid:int)->List[list]:
+        """uid の板に残っている注文（のコピー）を受付順に"""
+        with self.lock:
+            return [o[:] for o in self._by_user.get(uid, {}).values()]
+
+    def best(self, side:str)->Optional[list]:
+        """最良気配の先頭注文（買いは最高値、売りは最安値。同値は先着順）"""
+        keys = self._keys[side]; levels = self._levels[side]
+        with self.lock:
+            while keys:
+                k = keys[-1]
+                lv = levels[k]
+                while lv and lv[0][QTY] <= 0:
+                    lv.popleft()
+                if lv:
+                    return lv[0]
+                del levels[k]
+                keys.pop()
+            return None
+
+    def crossed(self)->bool:
+        b = self.best('buy'); s = self.best('sell')
+        return bool(b and s and b[PRICE] >= s[PRICE])
+
+    # ---- 板情報（L2） ----
+    def best_price(self, side:str)->Optional[int]:
+        keys = self._keys[side]
+        with self.lock:
+            return _price(side, keys[-1]) if keys else None
+
+    def spread(self)->Optional[int]:
+        """最良売り - 最良買い（どちらかの板が空なら None）"""
+        with self.lock:
+            b = self.best_price('buy'); s = self.best_price('sell')
+            return None if b is None or s is None else s - b
+
+    def depth(self, side:str, n:int=10)->List[Tuple[int,int,int]]:
+        """最良気配から n 段の (価格, 数量合計, 注文数)"""
+        keys = self._keys[side]; d = self._depth[side]
+        with self.lock:
+            return [(_price(side, k), *d[k]) for k in keys[:-n-1:-1]]
+
+    def cumulative(self, side:str, n:int=10)->List[Tuple[int,int]]:
+        """最良気配から n 段の (価格, その価格までの累計数量)"""
+        rows = self.depth(side, n)
+        return list(zip((r[0] for r in rows), accumulate(r[1] for r in rows)))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+価格過程（幾何ブラウン運動・平均回帰・ジャンプ拡散）のティック生成。
+
+乱数は BLOCK 件ずつ NumPy でまとめて引いてバッファに持ち、1ティックごとには
+バッファから取り出すだけにする。ショックは対数価格への加算量なので、
+販売所の売買などで価格が外から動いても、渡された現在価格から続けられる。
+advance() は n ティック分の経路を一度に返す（長いシミュレーションや履歴の埋め戻し用）。
+
+    proc = GBM(sigma=0.01, seed=0)
+    p = proc.next(100.0)             # 1ティック
+    path = proc.advance(100.0, 10000) # 1万ティックを一括で
+
+パラメータはすべて1ティックあたり。
+"""
+
+import math
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import numpy as np
+
+BLOCK = 4096
+
+
+class PriceProcess(ABC):
+    """対数価格 x に対し、ショック e を引いて x_{k+1} = f(x_k, e_k) で進める過程の基底"""
+
+    def __init__(self, seed:Optional[int]=None, block:int=BLOCK):
+        self.rng = np.random.default_rng(seed)
+        self.block = block
+        self.lock = threading.Lock()
+        self._buf = np.empty(0)
+        self._pos = 0
+
+    @abstractmethod
+    def _draw(self, n:int)->np.ndarray:
+        """n ティック分のショック（対数価格への加算量）"""
+
+    def _path(self, x0:float, e:np.ndarray)->np.ndarray:
+        """x0 から e で進めた対数価格の経路（x0 自体は含まない）。既定はランダムウォーク"""
+        return x0 + np.cumsum(e)
+
+    def _take(self, n:int)->np.ndarray:
+        with self.lock:
+            if self._pos + n > len(self._buf):
+                rest = self._buf[self._pos:]
+                self._buf = np.concatenate([rest, self._draw(max(self.block, n - len(rest)))])
+                self._pos = 0
+            e = self._buf[self._pos:self._pos + n]
+            self._pos += n
+            return e
+
+    def next(self, price:float)->float:
+        """price から1ティック進めた価格"""
+        return float(self.advance(price, 1)[0])
+
+    def advance(self, price:float, n:int)->np.ndarray:
+        """price から n ティック進めた価格の経路（長さ n）"""
+        return np.exp(self._path(math.log(price), self._take(n)))
+
+
+class GBM(PriceProcess):
+    """幾何ブラウン運動（mu はドリフト、sigma はボラティリティ）"""
+
+    def __init__(self, mu:float=0.0, sigma:float=0.01, **kw):
+        super().__init__(**kw)
+        self.mu, self.sigma = mu, sigma
+
+    def _draw(self, n):
+        return (self.mu - 0.5 * self.sigma ** 2) + self.sigma * self.rng.standard_normal(n)
+
+
+class JumpDiffusion(GBM):
+    """Merton のジャンプ拡散。1ティックに平均 lam 回、対数で N(jump_mu, jump_sigma) のジャンプ"""
+
+    def __init__(self, mu:float=0.0, sigma:float=0.01, lam:float=0.02, jump_mu:float=0.0,
+                 jump_sigma:float=0.05, **kw):
+        super().__init__(mu, sigma, **kw)
+        self.lam, self.jump_mu, self.jump_sigma = lam, jump_mu, jump_sigma
+
+    def _draw(self, n):
+        k = math.exp(self.jump_mu + 0.5 * self.jump_sigma ** 2) - 1   # ジャンプ分の期待リターンを差し引く
+        jumps = self.rng.poisson(self.lam, n)
+        return (super()._draw(n) - self.lam * k
+                + jumps * self.jump_mu + np.sqrt(jumps) * self.jump_sigma * self.rng.standard_normal(n))
+
+
+class MeanReverting(PriceProcess):
+    """対数価格の Ornstein-Uhlenbeck 過程（mean に速さ theta で戻る）"""
+
+    def __init__(self, mean:float=100.0, theta:float=0.05, sigma:float=0.01, **kw):
+        super().__init__(**kw)
+        self.m = math.log(mean)
+        self.phi = math.exp(-theta)
+        self.sd = sigma * math.sqrt((1 - self.phi ** 2) / (2 * theta))   # 厳密な離散化
+        # phi^-L が桁あふれしない長さごとに区切って閉じた形で計算する
+        self.chunk = max(1, int(50 / theta))
+
+    def _draw(self, n):
+        return self.sd * self.rng.standard_normal(n)
+
+    def _path(self, x0, e):
+        # y_k = phi^k y_0 + Σ_{j<=k} phi^{k-j} e_j （y = x - m）
+        out = np.empty(len(e))
+        y = x0 - self.m
+        for s in range(0, len(e), self.chunk):
+            c = e[s:s + self.chunk]
+            p = self.phi ** np.arange(1, len(c) + 1)
+            out[s:s + len(c)] = p * (y + np.cumsum(c / p))
+            y = out[s + len(c) - 1]
+        return out + self.m
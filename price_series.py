@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+価格系列のストア（crypt_demo_v2 の price_history）。
+
+生のティックは直近 RAW_MAX 件だけリングバッファに残し、同時に
+1秒・1分・1時間の OHLC ローソク足に集計する（足もそれぞれ上限件数まで）。
+チャートは表示期間をカバーできる最も細かい解像度から返すので、
+保存量も描画量も稼働時間に関係なく一定になる。
+"""
+
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+import pandas as pd
+
+RAW_MAX = 2000
+# 間隔（秒） -> 保持する本数（1秒足 15分、1分足 1日、1時間足 180日）
+INTERVALS = {1: 900, 60: 1440, 3600: 24 * 180}
+
+# ローソク足: [bucket(epoch 秒), open, high, low, close]
+B, O, H, L, C = range(5)
+
+
+def _ts(time:str)->float:
+    # 表示用の時刻文字列をそのまま UTC とみなした epoch 秒（戻すときは unit="s" だけでよい）
+    return datetime.fromisoformat(time).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _covers(buf:deque, t:float, since:Optional[float])->bool:
+    """buf が since 以降を欠けずに持っているか（since=None は一度も溢れていないか）"""
+    if since is None:
+        return len(buf) < buf.maxlen
+    return t <= since
+
+
+class PriceSeries:
+    def __init__(self):
+        self.raw = deque(maxlen=RAW_MAX)                                   # (epoch 秒, price)
+        self.candles = {iv: deque(maxlen=n) for iv, n in INTERVALS.items()}
+        self.version = 0
+
+    def append(self, tick:dict):
+        """{"time": "%Y-%m-%d %H:%M:%S", "price": float} を1件取り込む"""
+        ts = _ts(tick["time"]); p = tick["price"]
+        self.raw.append((ts, p))
+        for iv, cs in self.candles.items():
+            bucket = ts - ts % iv
+            if cs and bucket <= cs[-1][B]:
+                c = cs[-1]   # 同じ足（時計の巻き戻りも最後の足に入れる）
+                c[H] = max(c[H], p); c[L] = min(c[L], p); c[C] = p
+            else:
+                cs.append([bucket, p, p, p, p])
+        self.version += 1
+
+    def last_price(self)->float:
+        return self.raw[-1][1]
+
+    def age(self, time:str)->Optional[float]:
+        """time（"%Y-%m-%d %H:%M:%S"）が最後のティックから何秒後か（ティックが無ければ None）"""
+        return _ts(time) - self.raw[-1][0] if self.raw else None
+
+    def frame(self, span:Optional[float]=None)->pd.DataFrame:
+        """直近 span 秒（None は保持している全期間）を、それをカバーできる最も細かい解像度で返す。
+        index は time、列は open/high/low/close（生ティックは4列とも同じ値）"""
+        if not self.raw:
+            return pd.DataFrame(columns=["open", "high", "low", "close"])
+        since = self.raw[-1][0] - span if span is not None else None
+        if _covers(self.raw, self.raw[0][0], since):
+            rows = [(t, p, p, p, p) for t, p in self.raw if since is None or t >= since]
+        else:
+            ivs = sorted(self.candles)
+            iv = next((iv for iv in ivs if _covers(self.candles[iv], self.candles[iv][0][B], since)), ivs[-1])
+            rows = [tuple(c) for c in self.candles[iv] if since is None or c[B] > since - iv]
+        df = pd.DataFrame(rows, columns=["time", "open", "high", "low", "close"])
+        df["time"] = pd.to_datetime(df["time"], unit="s")
+        return df.set_index("time")
+
+    # ---- スナップショット（JSON）----
+    def to_json(self)->dict:
+        return {"raw": list(self.raw), "candles": {str(iv): list(cs) for iv, cs in self.candles.items()}}
+
+    @classmethod
+    def from_json(cls, obj)->"PriceSeries":
+        """to_json の形式、または旧形式（{"time","price"} のリスト）から作る"""
+        if isinstance(obj, cls):
+            return obj
+        s = cls()
+        if isinstance(obj, list):
+            for tick in obj:
+                s.append(tick)
+            return s
+        s.raw.extend(tuple(r) for r in obj["raw"])
+        for iv, cs in obj["candles"].items():
+            if int(iv) in s.candles:
+                s.candles[int(iv)].extend(cs)
+        return s
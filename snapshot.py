@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+取引所の状態（crypt_demo_v0 では未約定注文）のバイナリスナップショット。
+
+表は列ごとの固定長整数配列（array の typecode）で書き、読み込みは mmap して
+memoryview.cast で列をそのまま整数列として見る（行ごとの変換もコピーもしない）。
+文字列の列は終端位置の配列と UTF-8 の連結で持つ。ファイル全体の CRC32 を持ち、
+一時ファイルに書いてから置き換えるので、書きかけのファイルを読むことはない。
+
+    ヘッダ  magic 8s, version I, crc32 I, nmeta I, ntables I
+    meta    (name 16s, value q) × nmeta
+    表      name 16s, nrows Q, ncols I, pad I、続けて列ごとに
+            name 16s, typecode 1s + 7x, nbytes Q, データ（8 バイト境界まで 0 詰め）
+
+    dump("simdex.snap", {"price": p}, {"orders": {"id": ("q", ids), "side": ("b", sides)}})
+    snap = load("simdex.snap")     # 壊れている・版が違う場合は None
+    snap.meta["price"], snap.tables["orders"]["id"][0]
+"""
+
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from typing import Dict, Iterable, Optional, Tuple
+
+SNAP_MAGIC = b"SIMDEXSN"
+SNAP_VERSION = 1
+STR = "s"   # 文字列の列（終端位置 q の配列 + UTF-8 の連結）
+
+_HEADER = struct.Struct("<8sIIII")
+_META = struct.Struct("<16sq")
+_TABLE = struct.Struct("<16sQII")
+_COLUMN = struct.Struct("<16sc7xQ")
+
+
+def _pad(n:int)->int:
+    return -n % 8
+
+
+def _column_bytes(typecode:str, values:Iterable)->Tuple[bytes,int]:
+    """列のバイト列と行数"""
+    if typecode != STR:
+        a = array(typecode, values)
+        return a.tobytes(), len(a)
+    blob = bytearray()
+    ends = array("q")
+    for v in values:
+        blob += v.encode()
+        ends.append(len(blob))
+    return struct.pack("<Q", len(ends)) + ends.tobytes() + bytes(blob), len(ends)
+
+
+def dump(path:str, meta:Dict[str,int], tables:Dict[str,Dict[str,Tuple[str,Iterable]]]):
+    """meta（整数）と表（列名 -> (typecode, 値の列)）を path に書く"""
+    parts = []
+    for name, value in meta.items():
+        parts.append(_META.pack(name.encode(), value))
+    for tname, cols in tables.items():
+        data = [(c, tc) + _column_bytes(tc, vals) for c, (tc, vals) in cols.items()]
+        nrows = data[0][3] if data else 0
+        if any(d[3] != nrows for d in data):
+            raise ValueError(f"{tname}: 列の長さが揃っていません")
+        parts.append(_TABLE.pack(tname.encode(), nrows, len(data), 0))
+        for c, tc, b, _ in data:
+            parts.append(_COLUMN.pack(c.encode(), tc.encode(), len(b)))
+            parts.append(b + bytes(_pad(len(b))))
+    body = b"".join(parts)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(SNAP_MAGIC, SNAP_VERSION, zlib.crc32(body), len(meta), len(tables)))
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    """load() の結果。数値の列は mmap 上の memoryview（close() まで有効）"""
+
+    def __init__(self, mm:mmap.mmap, meta:Dict[str,int], tables:Dict[str,Dict[str,object]], nrows:Dict[str,int]):
+        self._mm = mm
+        self.meta = meta
+        self.tables = tables
+        self.nrows = nrows
+
+    def rows(self, table:str, *cols:str):
+        """指定した列を行のタプルとして順に返す"""
+        t = self.tables[table]
+        return zip(*(t[c] for c in cols))
+
+    def close(self):
+        for cols in self.tables.values():
+            for v in cols.values():
+                if isinstance(v, memoryview):
+                    v.release()
+        self._mm.close()
+
+
+def _read_str(mv:memoryview)->list:
+    n = struct.unpack_from("<Q", mv)[0]
+    ends = mv[8:8 + 8 * n].cast("q")
+    blob = bytes(mv[8 + 8 * n:])
+    out, start = [], 0
+    for e in ends:
+        out.append(blob[start:e].decode())
+        start = e
+    ends.release()
+    return out
+
+
+def load(path:str)->Optional[Snapshot]:
+    """スナップショットを mmap で開く。無い・壊れている・版が違うときは None"""
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    mv = memoryview(mm)
+    tables, nrows = {}, {}
+    try:
+        magic, version, crc, nmeta, ntables = _HEADER.unpack_from(mv)
+        if magic != SNAP_MAGIC or version != SNAP_VERSION or zlib.crc32(mv[_HEADER.size:]) != crc:
+            raise ValueError(path)
+        pos = _HEADER.size
+        meta = {}
+        for _ in range(nmeta):
+            name, value = _META.unpack_from(mv, pos); pos += _META.size
+            meta[name.rstrip(b"\0").decode()] = value
+        for _ in range(ntables):
+            tname, n, ncols, _pad0 = _TABLE.unpack_from(mv, pos); pos += _TABLE.size
+            tname = tname.rstrip(b"\0").decode()
+            cols = {}
+            for _ in range(ncols):
+                cname, tc, nbytes = _COLUMN.unpack_from(mv, pos); pos += _COLUMN.size
+                data = mv[pos:pos + nbytes]
+                tc = tc.decode()
+                if tc == STR:
+                    cols[cname.rstrip(b"\0").decode()] = _read_str(data)
+                    data.release()
+                else:
+                    cols[cname.rstrip(b"\0").decode()] = data.cast(tc)
+                pos += nbytes + _pad(nbytes)
+            tables[tname] = cols
+            nrows[tname] = n
+    except (ValueError, TypeError, struct.error, UnicodeDecodeError):
+        mv.release()
+        Snapshot(mm, {}, tables, {}).close()
+        return None
+    mv.release()
+    return Snapshot(mm, meta, tables, nrows)
@@ -0,0 +1,627 @@
+# -*- coding: utf-8 -*-
+"""
+ストレージ層（ユーザー・ウォレット・注文・約定・価格）の共通インターフェースと実装。
+
+    SQLiteStorage   crypt_demo_v0 と同じ SQLite スキーマ（このモジュールが定義を持つ）
+    JournalStorage  crypt_demo_v1 / v2 と同じ追記専用ジャーナル（journal.Journal）
+    MemoryStorage   プロセス内の dict だけ（crypt_demo_v3 の session_state 相当）
+
+金額・数量は fixedpoint の整数単位。業務ロジック（exchange.Exchange）はこの
+インターフェースだけを使うので、どのバックエンドでも同じように動く。
+bench_storage.py で同じワークロードを流して比べられる。
+
+transaction() の中の書き込みは、ブロックを抜けたときにまとめて確定する
+（読み取りに同じトランザクション内の書き込みが見えるとは限らない）。
+SQLiteStorage は残高の変更を元帳（ledger.py）にも記録する。約定・販売所の売買は add_trades が
+v0 と同じ仕訳（fill / dealer）で書き、set_wallets の差分のうち約定で説明できない残り
+（残高の直接修正）だけをトランザクションの確定時に ISSUER との振替（adjust）にする。
+"""
+
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+from fixedpoint import to_mock
+from journal import Journal
+from ledger import ISSUER, MOCK, Y, Postings, create_ledger_tables, post_trades, trade_legs
+
+INITIAL_PRICE = to_mock(100)
+
+# ---------------------- SQLite スキーマ（crypt_demo_v0 と共用） ----------------------
+SCHEMA_VERSION = 4   # PRAGMA user_version（0 = REAL 版の旧スキーマ、1 = candles 導入前、2 = 履歴の keyset 用インデックス導入前、3 = 元帳導入前）
+
+# 接続ごとに1回だけ設定する PRAGMA（WAL で読み手がマッチングの書き込みを妨げない）
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",   # 256MB
+    "PRAGMA cache_size=-65536",     # 64MB
+    "PRAGMA busy_timeout=5000",
+)
+
+ORDER_INDEXES = ("idx_orders_open_buy", "idx_orders_open_sell")
+# 取引履歴のインデックス。id は rowid なので末尾に暗黙に付き、(…, ts, id) の順に並ぶ
+TRADE_INDEXES = ("idx_trades_venue_ts_id", "idx_trades_ts_id", "idx_trades_buyer_ts_id", "idx_trades_seller_ts_id")
+OLD_TRADE_INDEXES = ("idx_trades_venue_ts", "idx_trades_ts")   # ts DESC 版（id での並べ替えに使えない）
+
+def create_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE,
+        pw_hash TEXT,
+        salt TEXT
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS wallets(
+        user_id INTEGER PRIMARY KEY,
+        mock INTEGER NOT NULL DEFAULT 0,   -- 1e-6 Mock
+        y INTEGER NOT NULL DEFAULT 0,      -- 1e-6 Y
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS orders(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        side TEXT,           -- 'buy' or 'sell'
+        price INTEGER,       -- 1e-6 Mock / Y
+        qty_rem INTEGER,     -- 1e-6 Y
+        ts INTEGER,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS trades(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER,
+        venue TEXT,          -- 'dealer' or 'exchange'
+        buyer_id INTEGER,
+        seller_id INTEGER,
+        price INTEGER,
+        qty INTEGER,
+        fee_bps INTEGER,
+        fee_buyer_mock INTEGER,
+        fee_seller_mock INTEGER,
+        FOREIGN KEY(buyer_id) REFERENCES users(id),
+        FOREIGN KEY(seller_id) REFERENCES users(id)
+    );""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS state(
+        k TEXT PRIMARY KEY,
+        v TEXT
+    );""")
+    # ローソク足（約定の書き込みと同じトランザクションで更新する）
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS candles(
+        venue TEXT,          -- 'dealer' / 'exchange' / 'all'
+        interval INTEGER,    -- 秒（CANDLE_INTERVALS）
+        bucket INTEGER,      -- 足の開始時刻（UNIX 秒）
+        open INTEGER, high INTEGER, low INTEGER, close INTEGER,   -- 1e-6 Mock / Y
+        volume INTEGER,      -- 1e-6 Y
+        n INTEGER,           -- 約定件数
+        PRIMARY KEY(venue, interval, bucket)
+    ) WITHOUT ROWID;""")
+    # 残高変更の元帳（ledger.py）
+    create_ledger_tables(cur)
+
+def create_order_log(cur):
+    """orders の更新・削除を記録する表（crypt_demo_v0 のスナップショットの差分の読み直し用）。
+    トリガーで書くので、どこから orders を変えても漏れない。古い行は v0 の write_snapshot が消す"""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS order_log(
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL
+    );""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS order_log_update AFTER UPDATE OF qty_rem ON orders
+    BEGIN INSERT INTO order_log(order_id) VALUES (NEW.id); END;""")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS order_log_delete AFTER DELETE ON orders
+    BEGIN INSERT INTO order_log(order_id) VALUES (OLD.id); END;""")
+
+def create_indexes(cur):
+    # 板（未約定注文のみの部分インデックス。価格・時間優先の順に並べて持つ）
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_orders_open_buy
+        ON orders(price DESC, ts, id, user_id, qty_rem, side)
+        WHERE side='buy' AND qty_rem>0;""")
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_orders_open_sell
+        ON orders(price, ts, id, user_id, qty_rem, side)
+        WHERE side='sell' AND qty_rem>0;""")
+    # 取引履歴（(ts, id) の keyset で新しい順に後ろから読む）
+    for idx in OLD_TRADE_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS {idx}")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trades_venue_ts_id ON trades(venue, ts);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trades_ts_id ON trades(ts);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trades_buyer_ts_id ON trades(buyer_id, ts);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_trades_seller_ts_id ON trades(seller_id, ts);")
+
+# ローソク足の間隔（秒）: 1分足・1時間足・日足
+CANDLE_INTERVALS = (60, 3600, 86400)
+
+# ローカル時刻のオフセットと0時は 15 分ごとに引いてキャッシュする（切り替えは 15 分の倍数の時刻に起きる）
+@lru_cache(maxsize=4096)
+def _tz_offset(quarter:int)->int:
+    return int(datetime.fromtimestamp(quarter * 900, timezone.utc).astimezone().utcoffset().total_seconds())
+
+@lru_cache(maxsize=4096)
+def _local_midnight(quarter:int)->int:
+    return int(datetime.fromtimestamp(quarter * 900).replace(hour=0, minute=0, second=0).timestamp())
+
+def candle_bucket(ts:int, interval:int)->int:
+    """ts を含む足の開始時刻。日足はその日のローカルの0時、それ以外はローカル時刻の区切り。
+    オフセットは ts ごとに引くので、夏時間の切り替えの前後でも正しく切れる"""
+    if interval == 86400:
+        return _local_midnight(ts // 900)
+    return ts - (ts + _tz_offset(ts // 900)) % interval
+
+SQL_CANDLE_UPSERT = """INSERT INTO candles(venue,interval,bucket,open,high,low,close,volume,n)
+                       VALUES(?,?,?,?,?,?,?,?,?)
+                       ON CONFLICT(venue,interval,bucket) DO UPDATE SET
+                           high=MAX(high,excluded.high), low=MIN(low,excluded.low),
+                           close=excluded.close, volume=volume+excluded.volume, n=n+excluded.n"""
+
+def upsert_candles(cur, trades):
+    """(ts, venue, price, qty) の約定（時刻順）をローソク足に積み上げる。
+    同じ足に入る約定はメモリ上でまとめてから1行ずつ upsert する。"""
+    agg = {}   # (venue, interval, bucket) -> [o,h,l,c,volume,n]
+    for ts, venue, price, qty in trades:
+        buckets = [(iv, candle_bucket(ts, iv)) for iv in CANDLE_INTERVALS]
+        for v in (venue, 'all'):
+            for iv, b in buckets:
+                k = (v, iv, b)
+                c = agg.get(k)
+                if c is None:
+                    agg[k] = [price, price, price, price, qty, 1]
+                else:
+                    if price > c[1]: c[1] = price
+                    if price < c[2]: c[2] = price
+                    c[3] = price; c[4] += qty; c[5] += 1
+    cur.executemany(SQL_CANDLE_UPSERT, [k + tuple(c) for k, c in agg.items()])
+
+# ---------------------- インターフェース ----------------------
+# 約定の行: (ts, venue, buyer_id, seller_id, price, qty, fee_bps, fee_buyer_mock, fee_seller_mock)
+# 注文の行: (id, user_id, side, price, qty_rem, ts)
+class Storage(ABC):
+    @abstractmethod
+    def transaction(self):
+        """書き込みをまとめて確定するコンテキスト（入れ子は外側にまとめる）"""
+
+    # ユーザー
+    @abstractmethod
+    def add_user(self, username:str, pw_hash:str, salt:str, mock:int, y:int)->int:
+        ...
+
+    @abstractmethod
+    def get_user(self, username:str)->Optional[Tuple[int,str,str]]:
+        """(id, pw_hash, salt)"""
+
+    @abstractmethod
+    def username(self, uid:int)->str:
+        ...
+
+    # ウォレット
+    @abstractmethod
+    def get_wallet(self, uid:int)->Tuple[int,int]:
+        """(Mock 単位, Y lot)。未登録は (0, 0)"""
+
+    @abstractmethod
+    def set_wallets(self, rows:Iterable[Tuple[int,int,int]]):
+        """(user_id, mock, y) で上書き"""
+
+    # 注文
+    @abstractmethod
+    def add_order(self, uid:int, side:str, price:int, qty:int, ts:int)->int:
+        ...
+
+    @abstractmethod
+    def set_order_qtys(self, rows:Iterable[Tuple[int,int]]):
+        """(order_id, qty_rem) で更新。0 以下は削除"""
+
+    @abstractmethod
+    def open_orders(self)->List[tuple]:
+        """未約定の注文（時刻順）。板の読み込み用"""
+
+    # 約定
+    @abstractmethod
+    def add_trades(self, rows:Iterable[tuple]):
+        ...
+
+    @abstractmethod
+    def trades(self, venue:Optional[str]=None, limit:int=200)->List[tuple]:
+        """新しい順に最大 limit 件"""
+
+    # 価格
+    @abstractmethod
+    def get_price(self)->int:
+        ...
+
+    @abstractmethod
+    def set_price(self, p:int):
+        ...
+
+    def close(self):
+        pass
+
+
+# ---------------------- SQLite ----------------------
+class SQLiteStorage(Storage):
+    def __init__(self, path:str, factory=sqlite3.Connection):
+        # 自動コミットで開き、transaction() の中だけ BEGIN IMMEDIATE でまとめる
+        self.con = sqlite3.connect(path, check_same_thread=False, cached_statements=256,
+                                   isolation_level=None, factory=factory)
+        self.lock = threading.RLock()
+        self._depth = 0
+        self._adjust = {}   # (user_id, 資産) -> このトランザクションで仕訳がまだ無い残高の差分
+        for pragma in DB_PRAGMAS:
+            self.con.execute(pragma)
+        cur = self.con.cursor()
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        exists = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='wallets'").fetchone()
+        if exists and version != SCHEMA_VERSION:
+            raise RuntimeError(f"{path}: スキーマ {version} は未移行です（crypt_demo_v0 の init_db で移行してください）")
+        cur.execute("BEGIN IMMEDIATE")
+        create_tables(cur)
+        create_indexes(cur)
+        cur.execute("INSERT OR IGNORE INTO state(k,v) VALUES ('last_price',?)", (str(INITIAL_PRICE),))
+        cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        cur.execute("COMMIT")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self._depth:
+                self._depth += 1
+                try: yield
+                finally: self._depth -= 1
+                return
+            self.con.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            self._adjust = {}
+            try:
+                yield
+                self._post_adjust()
+                self.con.execute("COMMIT")
+            except BaseException:
+                self.con.execute("ROLLBACK")
+                raise
+            finally:
+                self._depth = 0
+
+    def _post_adjust(self):
+        """約定の仕訳で説明できない残高の差分を ISSUER との振替として書く"""
+        per_user = {}
+        for (u, s), d in self._adjust.items():
+            if d:
+                per_user.setdefault(u, []).extend([(u, s, d), (ISSUER, s, -d)])
+        if per_user:
+            p = Postings(int(time.time()))
+            for legs in per_user.values():
+                p.post('adjust', None, legs)
+            p.write(self.con.cursor())
+
+    def add_user(self, username, pw_hash, salt, mock, y):
+        with self.transaction():
+            cur = self.con.execute("INSERT INTO users(username,pw_hash,salt) VALUES (?,?,?)", (username, pw_hash, salt))
+            uid = cur.lastrowid
+            self.con.execute("INSERT INTO wallets(user_id,mock,y) VALUES (?,?,?)", (uid, mock, y))
+            p = Postings(int(time.time()))
+            p.post('signup', None, [(uid, MOCK, mock), (ISSUER, MOCK, -mock), (uid, Y, y), (ISSUER, Y, -y)])
+            p.write(cur)
+        return uid
+
+    def get_user(self, username):
+        return self.con.execute("SELECT id, pw_hash, salt FROM users WHERE username=?", (username,)).fetchone()
+
+    def username(self, uid):
+        r = self.con.execute("SELECT username FROM users WHERE id=?", (uid,)).fetchone()
+        return r[0] if r else "unknown"
+
+    def get_wallet(self, uid):
+        r = self.con.execute("SELECT mock,y FROM wallets WHERE user_id=?", (uid,)).fetchone()
+        return (r[0], r[1]) if r else (0, 0)
+
+    def set_wallets(self, rows):
+        # 業務ロジックは結果の残高だけを渡すので、差分をためておき、同じトランザクションの
+        # add_trades の仕訳を引いた残りを確定時に adjust にする
+        rows = list(rows)
+        with self.transaction():
+            for u, m, y in rows:
+                old = self.get_wallet(u)
+                for s, d in ((MOCK, m - old[0]), (Y, y - old[1])):
+                    self._adjust[(u, s)] = self._adjust.get((u, s), 0) + d
+            self.con.executemany("UPDATE wallets SET mock=?, y=? WHERE user_id=?", [(m, y, u) for u, m, y in rows])
+
+    def add_order(self, uid, side, price, qty, ts):
+        return self.con.execute("INSERT INTO orders(user_id,side,price,qty_rem,ts) VALUES(?,?,?,?,?)",
+                                (uid, side, price, qty, ts)).lastrowid
+
+    def set_order_qtys(self, rows):
+        rows = list(rows)
+        with self.transaction():
+            self.con.executemany("UPDATE orders SET qty_rem=? WHERE id=?", [(q, oid) for oid, q in rows if q > 0])
+            self.con.executemany("DELETE FROM orders WHERE id=?", [(oid,) for oid, q in rows if q <= 0])
+
+    def open_orders(self):
+        return self.con.execute("""SELECT id,user_id,side,price,qty_rem,ts FROM orders
+                                   WHERE qty_rem>0 ORDER BY ts, id""").fetchall()
+
+    def add_trades(self, rows):
+        rows = list(rows)
+        with self.transaction():
+            self.con.executemany("""INSERT INTO trades(ts,venue,buyer_id,seller_id,price,qty,fee_bps,fee_buyer_mock,fee_seller_mock)
+                                    VALUES(?,?,?,?,?,?,?,?,?)""", rows)
+            cur = self.con.cursor()
+            post_trades(cur, rows)
+            for r in rows:
+                for a, s, d in trade_legs(r)[1]:
+                    if a > 0:
+                        self._adjust[(a, s)] = self._adjust.get((a, s), 0) - d
+            upsert_candles(cur, [(r[0], r[1], r[4], r[5]) for r in rows])
+
+    def trades(self, venue=None, limit=200):
+        cols = "ts,venue,buyer_id,seller_id,price,qty,fee_bps,fee_buyer_mock,fee_seller_mock"
+        if venue:
+            return self.con.execute(f"SELECT {cols} FROM trades WHERE venue=? ORDER BY ts DESC, id DESC LIMIT ?",
+                                    (venue, limit)).fetchall()
+        return self.con.execute(f"SELECT {cols} FROM trades ORDER BY ts DESC, id DESC LIMIT ?", (limit,)).fetchall()
+
+    def get_price(self):
+        r = self.con.execute("SELECT v FROM state WHERE k='last_price'").fetchone()
+        return int(r[0]) if r else INITIAL_PRICE
+
+    def set_price(self, p):
+        self.con.execute("INSERT OR REPLACE INTO state(k,v) VALUES ('last_price',?)", (str(p),))
+
+    def close(self):
+        self.con.close()
+
+
+# ---------------------- ジャーナル ----------------------
+def _default_state()->dict:
+    return {"users": {}, "wallets": {}, "orders": {}, "trades": [], "price": INITIAL_PRICE,
+            "next_user_id": 1, "next_order_id": 1}
+
+def _apply(data:dict, ev:dict):
+    """JournalStorage のイベント（JSON のキーは文字列なので id は str にして持つ）"""
+    t = ev["t"]
+    if t == "user":
+        data["users"][str(ev["id"])] = ev["rec"]
+        data["wallets"][str(ev["id"])] = ev["w"]
+        data["next_user_id"] = ev["id"] + 1
+    elif t == "wallets":
+        for uid, m, y in ev["rows"]:
+            data["wallets"][str(uid)] = [m, y]
+    elif t == "order":
+        data["orders"][str(ev["o"][0])] = ev["o"]
+        data["next_order_id"] = ev["o"][0] + 1
+    elif t == "order_qty":
+        for oid, q in ev["rows"]:
+            if q > 0:
+                data["orders"][str(oid)][4] = q
+            else:
+                data["orders"].pop(str(oid), None)
+    elif t == "trades":
+        data["trades"].extend(ev["rows"])
+    elif t == "price":
+        data["price"] = ev["p"]
+    else:
+        raise ValueError(f"unknown event: {t}")
+
+
+class JournalStorage(Storage):
+    def __init__(self, path:str, snapshot_every:Optional[int]=None):
+        kw = {"snapshot_every": snapshot_every} if snapshot_every else {}
+        self.journal = Journal(path, _default_state, apply=_apply, **kw)
+        self.data = self.journal.data
+        self._names = {rec[0]: int(uid) for uid, rec in self.data["users"].items()}
+        self._tx = None   # transaction() 中にためるイベント
+
+    @contextmanager
+    def transaction(self):
+        with self.journal.lock:
+            if self._tx is not None:
+                yield
+                return
+            self._tx = []
+            try:
+                yield
+                events, self._tx = self._tx, None
+                if events:
+                    self.journal.append(*events)   # 1回の write
+                    self._committed(events)
+            finally:
+                self._tx = None
+
+    def _emit(self, ev:dict):
+        if self._tx is not None:
+            self._tx.append(ev)
+        else:
+            self.journal.append(ev)
+            self._committed([ev])
+
+    def _committed(self, events:list):
+        """追記できたイベントだけを索引に反映する（中断したトランザクションの分は残らない）"""
+        for ev in events:
+            if ev["t"] == "user":
+                self._names[ev["rec"][0]] = ev["id"]
+
+    def _next_id(self, t:str, key:str)->int:
+        """次の id（状態の次番号 + このトランザクションでまだ追記していない分）"""
+        return self.data[key] + sum(1 for ev in self._tx or () if ev["t"] == t)
+
+    def add_user(self, username, pw_hash, salt, mock, y):
+        with self.journal.lock:
+            uid = self._next_id("user", "next_user_id")
+            self._emit({"t": "user", "id": uid, "rec": [username, pw_hash, salt], "w": [mock, y]})
+        return uid
+
+    def get_user(self, username):
+        uid = self._names.get(username)
+        rec = self.data["users"].get(str(uid))
+        return (uid, rec[1], rec[2]) if rec else None
+
+    def username(self, uid):
+        rec = self.data["users"].get(str(uid))
+        return rec[0] if rec else "unknown"
+
+    def get_wallet(self, uid):
+        w = self.data["wallets"].get(str(uid))
+        return (w[0], w[1]) if w else (0, 0)
+
+    def set_wallets(self, rows):
+        self._emit({"t": "wallets", "rows": [list(r) for r in rows]})
+
+    def add_order(self, uid, side, price, qty, ts):
+        with self.journal.lock:
+            oid = self._next_id("order", "next_order_id")
+            self._emit({"t": "order", "o": [oid, uid, side, price, qty, ts]})
+        return oid
+
+    def set_order_qtys(self, rows):
+        self._emit({"t": "order_qty", "rows": [list(r) for r in rows]})
+
+    def open_orders(self):
+        return sorted((tuple(o) for o in self.data["orders"].values()), key=lambda o: (o[5], o[0]))
+
+    def add_trades(self, rows):
+        self._emit({"t": "trades", "rows": [list(r) for r in rows]})
+
+    def trades(self, venue=None, limit=200):
+        out = []
+        for r in reversed(self.data["trades"]):
+            if venue is None or r[1] == venue:
+                out.append(tuple(r))
+                if len(out) >= limit:
+                    break
+        return out
+
+    def get_price(self):
+        return self.data["price"]
+
+    def set_price(self, p):
+        self._emit({"t": "price", "p": p})
+
+    def close(self):
+        self.journal.snapshot()
+
+
+# ---------------------- メモリ ----------------------
+_MISSING = object()
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}     # uid -> (username, pw_hash, salt)
+        self.names = {}     # username -> uid
+        self.wallets = {}   # uid -> (mock, y)
+        self.orders = {}    # order_id -> 注文の行（挿入順 = 時刻順）
+        self._trades = []
+        self.price = INITIAL_PRICE
+        self._next_user = 1
+        self._next_order = 1
+        self._undo = None   # transaction() 中の (dict, key, 元の値) の記録
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self._undo is not None:
+                yield
+                return
+            self._undo = []
+            mark = (len(self._trades), self.price, self._next_user, self._next_order)
+            try:
+                yield
+            except BaseException:
+                self._rollback(mark)
+                raise
+            finally:
+                self._undo = None
+
+    def _rollback(self, mark:tuple):
+        for d, k, old in reversed(self._undo):
+            if old is _MISSING:
+                d.pop(k, None)
+            else:
+                d[k] = old
+        if any(d is self.orders for d, _, _ in self._undo):
+            # 戻した注文は末尾に入るので時刻順に並べ直す
+            self.orders = dict(sorted(self.orders.items(), key=lambda kv: (kv[1][5], kv[0])))
+        del self._trades[mark[0]:]
+        self.price, self._next_user, self._next_order = mark[1:]
+
+    def _save(self, d:dict, k):
+        if self._undo is not None:
+            self._undo.append((d, k, d.get(k, _MISSING)))
+
+    def add_user(self, username, pw_hash, salt, mock, y):
+        with self.lock:
+            uid = self._next_user
+            self._next_user += 1
+            for d, k in ((self.users, uid), (self.names, username), (self.wallets, uid)):
+                self._save(d, k)
+            self.users[uid] = (username, pw_hash, salt)
+            self.names[username] = uid
+            self.wallets[uid] = (mock, y)
+        return uid
+
+    def get_user(self, username):
+        uid = self.names.get(username)
+        return (uid,) + self.users[uid][1:] if uid is not None else None
+
+    def username(self, uid):
+        u = self.users.get(uid)
+        return u[0] if u else "unknown"
+
+    def get_wallet(self, uid):
+        return self.wallets.get(uid, (0, 0))
+
+    def set_wallets(self, rows):
+        with self.lock:
+            for u, m, y in rows:
+                self._save(self.wallets, u)
+                self.wallets[u] = (m, y)
+
+    def add_order(self, uid, side, price, qty, ts):
+        with self.lock:
+            oid = self._next_order
+            self._next_order += 1
+            self._save(self.orders, oid)
+            self.orders[oid] = (oid, uid, side, price, qty, ts)
+        return oid
+
+    def set_order_qtys(self, rows):
+        with self.lock:
+            for oid, q in rows:
+                self._save(self.orders, oid)
+                if q > 0:
+                    self.orders[oid] = self.orders[oid][:4] + (q,) + self.orders[oid][5:]
+                else:
+                    self.orders.pop(oid, None)
+
+    def open_orders(self):
+        return list(self.orders.values())
+
+    def add_trades(self, rows):
+        with self.lock:
+            self._trades.extend(tuple(r) for r in rows)
+
+    def trades(self, venue=None, limit=200):
+        out = []
+        for r in reversed(self._trades):
+            if venue is None or r[1] == venue:
+                out.append(r)
+                if len(out) >= limit:
+                    break
+        return out
+
+    def get_price(self):
+        return self.price
+
+    def set_price(self, p):
+        self.price = p
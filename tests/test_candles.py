@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""ローソク足の区切り（storage.candle_bucket / upsert_candles）。夏時間の切り替えをまたぐ日足"""
+
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+NY = "America/New_York"   # 2025-03-09 02:00 EST -> 03:00 EDT
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    if not hasattr(time, "tzset"):
+        pytest.skip("time.tzset が無い環境")
+    monkeypatch.setenv("TZ", NY)
+    time.tzset()
+    storage._tz_offset.cache_clear(); storage._local_midnight.cache_clear()
+    yield ZoneInfo(NY)
+    monkeypatch.undo()
+    time.tzset()
+    storage._tz_offset.cache_clear(); storage._local_midnight.cache_clear()
+
+
+def _ts(tz, *args)->int:
+    return int(datetime(*args, tzinfo=tz).timestamp())
+
+
+def test_daily_bucket_is_local_midnight_across_dst(new_york):
+    tz = new_york
+    midnight = _ts(tz, 2025, 3, 9)
+    before = _ts(tz, 2025, 3, 9, 1, 30)    # EST（UTC-5）
+    after = _ts(tz, 2025, 3, 9, 12, 0)     # EDT（UTC-4）
+    assert storage.candle_bucket(before, 86400) == midnight
+    assert storage.candle_bucket(after, 86400) == midnight
+    assert storage.candle_bucket(_ts(tz, 2025, 3, 10, 0, 30), 86400) == _ts(tz, 2025, 3, 10)
+    assert storage.candle_bucket(_ts(tz, 2025, 1, 15, 23, 59), 86400) == _ts(tz, 2025, 1, 15)
+    assert storage.candle_bucket(_ts(tz, 2025, 7, 15, 0, 1), 86400) == _ts(tz, 2025, 7, 15)
+
+
+def test_hourly_and_minute_buckets(new_york):
+    tz = new_york
+    after = _ts(tz, 2025, 3, 9, 12, 34, 56)
+    assert storage.candle_bucket(after, 3600) == _ts(tz, 2025, 3, 9, 12)
+    assert storage.candle_bucket(after, 60) == _ts(tz, 2025, 3, 9, 12, 34)
+
+
+def test_upsert_candles_puts_both_sides_of_dst_in_one_day(new_york):
+    tz = new_york
+    con = sqlite3.connect(":memory:")
+    cur = con.cursor()
+    storage.create_tables(cur)
+    storage.upsert_candles(cur, [(_ts(tz, 2025, 3, 9, 1, 30), 'dealer', 100, 1),
+                                 (_ts(tz, 2025, 3, 9, 12, 0), 'dealer', 110, 2)])
+    rows = cur.execute("""SELECT bucket, open, high, low, close, volume, n FROM candles
+                          WHERE venue='dealer' AND interval=86400""").fetchall()
+    assert rows == [(_ts(tz, 2025, 3, 9), 100, 110, 100, 110, 3, 2)]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""journal.Journal: スナップショット + ログの残りから開き直すと同じ状態になる（末尾行が途中で切れていても）"""
+
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from journal import Journal  # noqa: E402
+
+USERS = "abc"
+
+
+def _default():
+    return {"users": {}, "exchange_orders": [], "transactions": [], "price": 100}
+
+
+def _plain(data:dict)->dict:
+    """JSON にしたときの状態。残数量 0 以下の注文はまとめて詰めるまで残っているので除く"""
+    data = json.loads(json.dumps(data))
+    data["exchange_orders"] = [o for o in data["exchange_orders"] if o["amount"] > 0]
+    return data
+
+
+def _events(rng:random.Random, n:int):
+    """ユーザー登録のあとに注文・約定・残高・価格のイベントを混ぜて n 件"""
+    for u in USERS:
+        yield {"t": "user", "name": u, "rec": {"wallet": {"Mock": 1000.0, "Ycoin": 0.0}}}
+    oid = 0
+    for i in range(n):
+        r = rng.random()
+        if r < 0.4:
+            oid += 1
+            yield {"t": "order", "o": {"user": rng.choice(USERS), "type": rng.choice(("buy", "sell")),
+                                       "price": rng.randint(90, 110), "amount": rng.randint(1, 5)}}
+        elif r < 0.6 and oid:
+            yield {"t": "order_amt", "id": rng.randint(1, oid), "amount": rng.randint(0, 2)}
+        elif r < 0.8:
+            yield {"t": "wallet", "user": rng.choice(USERS), "w": {"Mock": rng.random() * 1000}}
+        elif r < 0.9:
+            yield {"t": "tx", "tx": {"type": "buy", "user": rng.choice(USERS), "amount": 1, "price": 100}}
+        else:
+            yield {"t": "price", "p": rng.randint(90, 110)}
+
+
+def _reopen(j:Journal)->Journal:
+    j._log.close()
+    return Journal(j.path, _default, snapshot_every=j.snapshot_every)
+
+
+def test_reopen_from_snapshot_and_log_tail(tmp_path):
+    j = Journal(str(tmp_path / "data.json"), _default, snapshot_every=64)
+    rng = random.Random(3)
+    for ev in _events(rng, 500):
+        j.append(ev)
+    assert os.path.exists(j.path) and 0 < j.pending < 64   # スナップショットの後にログの残りがある
+    want, seq = _plain(j.data), j.seq
+    j = _reopen(j)
+    assert _plain(j.data) == want and j.seq == seq
+    assert j.data["exchange_orders"].by_id == {o["id"]: o for o in j.data["exchange_orders"] if o["amount"] > 0}
+    # 開き直した後の追記も続けて読める
+    for ev in _events(rng, 100):
+        j.append(ev)
+    want = _plain(j.data)
+    j = _reopen(j)
+    assert _plain(j.data) == want
+    j._log.close()
+
+
+def test_log_already_in_snapshot_is_skipped(tmp_path):
+    """スナップショットを書いた直後、ログを空にする前に落ちた場合"""
+    j = Journal(str(tmp_path / "data.json"), _default, snapshot_every=1000)
+    for ev in _events(random.Random(4), 80):
+        j.append(ev)
+    j.append({"t": "tx", "tx": {"type": "sell", "user": "a", "amount": 1, "price": 100}})   # 最後の1件も読み飛ばす
+    with open(j.log_path, encoding="utf-8") as f:
+        log = f.read()
+    j.snapshot()
+    want = _plain(j.data)
+    with open(j.log_path, "w", encoding="utf-8") as f:
+        f.write(log)
+    j = _reopen(j)
+    assert _plain(j.data) == want
+    j._log.close()
+
+
+def test_truncated_last_line_is_dropped(tmp_path):
+    j = Journal(str(tmp_path / "data.json"), _default, snapshot_every=1000)
+    for ev in _events(random.Random(5), 50):
+        j.append(ev)
+    want, seq = _plain(j.data), j.seq
+    j._log.write('{"t":"price","p":12')   # 書き込み途中で落ちた行
+    j._log.flush()
+    j = _reopen(j)
+    assert _plain(j.data) == want and j.seq == seq
+    with open(j.log_path, encoding="utf-8") as f:
+        assert f.read() == ""   # 開くときに畳んで、切れた行も消える
+    j.append({"t": "price", "p": 123})
+    j = _reopen(j)
+    assert j.data["price"] == 123 and j.seq == seq + 1
+    j._log.close()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""matching.Book（ソート済みの板）の約定が、従来の二重ループのマッチングと一致することを確かめる"""
+
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from journal import Journal  # noqa: E402
+from matching import EX_FEE_RATE, Book, match_and_settle, place_order  # noqa: E402
+
+USERS = "abcde"
+
+
+def _default():
+    return {"users": {u: {"wallet": {"Mock": 1e6, "Ycoin": 1e3}} for u in USERS},
+            "exchange_orders": [], "transactions": [], "price": 100}
+
+
+def nested_loop(orders:list, wallets:dict)->list:
+    """旧 crypt_demo_v1 の簡易マッチング（買い × 売りの二重ループ）。
+    旧版は登録順に回していたので、ここでは価格・時間優先に並べてから回す"""
+    buys = sorted((o for o in orders if o["type"] == "buy" and o["amount"] > 0), key=lambda o: (-o["price"], o["id"]))
+    sells = sorted((o for o in orders if o["type"] == "sell" and o["amount"] > 0), key=lambda o: (o["price"], o["id"]))
+    fills = []
+    for buy in buys:
+        for sell in sells:
+            if buy["price"] >= sell["price"] and buy["amount"] > 0 and sell["amount"] > 0:
+                qty = min(buy["amount"], sell["amount"])
+                trade_price = (buy["price"] + sell["price"]) / 2
+                fee = qty * trade_price * EX_FEE_RATE
+                wallets[buy["user"]]["Mock"] -= qty * trade_price + fee
+                wallets[buy["user"]]["Ycoin"] += qty
+                wallets[sell["user"]]["Mock"] += qty * trade_price - fee
+                wallets[sell["user"]]["Ycoin"] -= qty
+                buy["amount"] -= qty
+                sell["amount"] -= qty
+                fills.append((buy["id"], sell["id"], qty, trade_price))
+    return fills
+
+
+def _fills(fills)->list:
+    return [(f.buy["id"], f.sell["id"], f.qty, f.price) for f in fills]
+
+
+@pytest.fixture
+def journal(tmp_path):
+    j = Journal(str(tmp_path / "data.json"), _default, snapshot_every=50)
+    yield j
+    j._log.close()
+
+
+def test_random_flow_matches_nested_loop(journal):
+    rng = random.Random(11)
+    book = Book()
+    ref_orders = []
+    ref_wallets = {u: dict(r["wallet"]) for u, r in _default()["users"].items()}
+    for i in range(1, 601):
+        side = rng.choice(("buy", "sell"))
+        order = {"user": rng.choice(USERS), "type": side,
+                 "price": rng.randint(95, 105) if side == "buy" else rng.randint(97, 107),
+                 "amount": rng.randint(1, 8) / 4}
+        oid = journal.data["next_order_id"]
+        got = _fills(place_order(journal, book, "Mock", dict(order)))
+        ref_orders.append(dict(order, id=oid))
+        assert got == nested_loop(ref_orders, ref_wallets), i
+        assert match_and_settle(journal, book, "Mock") == []   # 新しい注文がなければ何もしない
+    for u in USERS:
+        assert journal.data["users"][u]["wallet"] == pytest.approx(ref_wallets[u])
+    open_ids = sorted(o["id"] for o in ref_orders if o["amount"] > 0)
+    assert sorted(o["id"] for o in journal.data["exchange_orders"] if o["amount"] > 0) == open_ids
+    for side in ("buy", "sell"):
+        levels = {}
+        for o in ref_orders:
+            if o["type"] == side and o["amount"] > 0:
+                lv = levels.setdefault(o["price"], [0, 0]); lv[0] += o["amount"]; lv[1] += 1
+        assert book.depth(side, 100) == sorted(((p, q, n) for p, (q, n) in levels.items()), reverse=(side == "buy"))
+
+
+def test_book_is_rebuilt_after_clear(journal):
+    book = Book()
+    place_order(journal, book, "Mock", {"user": "a", "type": "sell", "price": 100, "amount": 1})
+    with journal.lock:
+        journal.append({"t": "clear"})
+    place_order(journal, book, "Mock", {"user": "b", "type": "buy", "price": 101, "amount": 1})
+    assert book.depth("buy") == [(101, 1, 1)] and book.depth("sell") == []
+    fills = place_order(journal, book, "Mock", {"user": "c", "type": "sell", "price": 99, "amount": 2})
+    assert _fills(fills) == [(2, 3, 1, 100.0)]
+    assert book.depth("sell") == [(99, 1, 1)]
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""orderbook.OrderBook（価格・時間優先、部分約定、取消の遅延削除、板情報）を素朴な実装と突き合わせる"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exchange import sweep  # noqa: E402
+from orderbook import OrderBook, OID, QTY  # noqa: E402
+
+RICH = [10**18, 10**18]   # 残高不足にならない財布
+
+
+class NaiveBook:
+    """全注文を線形に探す参照実装（注文 id = ユーザー id にして約定の相手を識別する）"""
+
+    def __init__(self):
+        self.orders = {}   # id -> [id, side, price, qty]（挿入順 = 時刻順）
+
+    def add(self, oid, side, price, qty)->list:
+        """反対側と指値まで約定させ、[(買い id, 売り id, 価格, 数量)] を返す（残りは板に載せる）"""
+        fills = []
+        while qty > 0:
+            opp = [o for o in self.orders.values() if o[1] != side
+                   and (price >= o[2] if side == 'buy' else price <= o[2])]
+            if not opp:
+                break
+            best = min(opp, key=lambda o: o[2] if side == 'buy' else -o[2])   # 同値は先着（min は最初を返す）
+            q = min(qty, best[3])
+            b, s = ((oid, price), (best[0], best[2])) if side == 'buy' else ((best[0], best[2]), (oid, price))
+            fills.append((b[0], s[0], (b[1] + s[1]) // 2, q))
+            qty -= q; best[3] -= q
+            if best[3] == 0:
+                del self.orders[best[0]]
+        if qty > 0:
+            self.orders[oid] = [oid, side, price, qty]
+        return fills
+
+    def cancel(self, oid):
+        self.orders.pop(oid, None)
+
+    def depth(self, side):
+        lv = {}
+        for o in self.orders.values():
+            if o[1] == side:
+                d = lv.setdefault(o[2], [0, 0]); d[0] += o[3]; d[1] += 1
+        return sorted(((p, q, n) for p, (q, n) in lv.items()), reverse=(side == 'buy'))
+
+
+def _place(book:OrderBook, oid, side, price, qty)->list:
+    taker = book.add(oid, oid, side, price, qty, 0)
+    fills, _, _, _ = sweep(book, lambda u: list(RICH), taker)
+    return [(f[2], f[3], f[4], f[5]) for f in fills]
+
+
+def test_price_then_time_priority():
+    book = OrderBook()
+    _place(book, 1, 'sell', 101, 5)
+    _place(book, 2, 'sell', 100, 5)
+    _place(book, 3, 'sell', 100, 5)
+    fills = _place(book, 4, 'buy', 101, 12)
+    assert [(f[1], f[3]) for f in fills] == [(2, 5), (3, 5), (1, 2)]
+    assert book.best('sell')[OID] == 1 and book.best('sell')[QTY] == 3
+    assert book.best('buy') is None
+
+
+def test_partial_fill_keeps_rest_on_book():
+    book = OrderBook()
+    _place(book, 1, 'buy', 100, 10)
+    assert _place(book, 2, 'sell', 99, 4) == [(1, 2, 99, 4)]
+    assert book.best('buy')[QTY] == 6
+    assert book.depth('buy') == [(100, 6, 1)]
+    assert _place(book, 3, 'sell', 100, 10) == [(1, 3, 100, 6)]
+    assert book.depth('sell') == [(100, 4, 1)] and book.depth('buy') == []
+
+
+def test_cancelled_orders_are_skipped_lazily():
+    book = OrderBook()
+    for oid in (1, 2, 3):
+        _place(book, oid, 'buy', 100, 1)
+    book.remove(1); book.remove(2)
+    assert book.depth('buy') == [(100, 1, 1)]
+    assert book.best('buy')[OID] == 3
+    assert _place(book, 4, 'sell', 100, 5) == [(3, 4, 100, 1)]
+    assert len(book) == 1 and book.best_price('buy') is None and book.spread() is None
+
+
+def test_random_flow_matches_naive_book():
+    rng = random.Random(7)
+    book, ref = OrderBook(), NaiveBook()
+    live = []
+    for oid in range(1, 3001):
+        if live and rng.random() < 0.2:
+            victim = live.pop(rng.randrange(len(live)))
+            book.remove(victim); ref.cancel(victim)
+        side = rng.choice(('buy', 'sell'))
+        price = rng.randint(95, 105) if side == 'buy' else rng.randint(97, 107)
+        qty = rng.randint(1, 10)
+        assert _place(book, oid, side, price, qty) == ref.add(oid, side, price, qty)
+        live = [o for o in live if o in ref.orders] + ([oid] if oid in ref.orders else [])
+        for s in ('buy', 'sell'):
+            assert book.depth(s, 1000) == ref.depth(s)
+        assert len(book) == len(ref.orders)
+        assert not book.crossed()
+    # 読み込み直しても同じ板になる
+    rows = sorted(((o[0], o[0], o[1], o[2], o[3], 0) for o in ref.orders.values()), key=lambda r: r[0])
+    fresh = OrderBook(); fresh.load(rows)
+    for s in ('buy', 'sell'):
+        assert fresh.depth(s, 1000) == book.depth(s, 1000)
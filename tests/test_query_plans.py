@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""crypt_demo_v0 のよく使うクエリがインデックスに乗っているか（全表走査・一時 B-tree のソートが無いか）"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("streamlit")
+import crypt_demo_v0 as core  # noqa: E402
+
+
+def test_hot_queries_use_indexes(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, "DB", str(tmp_path / "simdex.db"))
+    core.init_db()
+    assert core.check_query_plans() == []
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""crypt_demo_v0 の板スナップショット: スナップショット + order_log の差分から読んだ板が orders テーブルと一致する"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("streamlit")
+import crypt_demo_v0 as core  # noqa: E402
+from fixedpoint import to_lots, to_mock  # noqa: E402
+from orderbook import OrderBook  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, "DB", str(tmp_path / "simdex.db"))
+    core.init_db()
+    return core.db_conn()
+
+
+def _sql_orders(con)->list:
+    return con.execute(core.SQL_OPEN_ORDERS + " ORDER BY ts, id").fetchall()
+
+
+def _queue(book:OrderBook, side:str)->list:
+    """最良気配から順に取り出した注文（価格・時間優先の並び）"""
+    out = []
+    while (o := book.best(side)) is not None:
+        out.append(tuple(o)); book.remove(o[0])
+    return out
+
+
+def _assert_matches_sql(con):
+    rows = core.snapshot_orders()
+    assert rows is not None   # orders テーブルからの読み直しではなくスナップショットから
+    assert rows == _sql_orders(con)
+    core._load_book.clear()
+    book = core._load_book(core.DB)
+    ref = OrderBook(); ref.load(_sql_orders(con))
+    assert len(book) == len(ref)
+    for side in ('buy', 'sell'):
+        assert book.depth(side, 100) == ref.depth(side, 100)
+        assert _queue(book, side) == _queue(ref, side)
+    core._load_book.clear()   # 取り出して空にしたので、次の get_book() で読み直させる
+
+
+def test_snapshot_plus_order_log_equals_sql(db):
+    a = core.create_user("alice", "pw")
+    b = core.create_user("bob", "pw")
+    core.set_wallet(a, to_mock(10**6), to_lots(100))
+    core.set_wallet(b, to_mock(10**6), to_lots(100))
+    for p in (101, 102, 102, 103):
+        core.place_order(a, 'sell', to_mock(p), to_lots(2))
+    for p in (99, 98, 98):
+        core.place_order(b, 'buy', to_mock(p), to_lots(2))
+    core.write_snapshot()
+    _assert_matches_sql(db)
+
+    # スナップショットの後: 部分約定・取消・新規・新規の取消・数量変更
+    book = core.get_book()
+    core.place_order(b, 'buy', to_mock(101), to_lots(1))          # 101 の売りが部分約定
+    core.cancel_order(a, book.user_orders(a)[1][0])                # スナップショットにある注文
+    core.place_order(a, 'sell', to_mock(104), to_lots(1))
+    core.place_order(b, 'buy', to_mock(97), to_lots(1))
+    core.cancel_order(b, book.user_orders(b)[-1][0])   # 新規の注文
+    core.update_order_qty(book.user_orders(b)[0][0], to_lots(5))
+    assert db.execute("SELECT COUNT(*) FROM order_log").fetchone()[0] > 0
+    _assert_matches_sql(db)
+
+    # 書き直したスナップショット（古い order_log は消える）からも同じ
+    core.write_snapshot()
+    assert db.execute("SELECT COUNT(*) FROM order_log").fetchone()[0] == 0
+    core.place_order(b, 'buy', to_mock(102), to_lots(3))
+    _assert_matches_sql(db)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""storage のバックエンド共通の振る舞い（transaction() の中で例外が出たら何も残らない）"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JournalStorage, MemoryStorage, SQLiteStorage, Storage  # noqa: E402
+
+
+@pytest.fixture(params=["sqlite", "journal", "memory"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        s = SQLiteStorage(str(tmp_path / "s.db"))
+    elif request.param == "journal":
+        s = JournalStorage(str(tmp_path / "s.json"))
+    else:
+        s = MemoryStorage()
+    yield s
+    s.close()
+
+
+def _state(s):
+    return (s.get_wallet(1), s.get_wallet(2), s.open_orders(), s.trades(), s.get_price(),
+            s.get_user("alice")[0], s.get_user("bob"))
+
+
+def test_failed_transaction_leaves_nothing(store):
+    uid = store.add_user("alice", "h", "s", 1000, 5)
+    oid = store.add_order(uid, 'buy', 100, 3, 1)
+    store.add_trades([(1, 'dealer', uid, None, 100, 1, 200, 2, 0)])
+    before = _state(store)
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            store.add_user("bob", "h", "s", 7, 7)
+            store.set_wallets([(uid, 1, 2)])
+            store.add_order(uid, 'sell', 120, 1, 2)
+            store.set_order_qtys([(oid, 0)])
+            store.add_trades([(2, 'exchange', uid, uid, 110, 1, 50, 1, 1)])
+            store.set_price(123)
+            raise RuntimeError("abort")
+    assert _state(store) == before
+    # 中断した分の id は次の登録で使われる
+    assert store.add_user("bob", "h", "s", 7, 7) == uid + 1
+    assert store.get_user("bob")[0] == uid + 1
+
+
+def test_committed_transaction(store):
+    uid = store.add_user("alice", "h", "s", 1000, 5)
+    with store.transaction():
+        store.set_wallets([(uid, 900, 6)])
+        oid = store.add_order(uid, 'buy', 100, 3, 1)
+    assert store.get_wallet(uid) == (900, 6)
+    assert [o[0] for o in store.open_orders()] == [oid]
+
+
+def test_incomplete_backend_fails_at_construction():
+    class Partial(Storage):
+        def get_price(self): return 0
+    with pytest.raises(TypeError):
+        Partial()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+マッチング用の常駐ワーカー（書き込みを1本のスレッドに直列化する）。
+
+Streamlit の再実行（ユーザーの操作）の中でマッチングすると、遅延が画面の
+トラフィック次第になり、同時に走った再実行どうしが同じ状態を取り合う。
+そこで注文の登録・約定・決済はこのワーカーのキューに積み、画面側は結果
+（Future）を待って表示するだけにする。ワーカーは st.cache_resource で
+プロセスに1つだけ起動する。
+
+    worker = Worker("matcher")
+    n = worker.call(place_order, uid, 'buy', price, qty)   # ワーカーのスレッドで実行
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
+CALL_TIMEOUT = 10.0   # 秒（画面側が結果を待つ上限）
+
+
+class Worker:
+    def __init__(self, name:str="matcher"):
+        self.name = name
+        self._q = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn:Callable, *args, **kwargs)->Future:
+        """fn(*args, **kwargs) をキューに積み、結果の Future を返す（到着順に1つずつ実行）"""
+        fut = Future()
+        self._q.put((fn, args, kwargs, fut))
+        return fut
+
+    def call(self, fn:Callable, *args, **kwargs):
+        """submit して結果を待つ（例外はそのまま呼び出し側に送る）"""
+        return self.submit(fn, *args, **kwargs).result(CALL_TIMEOUT)
+
+    def pending(self)->int:
+        return self._q.qsize()
+
+    def stop(self):
+        self._q.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                break
+            fn, args, kwargs, fut = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                fut.set_exception(e)